@@ -1,3 +1,8 @@
 from django.contrib import admin
+from .models import AIGenerationJob
 
 # Register your models here.
+@admin.register(AIGenerationJob)
+class AIGenerationJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'goal', 'status', 'created_at')
+    list_filter = ('status',)
@@ -0,0 +1,196 @@
+"""
+Batch onboarding: plans for many users at once. Users are grouped by plan cache key, every distinct
+plan is fetched or generated once (a bounded number at a time) and it is then saved for all the users
+of its group with the same set-based statements, whatever their number. Generations take their slot in
+generation_limiter like the requests of the users do, so a batch never pushes the service past its limits.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from authentication.models import User
+from growthness.utils import parse_id, parse_int
+from .cache import lookup_plan, plan_cache_key, profile_buckets
+from .limiter import LimitExceeded, RateLimiter, generation_limiter
+from .local_planner import generate_local_plan
+from .metrics import collect, record_queries, stage
+from .models import AIGenerationJob
+from .plan_templates import apply_plan_to_users
+from .utils import create_models_data, get_plan_for_buckets
+
+# seconds between two attempts to take a generation slot
+SLOT_POLL_SECONDS = 1.0
+
+
+def resolve_users(identifiers):
+    """
+    Description: users by id or email, loaded in one query. Returns the users in the order given
+    and the identifiers that matched nobody.
+    """
+    # integers are ids (out of range ones match nobody), anything else is an email
+    ids = {parse_id(identifier) for identifier in identifiers} - {None}
+    emails = {str(identifier).lower() for identifier in identifiers if parse_int(identifier) is None}
+    users = User.objects.filter(Q(id__in=ids) | Q(email__in=emails)).select_related('goal')
+    by_id = {user.id: user for user in users}
+    by_email = {user.email.lower(): user for user in users}
+
+    found, missing = [], []
+    for identifier in identifiers:
+        if parse_int(identifier) is None:
+            user = by_email.get(str(identifier).lower())
+        else:
+            user = by_id.get(parse_id(identifier))
+        if user is None:
+            missing.append(identifier)
+        elif user not in found:
+            found.append(user)
+    return found, missing
+
+
+def create_jobs(users, goal=None):
+    """
+    Description: one queued AIGenerationJob per user, for the goal or the user's own goal.
+    Users without any goal get no job and are returned apart.
+    """
+    jobs, skipped = [], []
+    for user in users:
+        user_goal = goal or (user.goal.title if user.goal_id else '')
+        if user_goal:
+            jobs.append(AIGenerationJob(user=user, goal=user_goal, payload={'goal': user_goal}))
+        else:
+            skipped.append(user)
+    return AIGenerationJob.objects.bulk_create(jobs), skipped
+
+
+class PlanGroup:
+    """
+    Description: the jobs that share a plan cache key, and what happened to their plan.
+    """
+
+    def __init__(self, key, goal, buckets):
+        self.key = key
+        self.goal = goal
+        self.buckets = buckets
+        self.jobs = []
+        self.source = AIGenerationJob.SOURCE_AI
+        self.created = {}
+        self.error = None
+        self.metrics = None
+
+
+def group_jobs(jobs):
+    groups = {}
+    for job in jobs:
+        buckets = profile_buckets(job.user)
+        key = plan_cache_key(job.goal, buckets)
+        if key not in groups:
+            groups[key] = PlanGroup(key, job.goal, buckets)
+        groups[key].jobs.append(job)
+    return list(groups.values())
+
+
+def _generation_slot(group):
+    """
+    Description: a generation slot for the group, taken for its first user. A full limiter is waited on
+    (up to the slot timeout, when the slots of lost holders have expired) instead of failing the group.
+    """
+    deadline = time.monotonic() + generation_limiter.timeout
+    while True:
+        try:
+            return generation_limiter.acquire(group.jobs[0].user_id)
+        except LimitExceeded:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise
+            time.sleep(min(SLOT_POLL_SECONDS, remaining))
+
+
+def _onboard_group(group, limiter, threaded):
+    users = [job.user for job in group.jobs]
+    try:
+        with collect() as metrics:
+            try:
+                # only generations count against the rate limit and take a slot
+                slot = None
+                if lookup_plan(group.key) is None:
+                    limiter.wait()
+                    slot = _generation_slot(group)
+                try:
+                    entry = get_plan_for_buckets({'goal': group.goal}, group.buckets)
+                finally:
+                    generation_limiter.release(slot)
+
+                if entry is not None:
+                    with stage('persist'):
+                        group.created, queries = apply_plan_to_users(entry, users)
+                elif settings.AI_LOCAL_FALLBACK:
+                    # the same goal and bands give the same local plan: built once for the group
+                    group.source = AIGenerationJob.SOURCE_LOCAL
+                    with stage('local_plan'):
+                        plan = generate_local_plan(group.goal, buckets=group.buckets)
+                    with stage('persist'), transaction.atomic():
+                        group.created = {user.id: create_models_data(plan, user) for user in users}
+                        queries = sum(created.pop('queries') for created in group.created.values())
+                else:
+                    raise ValueError("Error generating data")
+                record_queries(queries)
+            except Exception as e:
+                group.error = str(e)
+        group.metrics = metrics.as_dict()
+    finally:
+        if threaded:
+            connection.close()
+    return group
+
+
+def onboard_jobs(jobs, concurrency=None, max_per_minute=None):
+    """
+    Description: generate and save the plans of many jobs. Each distinct plan is fetched (or generated)
+    once, at most `concurrency` at a time and `max_per_minute` generations per minute, then saved for all
+    the users of its group in bulk. The jobs are updated like generate_plan_for_user does.
+
+    Returns one report row per job.
+    """
+    concurrency = max(1, concurrency or settings.AI_BATCH_CONCURRENCY)
+    limiter = RateLimiter(settings.AI_BATCH_MAX_PER_MINUTE if max_per_minute is None else max_per_minute)
+    groups = group_jobs(jobs)
+
+    AIGenerationJob.objects.filter(id__in=[job.id for job in jobs]).update(status=AIGenerationJob.STATUS_RUNNING)
+
+    if concurrency == 1 or len(groups) == 1:
+        for group in groups:
+            _onboard_group(group, limiter, threaded=False)
+    else:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(groups))) as executor:
+            for future in as_completed([executor.submit(_onboard_group, group, limiter, True) for group in groups]):
+                future.result()
+
+    report = []
+    now = timezone.now()
+    for group in groups:
+        for job in group.jobs:
+            job.updated_at = now
+            job.metrics = {**group.metrics, 'batch_users': len(group.jobs)}
+            if group.error is not None:
+                job.status = AIGenerationJob.STATUS_FAILED
+                job.error = group.error
+            else:
+                job.status = AIGenerationJob.STATUS_DONE
+                job.source = group.source
+            created = group.created.get(job.user_id, {})
+            report.append({
+                'user_id': job.user_id,
+                'email': job.user.email,
+                'job_id': job.id,
+                'cache_key': group.key,
+                'status': job.status,
+                'source': job.source if group.error is None else None,
+                'cache': group.metrics.get('cache'),
+                'created': {name: len(ids) for name, ids in created.items()},
+                'error': group.error,
+            })
+
+    AIGenerationJob.objects.bulk_update(jobs, ['status', 'error', 'source', 'metrics', 'updated_at'])
+    return report
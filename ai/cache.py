@@ -0,0 +1,194 @@
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from authentication.utils import age_in_years, height_in_cm, weight_in_kg
+from .models import AI_data, PlanTemplate
+
+# Width of each profile band; users falling in the same bands share a cached plan
+WEIGHT_BAND_KG = 10
+HEIGHT_BAND_CM = 10
+AGE_BAND_YEARS = 10
+
+
+def normalize_goal(goal):
+    """
+    Description: lowercase the goal, drop accents and punctuation and collapse whitespace,
+    so "Perder  Peso!" and "perder peso" share a cache entry.
+    """
+    goal = unicodedata.normalize('NFKD', str(goal))
+    goal = ''.join(char for char in goal if not unicodedata.combining(char))
+    goal = re.sub(r'[^\w\s]', ' ', goal.lower())
+    return ' '.join(goal.split())
+
+
+def _band(value, width):
+    if value is None or value <= 0:
+        return None
+    return int(value // width * width)
+
+
+def profile_buckets(user=None):
+    """
+    Description: weight (kg), height (cm) and age (years) bands of the user, as the lower bound of each band.
+    Unknown values (or no user at all) are None.
+    """
+    if user is None or not getattr(user, 'is_authenticated', False):
+        return {'weight': None, 'height': None, 'age': None}
+
+    return {
+        'weight': _band(weight_in_kg(user), WEIGHT_BAND_KG),
+        'height': _band(height_in_cm(user), HEIGHT_BAND_CM),
+        'age': _band(age_in_years(user.birth_date), AGE_BAND_YEARS),
+    }
+
+
+def describe_profile(buckets):
+    """
+    Description: human readable ranges for the bands, sent to the generator along with the goal.
+    """
+    widths = {'weight': (WEIGHT_BAND_KG, 'kg'), 'height': (HEIGHT_BAND_CM, 'cm'), 'age': (AGE_BAND_YEARS, 'anos')}
+    profile = {}
+    for name, (width, unit) in widths.items():
+        if buckets.get(name) is not None:
+            profile[name] = f"{buckets[name]}-{buckets[name] + width - 1} {unit}"
+    return profile
+
+
+def cache_version():
+    return getattr(settings, 'AI_PLAN_CACHE_VERSION', 1)
+
+
+def cache_ttl():
+    return timedelta(seconds=getattr(settings, 'AI_PLAN_CACHE_TTL', 60 * 60 * 24 * 30))
+
+
+def plan_cache_key(goal, buckets, version=None):
+    version = cache_version() if version is None else version
+    goal = normalize_goal(goal)
+    # keep the key readable in the admin, but make sure it fits the column
+    if len(goal) > 180:
+        goal = hashlib.sha1(goal.encode()).hexdigest()
+    profile = ':'.join('-' if buckets.get(name) is None else str(buckets[name]) for name in ('weight', 'height', 'age'))
+    return f"v{version}:{goal}:{profile}"
+
+
+class PlanLRU:
+    """
+    Description: small in-process LRU kept in front of the AI_data table for hot goals.
+    Entries expire with the same TTL as the table rows.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, entry = item
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, ttl_seconds):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl_seconds, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+plan_lru = PlanLRU(getattr(settings, 'AI_PLAN_CACHE_LRU_SIZE', 128))
+
+
+def _remaining_ttl(entry):
+    return max((entry.created_at + cache_ttl() - timezone.now()).total_seconds(), 0)
+
+
+def lookup_plan(key):
+    """
+    Description: return the fresh AI_data row for the key, or None. Hits in the LRU cost no query,
+    misses cost a single indexed lookup.
+    """
+    entry = plan_lru.get(key)
+    if entry is not None:
+        return entry
+
+    entry = AI_data.objects.filter(
+        cache_key=key,
+        version=cache_version(),
+        created_at__gte=timezone.now() - cache_ttl()
+    ).first()
+
+    if entry is not None:
+        plan_lru.set(key, entry, _remaining_ttl(entry))
+    return entry
+
+
+def store_plan(key, goal, json_data):
+    """
+    Description: save a generated plan under the key, replacing any stale row (and its compiled template).
+    Empty plans are never stored.
+    """
+    if not json_data:
+        return None
+
+    entry, created = AI_data.objects.update_or_create(
+        cache_key=key,
+        defaults={
+            'goal': normalize_goal(goal),
+            'json_data': json_data,
+            'version': cache_version(),
+            'created_at': timezone.now(),
+        }
+    )
+    if not created:
+        PlanTemplate.objects.filter(entry=entry).delete()
+    plan_lru.set(key, entry, _remaining_ttl(entry))
+    goal_index().add(key, entry.goal, entry.created_at)
+    return entry
+
+
+def invalidate_plan(key):
+    plan_lru.delete(key)
+    goal_index().discard(key)
+    AI_data.objects.filter(cache_key=key).delete()
+
+
+def goal_index():
+    # the similarity index is built on this module, so it is imported when first used
+    from .similarity import goal_index
+    return goal_index
+
+
+def purge_expired_plans():
+    """
+    Description: delete rows from older cache versions or past their TTL. Returns how many were removed.
+    """
+    plan_lru.clear()
+    deleted, _ = AI_data.objects.filter(
+        ~Q(version=cache_version()) | Q(created_at__lt=timezone.now() - cache_ttl())
+    ).delete()
+    return deleted
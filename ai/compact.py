@@ -0,0 +1,88 @@
+"""
+Compact generation protocol: short prompts and positional rows instead of verbose JSON objects.
+GPT answers e.g. [["Dormir bem",8,"horas"]] instead of [{"name": "Dormir bem", "goal": 8, "measure": "horas"}],
+and the rows are expanded back into the usual plan dicts before validation.
+"""
+
+# (key, label used in the prompt); a third item makes the field a list of nested rows
+COMPACT_FORMATS = {
+    'habits': (('name', 'nome'), ('goal', 'meta'), ('measure', 'unidade')),
+    'exercises': (
+        ('day', 'dia'),
+        ('routine', 'exercícios', (('exercise', 'exercício'), ('sets', 'séries'), ('weight', 'carga_kg'), ('reps', 'repetições'))),
+    ),
+    'diet': (
+        ('meal', 'refeição'),
+        ('foods', 'alimentos', (
+            ('name', 'alimento'), ('servings', 'porções'), ('calories', 'kcal'),
+            ('protein', 'proteína_g'), ('carbs', 'carboidrato_g'), ('fat', 'gordura_g'),
+        )),
+    ),
+}
+
+COMPACT_COMMON_PROMPT = (
+    "Gere parte de um plano de saúde personalizado, em português, para os dados do usuário. "
+    "Responda APENAS com um array JSON compacto (sem espaços, sem chaves de objeto, sem texto extra). "
+)
+
+COMPACT_INSTRUCTIONS = {
+    'habits': "Hábitos: no mínimo 3 (sono, alimentação e exercício).",
+    'exercises': "Treino da semana: no mínimo 3 exercícios por dia disponível. Dias: seg,ter,qua,qui,sex,sab,dom.",
+    'diet': "Dieta do dia: no mínimo 3 refeições; valores nutricionais por porção.",
+}
+
+
+def _row_format(fields):
+    parts = []
+    for field in fields:
+        if len(field) == 3:
+            parts.append(f"[{_row_format(field[2])},...]")
+        else:
+            parts.append(field[1])
+    return f"[{','.join(parts)}]"
+
+
+def compact_prompt(section):
+    return f"{COMPACT_COMMON_PROMPT}{COMPACT_INSTRUCTIONS[section]} Cada item: {_row_format(COMPACT_FORMATS[section])}"
+
+
+COMPACT_PROMPTS = {section: compact_prompt(section) for section in COMPACT_FORMATS}
+
+
+def _expand_rows(rows, fields):
+    if not isinstance(rows, list):
+        # left for the schema validation to report
+        return rows
+    return [_expand_row(row, fields) for row in rows]
+
+
+def _expand_row(row, fields):
+    if not isinstance(row, list):
+        # e.g. the model answered with an object anyway
+        return row
+    item = {}
+    for field, value in zip(fields, row):
+        item[field[0]] = _expand_rows(value, field[2]) if len(field) == 3 else value
+    return item
+
+
+def expand_section(section, rows):
+    """
+    Description: positional rows of a section -> the list of dicts create_models_data consumes.
+    Missing trailing values are left out; the schema validation decides whether they were required.
+    """
+    return _expand_rows(rows, COMPACT_FORMATS[section])
+
+
+def _compact_rows(items, fields):
+    return [
+        [_compact_rows(item.get(field[0], []), field[2]) if len(field) == 3 else item.get(field[0]) for field in fields]
+        for item in items
+    ]
+
+
+def compact_section(section, items):
+    """
+    Description: the inverse of expand_section, used to build test and benchmark responses.
+    """
+    return _compact_rows(items, COMPACT_FORMATS[section])
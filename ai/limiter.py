@@ -0,0 +1,252 @@
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import redis
+from django.conf import settings
+from .locks import get_redis
+from .metrics import record_counter
+
+
+class RateLimiter:
+    """
+    Description: spaces calls so that at most `per_minute` of them start in any minute, across threads.
+    A value of 0 (or less) disables the limit.
+    """
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
+class LimitExceeded(Exception):
+    """
+    Description: no generation slot is free. `scope` is 'global' (the service is saturated) or 'user'
+    (this user already has as many generations in flight as allowed); `retry_after` is in seconds.
+    """
+
+    def __init__(self, scope, retry_after):
+        super().__init__(f"Too many AI generations in flight ({scope} limit)")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+# Takes a slot in every semaphore (global, user) or in none. Each semaphore is a sorted set of
+# tokens scored by their expiry, so slots of crashed workers free themselves.
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local expires_at = tonumber(ARGV[2])
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+    if redis.call('ZCARD', key) >= tonumber(ARGV[3 + i]) then
+        return i
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, expires_at, ARGV[3])
+    redis.call('EXPIRE', key, math.ceil(expires_at - now))
+end
+return 0
+"""
+
+
+class LocalSemaphores:
+    """
+    Description: the same semaphores in process memory, used while Redis is unreachable.
+    The limits then hold per process instead of across every worker.
+    """
+
+    def __init__(self):
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, keys, limits, token, now, expires_at):
+        with self._lock:
+            for index, (key, limit) in enumerate(zip(keys, limits), start=1):
+                slots = self._slots.setdefault(key, {})
+                for expired in [slot for slot, expiry in slots.items() if expiry <= now]:
+                    del slots[expired]
+                if len(slots) >= limit:
+                    return index
+            for key in keys:
+                self._slots[key][token] = expires_at
+            return 0
+
+    def release(self, keys, token):
+        with self._lock:
+            for key in keys:
+                self._slots.get(key, {}).pop(token, None)
+
+    def depth(self, key, now):
+        with self._lock:
+            return sum(expiry > now for expiry in self._slots.get(key, {}).values())
+
+
+class ConcurrencyLimiter:
+    """
+    Description: bounds the GPT generations in flight, globally and per user, across every web and celery
+    worker. Slots live in Redis sorted sets and expire after `timeout` seconds in case their holder dies;
+    while Redis is unreachable, per process semaphores take over. A limit of 0 disables it.
+
+        token = limiter.acquire(user.id)  # raises LimitExceeded
+        ...
+        limiter.release(token)
+
+    Tokens are "{user_id}:{backend}:{uuid}", backend being where the slot was taken ('redis' or 'local').
+    A local slot can only be released by the process that took it, see hand_off.
+    """
+
+    REDIS_RETRY_SECONDS = 30
+
+    def __init__(self, name, global_limit=None, user_limit=None, timeout=None, retry_after=None):
+        # None reads the AI_CONCURRENCY_* setting on every call
+        self.name = name
+        self._global_limit = global_limit
+        self._user_limit = user_limit
+        self._timeout = timeout
+        self._retry_after = retry_after
+        self.local = LocalSemaphores()
+        self._script = None
+        self._redis_down_until = 0.0
+
+    @property
+    def global_limit(self):
+        return settings.AI_CONCURRENCY_LIMIT if self._global_limit is None else self._global_limit
+
+    @property
+    def user_limit(self):
+        return settings.AI_CONCURRENCY_LIMIT_PER_USER if self._user_limit is None else self._user_limit
+
+    @property
+    def timeout(self):
+        return settings.AI_CONCURRENCY_SLOT_TIMEOUT if self._timeout is None else self._timeout
+
+    @property
+    def retry_after(self):
+        return settings.AI_CONCURRENCY_RETRY_AFTER if self._retry_after is None else self._retry_after
+
+    def _keys(self, user_id):
+        # (scope, key, limit) of every enabled semaphore
+        scopes = [
+            ('global', f"ai:limiter:{self.name}:global", self.global_limit),
+            ('user', f"ai:limiter:{self.name}:user:{user_id}", self.user_limit),
+        ]
+        return [scope for scope in scopes if scope[2] > 0]
+
+    def _redis(self):
+        # after a failure, skip Redis for a while instead of paying the connect timeout on every request
+        if time.monotonic() < self._redis_down_until:
+            return None
+        return get_redis()
+
+    def _redis_failed(self):
+        self._redis_down_until = time.monotonic() + self.REDIS_RETRY_SECONDS
+
+    def acquire(self, user_id):
+        """
+        Description: take a slot for the user and return its token, or raise LimitExceeded.
+        """
+        slot_id = uuid.uuid4().hex
+        scopes = self._keys(user_id)
+        if not scopes:
+            return f"{user_id}:none:{slot_id}"
+
+        keys = [key for _, key, _ in scopes]
+        limits = [limit for _, _, limit in scopes]
+        now = time.time()
+        expires_at = now + self.timeout
+
+        full = None
+        client = self._redis()
+        if client is not None:
+            token = f"{user_id}:redis:{slot_id}"
+            try:
+                if self._script is None:
+                    self._script = client.register_script(ACQUIRE_SCRIPT)
+                full = self._script(keys=keys, args=[now, expires_at, token, *limits], client=client)
+            except redis.exceptions.RedisError:
+                self._redis_failed()
+        if full is None:
+            token = f"{user_id}:local:{slot_id}"
+            full = self.local.acquire(keys, limits, token, now, expires_at)
+
+        if full:
+            scope = scopes[full - 1][0]
+            record_counter(f"limiter_rejected_{scope}")
+            raise LimitExceeded(scope, self.retry_after)
+        return token
+
+    def release(self, token):
+        if not token:
+            return
+        user_id, backend, _ = token.split(':', 2)
+        keys = [key for _, key, _ in self._keys(user_id)]
+        if not keys:
+            return
+
+        if backend == 'local':
+            self.local.release(keys, token)
+            return
+        client = self._redis()
+        if client is None:
+            return
+        try:
+            pipeline = client.pipeline(transaction=False)
+            for key in keys:
+                pipeline.zrem(key, token)
+            pipeline.execute()
+        except redis.exceptions.RedisError:
+            self._redis_failed()
+
+    def hand_off(self, token):
+        """
+        Description: the token to give to another process (a celery task) that releases the slot when it is done.
+        A local slot lives in this process' memory and could never be released from there, so it is released
+        now and None is returned: while Redis is down, the limits only cover the work done in this process.
+        """
+        if token and token.split(':', 2)[1] != 'redis':
+            self.release(token)
+            return None
+        return token
+
+    def reset(self):
+        # drops the slots held in process memory (tests, or after a worker pool restart)
+        self.local = LocalSemaphores()
+
+    @contextmanager
+    def slot(self, user_id):
+        token = self.acquire(user_id)
+        try:
+            yield token
+        finally:
+            self.release(token)
+
+    def depth(self):
+        """
+        Description: generations in flight (holding a global slot) and the limits.
+        """
+        key = f"ai:limiter:{self.name}:global"
+        now = time.time()
+        in_flight = None
+        client = self._redis()
+        if client is not None:
+            try:
+                in_flight = client.zcount(key, f"({now}", '+inf')
+            except redis.exceptions.RedisError:
+                self._redis_failed()
+        if in_flight is None:
+            in_flight = self.local.depth(key, now)
+        return {'in_flight': in_flight, 'limit': self.global_limit, 'per_user_limit': self.user_limit}
+
+
+generation_limiter = ConcurrencyLimiter('generation')
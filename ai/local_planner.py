@@ -0,0 +1,111 @@
+"""
+Rule based plan engine. Builds a plan in the same shape as the GPT ones from the Exercise and Food
+catalogs, the goal and the user's profile bands, in a few milliseconds and without any network call.
+Used when OpenAI can't answer, and as a first draft while the GPT plan is generated in the background.
+The diet is solved for the profile's macro targets by diets.planner.
+"""
+from diets.models import Food
+from diets.planner import DEFAULT_PROFILE, FOODS_PER_MEAL, FoodArrays, goal_kind, macro_targets, optimize_diet
+from exercises.models import Exercise
+from .cache import AGE_BAND_YEARS, HEIGHT_BAND_CM, WEIGHT_BAND_KG, profile_buckets
+from .schema import validate_plan
+
+# Per goal kind: training days, reps per set, load as a fraction of body weight
+# and whether every training day ends with cardio
+GOAL_RULES = {
+    'lose': {'days': ('Segunda-feira', 'Quarta-feira', 'Sexta-feira'), 'reps': 15, 'load': 0.3, 'cardio': True},
+    'gain': {'days': ('Segunda-feira', 'Terça-feira', 'Quinta-feira', 'Sexta-feira'), 'reps': 10, 'load': 0.5, 'cardio': False},
+    'endurance': {'days': ('Terça-feira', 'Quinta-feira', 'Sábado'), 'reps': 15, 'load': 0.25, 'cardio': True},
+    'maintain': {'days': ('Segunda-feira', 'Quarta-feira', 'Sexta-feira'), 'reps': 12, 'load': 0.35, 'cardio': False},
+}
+
+EXERCISES_PER_DAY = 3
+
+# Used when the catalogs don't have enough entries yet; created in the catalog when the plan is saved
+DEFAULT_EXERCISES = (
+    ('Agachamento livre', 'gym'), ('Supino reto', 'gym'), ('Remada curvada', 'gym'),
+    ('Levantamento terra', 'gym'), ('Desenvolvimento com halteres', 'gym'), ('Puxada frontal', 'gym'),
+    ('Afundo', 'gym'), ('Rosca direta', 'gym'), ('Tríceps na polia', 'gym'),
+    ('Corrida', 'cardio'), ('Bicicleta ergométrica', 'cardio'), ('Caminhada rápida', 'cardio'),
+)
+
+# name, calories, protein, carbs, fat (per serving)
+DEFAULT_FOODS = (
+    ('Ovo cozido', 78, 6.3, 0.6, 5.3), ('Peito de frango grelhado', 165, 31.0, 0.0, 3.6),
+    ('Iogurte natural', 100, 8.0, 11.0, 2.5), ('Aveia em flocos', 150, 5.0, 27.0, 3.0),
+    ('Arroz integral', 215, 5.0, 45.0, 1.8), ('Batata doce cozida', 115, 2.1, 27.0, 0.1),
+    ('Pão integral', 140, 6.0, 24.0, 2.0), ('Banana', 105, 1.3, 27.0, 0.4),
+    ('Feijão cozido', 115, 7.6, 20.0, 0.5), ('Castanhas', 185, 4.3, 3.9, 18.5),
+    ('Azeite de oliva', 120, 0.0, 0.0, 14.0), ('Salmão grelhado', 206, 22.0, 0.0, 12.0),
+)
+
+
+def profile_values(buckets):
+    """
+    Description: the middle of each profile band, or the default profile for unknown bands.
+    """
+    widths = {'weight': WEIGHT_BAND_KG, 'height': HEIGHT_BAND_CM, 'age': AGE_BAND_YEARS}
+    return {
+        name: DEFAULT_PROFILE[name] if buckets.get(name) is None else buckets[name] + widths[name] / 2
+        for name in widths
+    }
+
+
+def _habits(kind, profile):
+    water = max(1.5, round(profile['weight'] * 0.035 * 2) / 2)
+    habits = [
+        {"name": "Dormir bem", "goal": 8, "measure": "horas", "frequency": "daily"},
+        {"name": "Beber água", "goal": water, "measure": "litros", "frequency": "daily"},
+        {"name": "Comer frutas e verduras", "goal": 5, "measure": "porções", "frequency": "daily"},
+        {"name": "Treinar", "goal": len(GOAL_RULES[kind]['days']), "measure": "treinos", "frequency": "weekly"},
+    ]
+    if kind in ('lose', 'endurance'):
+        habits.append({"name": "Caminhar", "goal": 10000, "measure": "passos", "frequency": "daily"})
+    return habits
+
+
+def _exercises(kind, profile, catalog):
+    rules = GOAL_RULES[kind]
+    gym = [name for name, exercise_type in catalog if exercise_type == 'gym'] or [name for name, t in DEFAULT_EXERCISES if t == 'gym']
+    cardio = [name for name, exercise_type in catalog if exercise_type == 'cardio'] or [name for name, t in DEFAULT_EXERCISES if t == 'cardio']
+    load = int(round(profile['weight'] * rules['load'] / 2.5) * 2.5)
+
+    exercises = []
+    cursor = 0
+    for day in rules['days']:
+        routine = []
+        strength = EXERCISES_PER_DAY - 1 if rules['cardio'] else EXERCISES_PER_DAY
+        # rotate through the catalog so consecutive days train different exercises
+        for _ in range(strength):
+            routine.append({"exercise": gym[cursor % len(gym)], "exercise_type": "gym", "sets": 3, "weight": load, "reps": rules['reps']})
+            cursor += 1
+        if rules['cardio']:
+            routine.append({"exercise": cardio[len(exercises) % len(cardio)], "exercise_type": "cardio", "duration": 30 if kind == 'lose' else 40})
+        exercises.append({"day": day, "routine": routine})
+    return exercises
+
+
+def _diet(kind, profile, catalog):
+    foods = FoodArrays(catalog)
+    if len(foods) < FOODS_PER_MEAL * 2:
+        foods = FoodArrays([(None, *food) for food in DEFAULT_FOODS])
+    return optimize_diet(foods, macro_targets(profile, kind))['diet']
+
+
+def generate_local_plan(goal, user=None, buckets=None):
+    """
+    Description: a complete, validated plan for the goal and the user's profile bands (or the given buckets).
+    The same goal and bands always give the same plan.
+    """
+    buckets = profile_buckets(user) if buckets is None else buckets
+    kind = goal_kind(goal)
+    profile = profile_values(buckets)
+
+    exercises = list(Exercise.objects.order_by('id').values_list('name', 'exercise_type')[:200])
+    foods = Food.objects.order_by('id').values_list('id', 'name', 'calories', 'protein', 'carbs', 'fat')[:500]
+
+    return validate_plan({
+        "habits": _habits(kind, profile),
+        "exercises": _exercises(kind, profile, exercises),
+        "diet": _diet(kind, profile, foods),
+    })
@@ -0,0 +1,85 @@
+import hashlib
+import time
+from contextlib import contextmanager
+import redis
+from django.conf import settings
+from django.db import connection
+
+_redis_client = None
+
+
+def get_redis():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(
+            settings.AI_REDIS_URL,
+            socket_connect_timeout=0.5,
+            socket_timeout=5,
+        )
+    return _redis_client
+
+
+def _advisory_lock_id(name):
+    # pg advisory locks take a signed 64 bit integer
+    return int.from_bytes(hashlib.sha1(name.encode()).digest()[:8], 'big', signed=True)
+
+
+@contextmanager
+def _advisory_lock(name, wait):
+    if connection.vendor != 'postgresql':
+        # nothing to coordinate with, e.g. a single sqlite process
+        yield True
+        return
+
+    lock_id = _advisory_lock_id(name)
+    deadline = time.monotonic() + wait
+    acquired = False
+
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [lock_id])
+            acquired = cursor.fetchone()[0]
+            if acquired or time.monotonic() >= deadline:
+                break
+            time.sleep(0.1)
+
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [lock_id])
+
+
+@contextmanager
+def single_flight(key, timeout=None, wait=None):
+    """
+    Description: allow a single holder per key across every web and celery worker.
+
+    Uses a Redis lock that expires after `timeout` seconds, so a crashed worker can't hold it forever,
+    and falls back to a postgres advisory lock when Redis is unreachable. Callers wait up to `wait`
+    seconds; the context value tells whether the lock was acquired.
+    """
+    timeout = settings.AI_GENERATION_LOCK_TIMEOUT if timeout is None else timeout
+    wait = settings.AI_GENERATION_LOCK_WAIT if wait is None else wait
+    name = f"ai:single-flight:{key}"
+
+    try:
+        lock = get_redis().lock(name, timeout=timeout, blocking_timeout=wait)
+        acquired = lock.acquire()
+    except redis.exceptions.RedisError:
+        # unreachable, timing out or failing: fall back rather than fail the generation
+        with _advisory_lock(name, wait) as acquired:
+            yield acquired
+        return
+
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            try:
+                lock.release()
+            except redis.exceptions.RedisError:
+                # the lock expired while generating (someone else may own it now) or Redis went away;
+                # either way it frees itself after `timeout`
+                pass
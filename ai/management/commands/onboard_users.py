@@ -0,0 +1,46 @@
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ai.batch import create_jobs, onboard_jobs, resolve_users
+
+
+class Command(BaseCommand):
+    help = "Generate and save the AI plans of many users at once, each distinct plan generated once."
+
+    def add_arguments(self, parser):
+        parser.add_argument('users', nargs='*', help="User ids or emails.")
+        parser.add_argument('--file', help="File with one user id or email per line.")
+        parser.add_argument('--goal', help="Goal for every user, instead of their own goals.")
+        parser.add_argument('--concurrency', type=int, default=settings.AI_BATCH_CONCURRENCY,
+                            help="Distinct plans fetched or generated at the same time.")
+        parser.add_argument('--max-per-minute', type=int, default=settings.AI_BATCH_MAX_PER_MINUTE,
+                            help="Generations started per minute, to stay under the OpenAI rate limits (0 disables).")
+        parser.add_argument('--json', action='store_true', help="Print the per-user report as JSON.")
+
+    def handle(self, *args, **options):
+        identifiers = list(options['users'])
+        if options['file']:
+            with open(options['file'], encoding='utf-8') as f:
+                identifiers += [line.strip() for line in f if line.strip()]
+        if not identifiers:
+            raise CommandError("Give at least one user id or email.")
+
+        users, missing = resolve_users(identifiers)
+        jobs, skipped = create_jobs(users, options['goal'])
+        report = onboard_jobs(jobs, options['concurrency'], options['max_per_minute']) if jobs else []
+
+        report += [{'user_id': user.id, 'email': user.email, 'status': 'skipped', 'error': "User has no goal."} for user in skipped]
+        report += [{'user_id': None, 'email': identifier, 'status': 'not_found', 'error': "User not found."} for identifier in missing]
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2, default=str))
+            return
+
+        for row in report:
+            detail = row['error'] or f"{row['source']} plan ({row['cache']}), {row['created']}"
+            self.stdout.write(f"{row['email']}: {row['status']} - {detail}")
+
+        groups = len({row['cache_key'] for row in report if row.get('cache_key')})
+        failed = sum(row['status'] != 'done' for row in report)
+        summary = f"Done: {len(report) - failed} user(s) onboarded with {groups} distinct plan(s), {failed} not onboarded"
+        self.stdout.write(self.style.WARNING(summary) if failed else self.style.SUCCESS(summary))
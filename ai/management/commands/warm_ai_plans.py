@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from authentication.models import User
+from complete_profile.models import UserGoals
+from ai.cache import lookup_plan, plan_cache_key, profile_buckets, purge_expired_plans
+from ai.limiter import RateLimiter
+from ai.metrics import collect
+from ai.utils import get_plan_for_buckets
+
+UNKNOWN_PROFILE = {'weight': None, 'height': None, 'age': None}
+
+
+class Command(BaseCommand):
+    help = "Generate the missing or stale AI plans for every UserGoals entry and the profile buckets of its users."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.AI_WARM_CONCURRENCY,
+                            help="Plans generated at the same time.")
+        parser.add_argument('--max-per-minute', type=int, default=settings.AI_WARM_MAX_PER_MINUTE,
+                            help="Plans started per minute, to stay under the OpenAI rate limits (0 disables).")
+        parser.add_argument('--goal', action='append', dest='goals',
+                            help="Only warm this goal title (repeatable).")
+        parser.add_argument('--force', action='store_true',
+                            help="Regenerate plans even if the cached one is still fresh.")
+
+    def targets(self, goals):
+        """
+        Returns the (goal title, buckets) pairs to warm: every goal with the unknown profile,
+        plus every profile bucket its users fall in.
+        """
+        user_goals = UserGoals.objects.order_by('id')
+        if goals:
+            user_goals = user_goals.filter(title__in=goals)
+
+        buckets_by_goal = {user_goal.id: [UNKNOWN_PROFILE] for user_goal in user_goals}
+        users = User.objects.filter(goal__in=list(buckets_by_goal)).only(
+            'goal', 'weight', 'weight_measure', 'height', 'height_measure', 'birth_date'
+        )
+        for user in users:
+            buckets = profile_buckets(user)
+            if buckets not in buckets_by_goal[user.goal_id]:
+                buckets_by_goal[user.goal_id].append(buckets)
+
+        return [(user_goal.title, buckets) for user_goal in user_goals for buckets in buckets_by_goal[user_goal.id]]
+
+    def warm(self, goal, buckets, force, limiter):
+        key = plan_cache_key(goal, buckets)
+        try:
+            if not force and lookup_plan(key) is not None:
+                return key, 'cached'
+
+            limiter.wait()
+            with collect():
+                entry = get_plan_for_buckets({'goal': goal}, buckets, refresh=force)
+            if entry is None:
+                return key, 'failed'
+            # the plan of a similar goal is served as is, nothing is stored under this key
+            return key, 'generated' if entry.cache_key == key else 'similar'
+        finally:
+            if self.threaded:
+                connection.close()
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        limiter = RateLimiter(options['max_per_minute'])
+        self.threaded = concurrency > 1
+
+        purged = purge_expired_plans()
+        if purged:
+            self.stdout.write(f"Purged {purged} expired plan(s)")
+
+        targets = self.targets(options['goals'])
+        total = len(targets)
+        self.stdout.write(f"Warming {total} plan(s) with concurrency {concurrency}")
+
+        counts = {'cached': 0, 'generated': 0, 'similar': 0, 'failed': 0}
+
+        def report(done, key, outcome):
+            counts[outcome] += 1
+            self.stdout.write(f"[{done}/{total}] {key}: {outcome}")
+
+        if not self.threaded:
+            for done, (goal, buckets) in enumerate(targets, start=1):
+                report(done, *self.warm(goal, buckets, options['force'], limiter))
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [executor.submit(self.warm, goal, buckets, options['force'], limiter) for goal, buckets in targets]
+                for done, future in enumerate(as_completed(futures), start=1):
+                    report(done, *future.result())
+
+        summary = (
+            f"Done: {counts['generated']} generated, {counts['cached']} already cached, {counts['failed']} failed, "
+            f"{counts['similar']} served by a similar goal"
+        )
+        if counts['failed']:
+            self.stdout.write(self.style.WARNING(summary))
+        else:
+            self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,189 @@
+"""
+Instrumentation of the AI plan pipeline. A run (one job, one warmed plan) is wrapped in `collect()`;
+the code it calls records stage timings, cache outcomes and OpenAI calls into the current collector,
+whichever thread it runs on. Outside of a run, recording is a no-op.
+"""
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+import redis
+from django.conf import settings
+from .locks import get_redis
+
+logger = logging.getLogger(__name__)
+
+COUNTERS_KEY = 'ai:metrics:counters'
+
+_current = ContextVar('ai_pipeline_metrics', default=None)
+
+
+class PipelineMetrics:
+    """
+    Description: what one run of the pipeline spent, per stage, plus its cache outcome and OpenAI calls.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = {}
+        self.cache = None
+        self.similarity = None
+        self.openai_calls = []
+        self.queries = None
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def add_openai_call(self, call):
+        with self._lock:
+            self.openai_calls.append(call)
+
+    def as_dict(self):
+        prompt_tokens = sum(call.get('prompt_tokens') or 0 for call in self.openai_calls)
+        completion_tokens = sum(call.get('completion_tokens') or 0 for call in self.openai_calls)
+        ttfts = [call['ttft_ms'] for call in self.openai_calls if call.get('ttft_ms') is not None]
+        return {
+            'total_ms': round(self.timings.get('total', 0.0) * 1000, 1),
+            'stages_ms': {stage: round(seconds * 1000, 1) for stage, seconds in self.timings.items() if stage != 'total'},
+            'cache': self.cache,
+            # best cosine among the cached goals, when the exact goal wasn't cached
+            'similarity': self.similarity,
+            # the sections are generated at the same time: the first token of any of them is what the user waits for
+            'ttft_ms': min(ttfts) if ttfts else None,
+            'openai_calls': self.openai_calls,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cost_usd': round(plan_cost(prompt_tokens, completion_tokens), 6),
+            'queries': self.queries,
+        }
+
+
+def plan_cost(prompt_tokens, completion_tokens):
+    return (prompt_tokens * settings.OPENAI_PROMPT_PRICE_PER_1K + completion_tokens * settings.OPENAI_COMPLETION_PRICE_PER_1K) / 1000
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def collect():
+    """
+    Description: collect the metrics of one pipeline run. They are published (log line and Redis counters)
+    when the run ends, and the caller can attach `as_dict()` to its job.
+    """
+    metrics = PipelineMetrics()
+    token = _current.set(metrics)
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.add_time('total', time.perf_counter() - start)
+        _current.reset(token)
+        publish(metrics)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(name, time.perf_counter() - start)
+
+
+def record_time(name, seconds):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_time(name, seconds)
+
+
+def record_cache(outcome):
+    """
+    Description: 'hit' (cached plan), 'similar' (cached plan of a similar goal), 'coalesced'
+    (generated by a concurrent worker) or 'miss'.
+    """
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.cache = outcome
+
+
+def record_similarity(score):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.similarity = score
+
+
+def record_openai_call(**call):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_openai_call(call)
+
+
+def record_queries(count):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.queries = (metrics.queries or 0) + count
+
+
+def publish(metrics):
+    """
+    Description: one structured log line per run, and process independent counters in Redis.
+    Metrics must never break the pipeline, so an unreachable Redis is ignored.
+    """
+    data = metrics.as_dict()
+    logger.info("ai pipeline %s", json.dumps(data, default=str))
+
+    counters = {
+        'runs': 1,
+        'openai_calls': len(data['openai_calls']),
+        'prompt_tokens': data['prompt_tokens'],
+        'completion_tokens': data['completion_tokens'],
+    }
+    if data['cache']:
+        counters[f"cache_{data['cache']}"] = 1
+
+    try:
+        pipeline = get_redis().pipeline(transaction=False)
+        for name, amount in counters.items():
+            pipeline.hincrby(COUNTERS_KEY, name, amount)
+        pipeline.execute()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def record_counter(name, amount=1):
+    """
+    Description: bump one of the Redis counters outside of a pipeline run (e.g. rejected requests).
+    """
+    try:
+        get_redis().hincrby(COUNTERS_KEY, name, amount)
+    except redis.exceptions.RedisError:
+        pass
+
+
+def read_counters():
+    """
+    Description: the Redis counters as a dict of ints (empty if Redis is unreachable).
+    """
+    try:
+        counters = get_redis().hgetall(COUNTERS_KEY)
+    except redis.exceptions.RedisError:
+        return {}
+    return {name.decode(): int(value) for name, value in counters.items()}
+
+
+def percentile(values, fraction):
+    """
+    Description: linear interpolated percentile of a list of numbers (fraction between 0 and 1).
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
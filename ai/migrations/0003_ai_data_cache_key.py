@@ -0,0 +1,71 @@
+from django.db import migrations, models
+import django.utils.timezone
+import hashlib
+import re
+import unicodedata
+
+
+def normalize_goal(goal):
+    # Frozen copy of ai.cache.normalize_goal, migrations must not import app code
+    goal = unicodedata.normalize('NFKD', str(goal))
+    goal = ''.join(char for char in goal if not unicodedata.combining(char))
+    goal = re.sub(r'[^\w\s]', ' ', goal.lower())
+    return ' '.join(goal.split())
+
+
+def cache_key_goal(goal):
+    # Frozen copy of the goal part of ai.cache.plan_cache_key: long goals are hashed to fit the column
+    if len(goal) > 180:
+        goal = hashlib.sha1(goal.encode()).hexdigest()
+    return goal
+
+
+def fill_cache_keys(apps, schema_editor):
+    AI_data = apps.get_model('ai', 'AI_data')
+
+    seen = set()
+    for entry in AI_data.objects.order_by('-id'):
+        goal = normalize_goal(entry.goal)
+        # Existing rows carry no profile, so they land in the "unknown profile" bucket
+        cache_key = f"v1:{cache_key_goal(goal)}:-:-:-"
+
+        # Failed generations were stored as null, and duplicated goals broke get(); keep the newest row only
+        if entry.json_data is None or cache_key in seen:
+            entry.delete()
+            continue
+
+        seen.add(cache_key)
+        entry.goal = goal
+        entry.cache_key = cache_key
+        entry.save(update_fields=['goal', 'cache_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai', '0002_aigenerationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ai_data',
+            name='cache_key',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='ai_data',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='ai_data',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(fill_cache_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='ai_data',
+            name='cache_key',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 4.2.15 on 2026-10-18 10:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exercises', '0005_alter_exerciselog_reps_alter_exerciselog_weight'),
+        ('habits', '0005_insert_default_data'),
+        ('diets', '0001_initial'),
+        ('ai', '0003_ai_data_cache_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlanTemplate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('habit_count', models.PositiveIntegerField(default=0)),
+                ('exercise_count', models.PositiveIntegerField(default=0)),
+                ('food_count', models.PositiveIntegerField(default=0)),
+                ('compiled_at', models.DateTimeField(auto_now_add=True)),
+                ('entry', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='template', to='ai.ai_data')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TemplateRoutineExercise',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('day_of_week', models.CharField(blank=True, max_length=10, null=True)),
+                ('weight_goal', models.IntegerField(blank=True, null=True)),
+                ('reps_goal', models.IntegerField(blank=True, null=True)),
+                ('duration', models.IntegerField(blank=True, null=True)),
+                ('distance', models.FloatField(blank=True, null=True)),
+                ('pace', models.FloatField(blank=True, null=True)),
+                ('average_velocity', models.FloatField(blank=True, null=True)),
+                ('exercise', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='exercises.exercise')),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='routine_exercises', to='ai.plantemplate')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TemplateMealFood',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('meal_name', models.CharField(max_length=100)),
+                ('servings', models.FloatField()),
+                ('food', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='diets.food')),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='meal_foods', to='ai.plantemplate')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TemplateHabit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('name', models.CharField(max_length=100)),
+                ('goal', models.FloatField()),
+                ('measure', models.CharField(max_length=48, null=True)),
+                ('frequency', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='habits.frequency')),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='habits', to='ai.plantemplate')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-18 11:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai', '0004_plan_templates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aigenerationjob',
+            name='metrics',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.15 on 2026-10-18 11:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai', '0005_aigenerationjob_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aigenerationjob',
+            name='draft',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='aigenerationjob',
+            name='source',
+            field=models.CharField(blank=True, choices=[('ai', 'AI'), ('local', 'Local planner')], default='', max_length=5),
+        ),
+    ]
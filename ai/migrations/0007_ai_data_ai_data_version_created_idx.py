@@ -0,0 +1,17 @@
+# Generated by Django 4.2.15 on 2026-10-18 11:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai', '0006_aigenerationjob_source_draft'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ai_data',
+            index=models.Index(fields=['version', 'created_at'], name='ai_data_version_created_idx'),
+        ),
+    ]
@@ -1,6 +1,104 @@
 from django.db import models
+from django.utils import timezone
+from authentication.models import User
+from diets.models import Food
+from exercises.models import Exercise
+from habits.models import Frequency
 
 # Create your models here.
 class AI_data(models.Model):
+    goal = models.CharField(max_length=255)  # normalized goal
+    cache_key = models.CharField(max_length=255, unique=True)  # version + normalized goal + profile buckets
+    version = models.PositiveIntegerField(default=1)
+    json_data = models.JSONField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # the fresh plans of the current version (similarity index, purge); lookups go by cache_key
+            models.Index(fields=['version', 'created_at'], name='ai_data_version_created_idx'),
+        ]
+
+    def __str__(self):
+        return self.cache_key
+
+
+class AIGenerationJob(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    SOURCE_AI = 'ai'
+    SOURCE_LOCAL = 'local'
+
+    SOURCE_CHOICES = [
+        (SOURCE_AI, 'AI'),
+        (SOURCE_LOCAL, 'Local planner'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ai_jobs')
     goal = models.CharField(max_length=255)
-    json_data = models.JSONField()
\ No newline at end of file
+    payload = models.JSONField(default=dict)  # request data sent to the generator
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    error = models.TextField(blank=True, default='')
+    metrics = models.JSONField(default=dict, blank=True)  # stage timings, tokens and cache outcome (see ai/metrics.py)
+    source = models.CharField(max_length=5, choices=SOURCE_CHOICES, blank=True, default='')  # who made the saved plan
+    draft = models.JSONField(default=dict, blank=True)  # ids of the local draft rows, replaced by the AI plan
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"AI job {self.id} for {self.user.email}: {self.status}"
+
+
+class PlanTemplate(models.Model):
+    """
+    Description: a cached plan compiled once into normalized rows (resolved catalog ids, English day names),
+    so applying it to a user is a few INSERT ... SELECT statements instead of walking the JSON again.
+    """
+    entry = models.OneToOneField(AI_data, on_delete=models.CASCADE, related_name='template')
+    habit_count = models.PositiveIntegerField(default=0)
+    exercise_count = models.PositiveIntegerField(default=0)
+    food_count = models.PositiveIntegerField(default=0)
+    compiled_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Template of {self.entry.cache_key}"
+
+
+class TemplateHabit(models.Model):
+    template = models.ForeignKey(PlanTemplate, on_delete=models.CASCADE, related_name='habits')
+    position = models.PositiveIntegerField()
+    name = models.CharField(max_length=100)
+    goal = models.FloatField()
+    measure = models.CharField(max_length=48, null=True)
+    frequency = models.ForeignKey(Frequency, on_delete=models.CASCADE)
+
+
+class TemplateRoutineExercise(models.Model):
+    template = models.ForeignKey(PlanTemplate, on_delete=models.CASCADE, related_name='routine_exercises')
+    position = models.PositiveIntegerField()
+    exercise = models.ForeignKey(Exercise, on_delete=models.CASCADE)
+    day_of_week = models.CharField(max_length=10, null=True, blank=True)
+    weight_goal = models.IntegerField(blank=True, null=True)
+    reps_goal = models.IntegerField(blank=True, null=True)
+    duration = models.IntegerField(blank=True, null=True)
+    distance = models.FloatField(blank=True, null=True)
+    pace = models.FloatField(blank=True, null=True)
+    average_velocity = models.FloatField(blank=True, null=True)
+
+
+class TemplateMealFood(models.Model):
+    template = models.ForeignKey(PlanTemplate, on_delete=models.CASCADE, related_name='meal_foods')
+    position = models.PositiveIntegerField()
+    meal_name = models.CharField(max_length=100)
+    food = models.ForeignKey(Food, on_delete=models.CASCADE)
+    servings = models.FloatField()
@@ -0,0 +1,175 @@
+import os
+import random
+import threading
+import time
+import httpx
+from django.conf import settings
+from openai import OpenAI, APIConnectionError, APIError, APIStatusError
+
+
+class OpenAIUnavailable(Exception):
+    """
+    Description: OpenAI could not answer: retries were exhausted, the request timed out or the circuit is open.
+    """
+
+
+class CircuitOpenError(OpenAIUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Description: stops calling OpenAI for a while after too many consecutive failed calls.
+
+    closed -> open after `OPENAI_CIRCUIT_FAILURE_THRESHOLD` failures in a row; every call fails fast while open.
+    After `OPENAI_CIRCUIT_RESET_TIMEOUT` seconds a single trial call is let through (half open):
+    its success closes the circuit again, its failure opens it for another period.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= settings.OPENAI_CIRCUIT_RESET_TIMEOUT:
+                self.state = self.HALF_OPEN
+                return True
+            # open, or half open with the trial call still running
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= settings.OPENAI_CIRCUIT_FAILURE_THRESHOLD:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker()
+
+_client = None
+_client_config = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Description: the process wide OpenAI client. Its connection pool keeps connections alive between calls,
+    so only the first request pays for the TCP and TLS handshakes.
+    """
+    global _client, _client_config
+
+    config = (os.getenv('OPENAI_API_KEY'), os.getenv('OPENAI_BASE_URL') or settings.OPENAI_BASE_URL)
+    with _client_lock:
+        if _client is None or _client_config != config:
+            timeout = httpx.Timeout(settings.OPENAI_READ_TIMEOUT, connect=settings.OPENAI_CONNECT_TIMEOUT)
+            _client = OpenAI(
+                api_key=config[0],
+                base_url=config[1],
+                timeout=timeout,
+                max_retries=0,  # retries are handled by chat_completion
+                http_client=httpx.Client(
+                    timeout=timeout,
+                    limits=httpx.Limits(
+                        max_connections=settings.OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=settings.OPENAI_MAX_CONNECTIONS,
+                        keepalive_expiry=60,
+                    ),
+                ),
+            )
+            _client_config = config
+        return _client
+
+
+def _is_retryable(exc):
+    if isinstance(exc, APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    # connection errors and timeouts
+    return isinstance(exc, APIConnectionError)
+
+
+def _backoff(attempt, exc):
+    # full jitter exponential backoff, but never sooner than a Retry-After sent with a 429
+    delay = random.uniform(0, min(settings.OPENAI_BACKOFF_MAX, settings.OPENAI_BACKOFF_BASE * 2 ** attempt))
+    if isinstance(exc, APIStatusError):
+        try:
+            delay = max(delay, min(float(exc.response.headers.get('retry-after', 0)), settings.OPENAI_BACKOFF_MAX))
+        except ValueError:
+            pass
+    return delay
+
+
+def chat_completion(messages, model="gpt-4", **kwargs):
+    """
+    Description: chat.completions.create on the pooled client, retried on 429, 5xx, timeouts and
+    connection errors, behind the circuit breaker.
+
+    Raises OpenAIUnavailable when OpenAI can't answer; other API errors (e.g. 400) are raised unchanged.
+    """
+    if not breaker.allow():
+        raise CircuitOpenError("OpenAI circuit is open, failing fast")
+
+    attempt = 0
+    while True:
+        try:
+            result = get_client().chat.completions.create(model=model, messages=messages, **kwargs)
+        except Exception as exc:
+            if not _is_retryable(exc):
+                # our request was wrong, not the upstream
+                breaker.record_success()
+                raise
+            if attempt >= settings.OPENAI_MAX_RETRIES:
+                breaker.record_failure()
+                raise OpenAIUnavailable(f"OpenAI request failed after {attempt + 1} attempts: {exc}") from exc
+
+            time.sleep(_backoff(attempt, exc))
+            attempt += 1
+            continue
+
+        breaker.record_success()
+        return result
+
+
+def complete_text(messages, model="gpt-4", **kwargs):
+    """
+    Description: chat_completion streamed and joined back into text, so the time to the first token can be
+    measured. Returns (text, usage, ttft) with ttft in seconds; usage is None if the server doesn't send it.
+    """
+    start = time.perf_counter()
+    stream = chat_completion(messages, model=model, stream=True, stream_options={'include_usage': True}, **kwargs)
+
+    parts = []
+    usage = None
+    ttft = None
+    try:
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(chunk.choices[0].delta.content)
+    except (httpx.HTTPError, APIError) as exc:
+        # the request was accepted but the answer was cut, e.g. by a read timeout
+        breaker.record_failure()
+        raise OpenAIUnavailable(f"OpenAI stream was interrupted: {exc}") from exc
+
+    return ''.join(parts), usage, ttft
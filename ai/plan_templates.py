@@ -0,0 +1,250 @@
+from datetime import date
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from habits.models import Habit
+from exercises.models import Routine, RoutineExercise
+from diets.models import Meal, MealFood
+from .models import PlanTemplate, TemplateHabit, TemplateMealFood, TemplateRoutineExercise
+from .schema import DAY_MAPPING
+from .utils import QueryCounter, create_models_data, resolve_exercises, resolve_foods, resolve_frequencies
+
+
+def _table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def compile_template(entry):
+    """
+    Description: translate the plan of an AI_data row into template rows, once. Catalog entries
+    (frequencies, exercises, foods) are resolved or created here, and day names are translated here.
+    Concurrent compilations of the same row keep the first template.
+    """
+    plan = entry.json_data
+    habits = plan.get('habits', [])
+    routine = [
+        (DAY_MAPPING.get(exercise_data['day'], exercise_data['day']), routine_data)
+        for exercise_data in plan.get('exercises', [])
+        for routine_data in exercise_data['routine']
+    ]
+    foods = [(diet_data['meal'], food_item) for diet_data in plan.get('diet', []) for food_item in diet_data.get('foods', [])]
+
+    try:
+        with transaction.atomic():
+            template = PlanTemplate.objects.create(
+                entry=entry, habit_count=len(habits), exercise_count=len(routine), food_count=len(foods)
+            )
+
+            frequencies = resolve_frequencies({habit_data.get('frequency', 'daily') for habit_data in habits})
+            TemplateHabit.objects.bulk_create([
+                TemplateHabit(
+                    template=template,
+                    position=position,
+                    name=habit_data['name'],
+                    goal=habit_data['goal'],
+                    measure=habit_data.get('measure', 'steps'),
+                    frequency=frequencies[habit_data.get('frequency', 'daily')]
+                )
+                for position, habit_data in enumerate(habits)
+            ])
+
+            catalog = resolve_exercises([
+                (routine_data['exercise'], routine_data.get('exercise_type', 'gym')) for _, routine_data in routine
+            ])
+            TemplateRoutineExercise.objects.bulk_create([
+                TemplateRoutineExercise(
+                    template=template,
+                    position=position,
+                    exercise=catalog[(routine_data['exercise'], routine_data.get('exercise_type', 'gym'))],
+                    day_of_week=day_of_week,
+                    weight_goal=routine_data.get('weight'),
+                    reps_goal=routine_data.get('reps'),
+                    duration=routine_data.get('duration'),
+                    distance=routine_data.get('distance'),
+                    pace=routine_data.get('pace'),
+                    average_velocity=routine_data.get('average_velocity')
+                )
+                for position, (day_of_week, routine_data) in enumerate(routine)
+            ])
+
+            catalog = resolve_foods([food_item for _, food_item in foods])
+            TemplateMealFood.objects.bulk_create([
+                TemplateMealFood(
+                    template=template,
+                    position=position,
+                    meal_name=meal_name,
+                    food=catalog[food_item['name']],
+                    servings=food_item.get('servings', 1)
+                )
+                for position, (meal_name, food_item) in enumerate(foods)
+            ])
+    except IntegrityError:
+        # another worker compiled it first
+        return PlanTemplate.objects.get(entry=entry)
+
+    return template
+
+
+def get_template(entry):
+    """
+    Description: the compiled template of an AI_data row, compiling it on first use.
+    """
+    template = PlanTemplate.objects.filter(entry=entry).first()
+    if template is None:
+        template = compile_template(entry)
+    return template
+
+
+def _by_user(rows, user_ids):
+    # (id, user_id) rows -> {user_id: sorted ids}
+    created = {user_id: [] for user_id in user_ids}
+    for row_id, user_id in rows:
+        created[user_id].append(row_id)
+    return {user_id: sorted(ids) for user_id, ids in created.items()}
+
+
+def _apply_habits(cursor, template, user_ids):
+    # ids are drawn up front so the habits and their frequency links are written by the same statement
+    cursor.execute(f"""
+        WITH source AS (
+            SELECT nextval(pg_get_serial_sequence(%s, 'id')) AS habit_id, u.user_id, t.name, t.goal, t.measure, t.frequency_id
+            FROM {_table(TemplateHabit)} t
+            CROSS JOIN unnest(%s::integer[]) WITH ORDINALITY AS u(user_id, ordinality)
+            WHERE t.template_id = %s
+            ORDER BY u.ordinality, t.position
+        ), habits AS (
+            INSERT INTO {_table(Habit)} (id, user_id, name, goal, measure, from_plan, created_at)
+            SELECT habit_id, user_id, name, goal, measure, TRUE, %s FROM source
+        ), links AS (
+            INSERT INTO {_table(Habit.frequencies.through)} (habit_id, frequency_id)
+            SELECT habit_id, frequency_id FROM source
+        )
+        SELECT habit_id, user_id FROM source
+    """, [Habit._meta.db_table, user_ids, template.id, timezone.now()])
+    return _by_user(cursor.fetchall(), user_ids)
+
+
+def _apply_routine_exercises(cursor, template, user_ids):
+    today = date.today()
+    # Reuse today's routine of each user, create the missing ones
+    cursor.execute(f"""
+        INSERT INTO {_table(Routine)} (user_id, week_start_date)
+        SELECT u.user_id, %s
+        FROM unnest(%s::integer[]) AS u(user_id)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {_table(Routine)} r WHERE r.user_id = u.user_id AND r.week_start_date = %s
+        )
+    """, [today, user_ids, today])
+    cursor.execute(f"""
+        WITH routines AS (
+            SELECT r.user_id, min(r.id) AS routine_id, min(u.ordinality) AS ordinality
+            FROM {_table(Routine)} r
+            JOIN unnest(%s::integer[]) WITH ORDINALITY AS u(user_id, ordinality) ON u.user_id = r.user_id
+            WHERE r.week_start_date = %s
+            GROUP BY r.user_id
+        ), created AS (
+            INSERT INTO {_table(RoutineExercise)}
+                (routine_id, exercise_id, day_of_week, weight_goal, reps_goal, duration, distance, pace, average_velocity, from_plan)
+            SELECT routines.routine_id, t.exercise_id, t.day_of_week, t.weight_goal, t.reps_goal, t.duration, t.distance, t.pace, t.average_velocity, TRUE
+            FROM {_table(TemplateRoutineExercise)} t
+            CROSS JOIN routines
+            WHERE t.template_id = %s
+            ORDER BY routines.ordinality, t.position
+            RETURNING id, routine_id
+        )
+        SELECT created.id, routines.user_id FROM created JOIN routines USING (routine_id)
+    """, [user_ids, today, template.id])
+    return _by_user(cursor.fetchall(), user_ids)
+
+
+def _apply_meal_foods(cursor, template, user_ids):
+    today = date.today()
+    # Reuse today's meals with the same name, create the rest
+    cursor.execute(f"""
+        INSERT INTO {_table(Meal)} (name, user_id, date)
+        SELECT t.meal_name, u.user_id, %s
+        FROM {_table(TemplateMealFood)} t
+        CROSS JOIN unnest(%s::integer[]) WITH ORDINALITY AS u(user_id, ordinality)
+        WHERE t.template_id = %s AND NOT EXISTS (
+            SELECT 1 FROM {_table(Meal)} m WHERE m.user_id = u.user_id AND m.date = %s AND m.name = t.meal_name
+        )
+        GROUP BY u.user_id, t.meal_name
+        ORDER BY min(u.ordinality), min(t.position)
+    """, [today, user_ids, template.id, today])
+    cursor.execute(f"""
+        WITH meals AS (
+            SELECT m.user_id, m.name, min(m.id) AS meal_id
+            FROM {_table(Meal)} m
+            WHERE m.user_id = ANY(%s::integer[]) AND m.date = %s
+            GROUP BY m.user_id, m.name
+        ), created AS (
+            INSERT INTO {_table(MealFood)} (meal_id, food_id, servings, from_plan)
+            SELECT meals.meal_id, t.food_id, t.servings, TRUE
+            FROM {_table(TemplateMealFood)} t
+            CROSS JOIN unnest(%s::integer[]) WITH ORDINALITY AS u(user_id, ordinality)
+            JOIN meals ON meals.user_id = u.user_id AND meals.name = t.meal_name
+            WHERE t.template_id = %s
+            ORDER BY u.ordinality, t.position
+            RETURNING id, meal_id
+        )
+        SELECT created.id, meals.user_id FROM created JOIN meals USING (meal_id)
+    """, [user_ids, today, user_ids, template.id])
+    return _by_user(cursor.fetchall(), user_ids)
+
+
+def apply_template_to_users(template, users):
+    """
+    Description: save a compiled plan for many users at once with set-based INSERT ... SELECT statements
+    over the template rows and the list of users. The number of queries depends neither on the size
+    of the plan nor on the number of users.
+
+    Returns {user id: the same structure as create_models_data, without the query count} and the
+    number of queries run.
+    """
+    user_ids = list(dict.fromkeys(user.id for user in users))
+    counter = QueryCounter()
+    empty = {user_id: [] for user_id in user_ids}
+
+    with connection.execute_wrapper(counter), transaction.atomic(), connection.cursor() as cursor:
+        habits = _apply_habits(cursor, template, user_ids) if template.habit_count else empty
+        routine_exercises = _apply_routine_exercises(cursor, template, user_ids) if template.exercise_count else empty
+        meal_foods = _apply_meal_foods(cursor, template, user_ids) if template.food_count else empty
+
+    created = {
+        user_id: {'habits': habits[user_id], 'routine_exercises': routine_exercises[user_id], 'meal_foods': meal_foods[user_id]}
+        for user_id in user_ids
+    }
+    return created, counter.count
+
+
+def apply_template(template, user):
+    """
+    Description: save a compiled plan for the user with set-based INSERT ... SELECT statements.
+    The number of queries does not depend on the size of the plan.
+
+    Returns the same structure as create_models_data.
+    """
+    created, queries = apply_template_to_users(template, [user])
+    return {**created[user.id], 'queries': queries}
+
+
+def apply_plan(entry, user):
+    """
+    Description: save the plan of an AI_data row for the user through its compiled template.
+    The statements are PostgreSQL specific; other backends save the JSON with create_models_data.
+    """
+    if connection.vendor != 'postgresql':
+        return create_models_data(entry.json_data, user)
+
+    return apply_template(get_template(entry), user)
+
+
+def apply_plan_to_users(entry, users):
+    """
+    Description: apply_plan for many users at once, see apply_template_to_users.
+    """
+    if connection.vendor != 'postgresql':
+        created = {user.id: create_models_data(entry.json_data, user) for user in users}
+        return created, sum(result.pop('queries') for result in created.values())
+
+    return apply_template_to_users(get_template(entry), users)
+
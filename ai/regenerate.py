@@ -0,0 +1,246 @@
+"""
+Regeneration of a single section of a user's plan. Only that section is generated, then it is compared
+with the user's current rows and just the differences are written: new items are inserted, items whose
+values changed are updated and items the new section no longer has are deleted (rows the user
+created themselves are never deleted).
+"""
+from datetime import date
+from django.conf import settings
+from django.db import connection, transaction
+from diets.models import Meal, MealFood
+from exercises.models import Routine, RoutineExercise
+from habits.models import Habit
+from .cache import describe_profile, profile_buckets
+from .compact import compact_section
+from .metrics import record_queries, stage
+from .schema import DAY_MAPPING, validate_section
+from .sections import generate_section
+from .utils import QueryCounter, _create_habits, _create_meal_foods, _create_routine_exercises, resolve_frequencies
+
+ENGLISH_DAYS = {english: portuguese for portuguese, english in DAY_MAPPING.items()}
+
+# plan key -> RoutineExercise field
+EXERCISE_FIELDS = (
+    ('weight', 'weight_goal'), ('reps', 'reps_goal'), ('duration', 'duration'),
+    ('distance', 'distance'), ('pace', 'pace'), ('average_velocity', 'average_velocity'),
+)
+
+
+class SectionDiff:
+    """
+    Description: what has to change for the user's rows to match a regenerated section.
+    `inserts` are section items, `updates` are (row, new values) pairs and `deletes` are rows.
+    """
+
+    def __init__(self):
+        self.inserts = []
+        self.updates = []
+        self.deletes = []
+        self.unchanged = 0
+
+
+def diff_section(existing, wanted):
+    """
+    Description: match the current rows and the new items by key, in order. `existing` is a list of
+    (key, row, values) and `wanted` a list of (key, item, values); rows left without a match are deleted.
+    """
+    pool = {}
+    for key, row, values in existing:
+        pool.setdefault(key, []).append((row, values))
+
+    diff = SectionDiff()
+    for key, item, values in wanted:
+        matches = pool.get(key)
+        if not matches:
+            diff.inserts.append(item)
+            continue
+        row, current = matches.pop(0)
+        if current == values:
+            diff.unchanged += 1
+        else:
+            diff.updates.append((row, values))
+
+    # duplicates of a matched row are left over too, so they are cleaned up as well
+    diff.deletes = [row for matches in pool.values() for row, _ in matches]
+    return diff
+
+
+def _key(name):
+    return ' '.join(str(name).lower().split())
+
+
+def _deleted(result, model):
+    # delete() counts the cascaded rows too, only the section's own rows matter here
+    return result[1].get(model._meta.label, 0)
+
+
+def _summary(diff, deleted):
+    return {'inserted': len(diff.inserts), 'updated': len(diff.updates), 'deleted': deleted, 'unchanged': diff.unchanged}
+
+
+# Habits: keyed by name
+
+def _habit_frequency(habit):
+    return next((frequency.name for frequency in habit.frequencies.all()), 'daily')
+
+
+def _current_habits(user):
+    rows = []
+    items = []
+    for habit in Habit.objects.filter(user=user).prefetch_related('frequencies').order_by('id'):
+        values = {'goal': habit.goal, 'measure': habit.measure, 'frequency': _habit_frequency(habit)}
+        rows.append((_key(habit.name), habit, values))
+        items.append({'name': habit.name, **values})
+    return rows, items
+
+
+def _apply_habits(user, items, existing):
+    wanted = [
+        (_key(item['name']), item, {'goal': item['goal'], 'measure': item.get('measure', 'steps'), 'frequency': item.get('frequency', 'daily')})
+        for item in items
+    ]
+    diff = diff_section(existing, wanted)
+
+    _create_habits(diff.inserts, user)
+
+    if diff.updates:
+        # the frequency is a many to many: only the links of the habits whose frequency changed are replaced
+        changed = [(habit, values['frequency']) for habit, values in diff.updates if values['frequency'] != _habit_frequency(habit)]
+        for habit, values in diff.updates:
+            habit.goal = values['goal']
+            habit.measure = values['measure']
+        Habit.objects.bulk_update([habit for habit, _ in diff.updates], ['goal', 'measure'])
+
+        if changed:
+            frequencies = resolve_frequencies({name for _, name in changed})
+            HabitFrequency = Habit.frequencies.through
+            HabitFrequency.objects.filter(habit_id__in=[habit.id for habit, _ in changed]).delete()
+            HabitFrequency.objects.bulk_create([
+                HabitFrequency(habit_id=habit.id, frequency_id=frequencies[name].id) for habit, name in changed
+            ])
+
+    # habits the user created or already logged are kept, only unused plan habits go away
+    deleted = Habit.objects.filter(id__in=[habit.id for habit in diff.deletes], from_plan=True, habitlog__isnull=True).delete()
+    return _summary(diff, _deleted(deleted, Habit))
+
+
+# Exercises: keyed by exercise, type and day, in the user's latest routine
+
+def _current_routine(user):
+    return Routine.objects.filter(user=user).order_by('-week_start_date', '-id').first()
+
+
+def _current_exercises(user):
+    rows = []
+    days = {}
+    routine_exercises = RoutineExercise.objects.filter(routine=_current_routine(user)).select_related('exercise').order_by('id')
+    for routine_exercise in routine_exercises:
+        exercise = routine_exercise.exercise
+        values = {name: getattr(routine_exercise, field) for name, field in EXERCISE_FIELDS}
+        rows.append(((_key(exercise.name), exercise.exercise_type, routine_exercise.day_of_week), routine_exercise, values))
+
+        day = ENGLISH_DAYS.get(routine_exercise.day_of_week, routine_exercise.day_of_week)
+        days.setdefault(day, []).append({'exercise': exercise.name, 'exercise_type': exercise.exercise_type, **values})
+    return rows, [{'day': day, 'routine': routine} for day, routine in days.items()]
+
+
+def _apply_exercises(user, items, existing):
+    wanted = []
+    for day_data in items:
+        english_day = DAY_MAPPING.get(day_data['day'], day_data['day'])
+        for routine_data in day_data['routine']:
+            key = (_key(routine_data['exercise']), routine_data.get('exercise_type', 'gym'), english_day)
+            wanted.append((key, (day_data['day'], routine_data), {name: routine_data.get(name) for name, _ in EXERCISE_FIELDS}))
+    diff = diff_section(existing, wanted)
+
+    # new exercises go to the routine being compared (a new one for today if the user has none)
+    routine = existing[0][1].routine if existing else None
+    week_start_date = routine.week_start_date if routine else date.today()
+    _create_routine_exercises([
+        {'day': day, 'week_start_date': week_start_date, 'routine': [routine_data]} for day, routine_data in diff.inserts
+    ], user)
+
+    if diff.updates:
+        for routine_exercise, values in diff.updates:
+            for name, field in EXERCISE_FIELDS:
+                setattr(routine_exercise, field, values[name])
+        RoutineExercise.objects.bulk_update([row for row, _ in diff.updates], [field for _, field in EXERCISE_FIELDS])
+
+    # exercises the user created or already logged are kept
+    deleted = RoutineExercise.objects.filter(id__in=[row.id for row in diff.deletes], from_plan=True, exerciselog__isnull=True).delete()
+    return _summary(diff, _deleted(deleted, RoutineExercise))
+
+
+# Diet: keyed by meal and food, in today's meals
+
+def _current_diet(user):
+    rows = []
+    meals = {}
+    meal_foods = MealFood.objects.filter(meal__user=user, meal__date=date.today()).select_related('meal', 'food').order_by('meal_id', 'id')
+    for meal_food in meal_foods:
+        rows.append(((_key(meal_food.meal.name), _key(meal_food.food.name)), meal_food, {'servings': meal_food.servings}))
+        meals.setdefault(meal_food.meal.name, []).append({'name': meal_food.food.name, 'servings': meal_food.servings})
+    return rows, [{'meal': meal, 'foods': foods} for meal, foods in meals.items()]
+
+
+def _apply_diet(user, items, existing):
+    wanted = [
+        ((_key(diet_data['meal']), _key(food_item['name'])), (diet_data['meal'], food_item), {'servings': food_item.get('servings', 1)})
+        for diet_data in items
+        for food_item in diet_data['foods']
+    ]
+    diff = diff_section(existing, wanted)
+
+    # new foods of an existing meal go to that meal, even if GPT spelled its name differently
+    meal_names = {_key(row.meal.name): row.meal.name for _, row, _ in existing}
+    inserts = {}
+    for meal, food_item in diff.inserts:
+        inserts.setdefault(meal_names.get(_key(meal), meal), []).append(food_item)
+    _create_meal_foods([{'meal': meal, 'foods': foods} for meal, foods in inserts.items()], user)
+
+    if diff.updates:
+        for meal_food, values in diff.updates:
+            meal_food.servings = values['servings']
+        MealFood.objects.bulk_update([row for row, _ in diff.updates], ['servings'])
+
+    # foods the user added to their meals are kept
+    deleted = MealFood.objects.filter(id__in=[row.id for row in diff.deletes], from_plan=True).delete()
+    Meal.objects.filter(id__in={row.meal_id for row in diff.deletes}, mealfood__isnull=True).delete()
+    return _summary(diff, _deleted(deleted, MealFood))
+
+
+SECTIONS = {
+    'habits': (_current_habits, _apply_habits),
+    'exercises': (_current_exercises, _apply_exercises),
+    'diet': (_current_diet, _apply_diet),
+}
+
+
+def regenerate_section(user, section, goal, instructions=None):
+    """
+    Description: generate one section of the user's plan and apply it as a diff of their current rows.
+    With instructions ("troque o jantar"), the current section is sent along so GPT edits it instead of
+    starting over, and only what it changes is written.
+
+    Returns the new section and how many rows were inserted, updated, deleted or left unchanged.
+    """
+    current_rows, apply_section = SECTIONS[section]
+
+    data = {'goal': goal, 'profile': describe_profile(profile_buckets(user))}
+    if instructions:
+        _, current = current_rows(user)
+        data['instructions'] = instructions
+        data['current'] = compact_section(section, current) if settings.AI_PLAN_FORMAT == 'compact' else current
+
+    with stage('generation'):
+        items = generate_section(section, data)
+    with stage('validate'):
+        items = validate_section(section, items)
+
+    counter = QueryCounter()
+    with stage('persist'), connection.execute_wrapper(counter), transaction.atomic():
+        existing, _ = current_rows(user)
+        changes = apply_section(user, items, existing)
+    record_queries(counter.count)
+
+    return {'section': section, 'data': items, **changes}
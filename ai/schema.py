@@ -0,0 +1,270 @@
+"""
+Schema of the plans returned by GPT. The schema is compiled once into nested validator functions that
+check, coerce and repair a plan in a single pass, before anything is written to the database.
+"""
+import math
+import re
+from functools import lru_cache
+from habits.models import Frequency
+from .cache import normalize_goal
+from .sections import PLAN_SECTIONS
+
+# Mapping for Portuguese to English day names
+DAY_MAPPING = {
+    "Segunda-feira": "monday",
+    "Terça-feira": "tuesday",
+    "Quarta-feira": "wednesday",
+    "Quinta-feira": "thursday",
+    "Sexta-feira": "friday",
+    "Sábado": "saturday",
+    "Domingo": "sunday"
+}
+
+# "segunda feira", "segunda", "seg", "SEGUNDA-FEIRA", "monday", ... -> "Segunda-feira"
+DAY_ALIASES = {}
+for _day, _english in DAY_MAPPING.items():
+    _normalized = normalize_goal(_day)
+    DAY_ALIASES[_normalized] = _day
+    DAY_ALIASES[_normalized.replace(' feira', '')] = _day
+    DAY_ALIASES[_normalized[:3]] = _day
+    DAY_ALIASES[_english] = _day
+
+# leading number of strings like "12", "2,5", "8 horas" or "10-12"
+NUMBER_RE = re.compile(r'\s*([-+]?\d+(?:[.,]\d+)?)')
+
+
+class PlanValidationError(ValueError):
+    """
+    Description: the plan does not match the schema; `errors` lists every problem as "path: message".
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        shown = '; '.join(errors[:5])
+        if len(errors) > 5:
+            shown += f" (and {len(errors) - 5} more)"
+        super().__init__(f"GPT returned an invalid plan: {shown}")
+
+
+class Invalid(Exception):
+    pass
+
+
+def _to_number(value):
+    if isinstance(value, bool):
+        raise Invalid("expected a number")
+    if isinstance(value, (int, float)):
+        number = value
+    elif isinstance(value, str):
+        match = NUMBER_RE.match(value)
+        if match is None:
+            raise Invalid(f"expected a number, got {value!r}")
+        number = float(match.group(1).replace(',', '.'))
+    else:
+        raise Invalid(f"expected a number, got {type(value).__name__}")
+    if not math.isfinite(number):
+        raise Invalid("expected a finite number")
+    return number
+
+
+def integer(minimum=0):
+    def coerce(value):
+        # fast path for well formed answers
+        if type(value) is int and value >= minimum:
+            return value
+        number = _to_number(value)
+        if number < minimum:
+            raise Invalid(f"must be at least {minimum}")
+        return int(round(number))
+    return coerce
+
+
+def number(minimum=0):
+    def coerce(value):
+        if type(value) in (int, float) and minimum <= value < math.inf:
+            return value
+        number = _to_number(value)
+        if number < minimum:
+            raise Invalid(f"must be at least {minimum}")
+        return float(number)
+    return coerce
+
+
+def text(max_length=None):
+    limit = max_length or math.inf
+
+    def coerce(value):
+        if type(value) is str and 0 < len(value) <= limit and not value[0].isspace() and not value[-1].isspace():
+            return value
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise Invalid(f"expected a string, got {type(value).__name__}")
+        value = str(value).strip()
+        if not value:
+            raise Invalid("must not be empty")
+        return value[:max_length] if max_length else value
+    return coerce
+
+
+def choice(*options):
+    def coerce(value):
+        normalized = str(value).strip().lower()
+        if normalized not in options:
+            raise Invalid(f"must be one of {', '.join(options)}, got {value!r}")
+        return normalized
+    return coerce
+
+
+def day(value):
+    canonical = DAY_ALIASES.get(normalize_goal(value)) if isinstance(value, str) else None
+    if canonical is None:
+        raise Invalid(f"unknown day {value!r}")
+    return canonical
+
+
+def required(node):
+    return (node, True)
+
+
+def optional(node):
+    return (node, False)
+
+
+PLAN_SCHEMA = {
+    'habits': [{
+        'name': required(text(100)),
+        'goal': required(number()),
+        'measure': optional(text(48)),
+        'frequency': optional(choice(*(name for name, _ in Frequency.FREQUENCY_CHOICES))),
+    }],
+    'exercises': [{
+        'day': required(day),
+        'routine': required([{
+            'exercise': required(text(100)),
+            'exercise_type': optional(choice('gym', 'cardio')),
+            'title': optional(text()),
+            'sets': optional(integer()),
+            'weight': optional(integer()),
+            'reps': optional(integer()),
+            'duration': optional(integer()),
+            'distance': optional(number()),
+            'pace': optional(number()),
+            'average_velocity': optional(number()),
+        }]),
+    }],
+    'diet': [{
+        'meal': required(text(100)),
+        'foods': required([{
+            'name': required(text(100)),
+            'servings': optional(number()),
+            'calories': optional(integer()),
+            'protein': optional(number()),
+            'carbs': optional(number()),
+            'fat': optional(number()),
+        }]),
+    }],
+}
+
+
+def _format_path(path):
+    # paths are built as nested (parent, key) pairs and only formatted when there is an error
+    parts = []
+    while isinstance(path, tuple):
+        path, key = path
+        parts.append(f"[{key}]" if isinstance(key, int) else f".{key}")
+    return path + ''.join(reversed(parts))
+
+
+def _compile_scalar(coerce):
+    def validate(value, path, errors):
+        try:
+            return coerce(value)
+        except Invalid as e:
+            errors.append(f"{_format_path(path)}: {e}")
+    return validate
+
+
+def _compile_list(item_spec):
+    validate_item = compile_schema(item_spec)
+
+    def validate(value, path, errors):
+        # the model sometimes answers a single object where a list is expected
+        if isinstance(value, dict):
+            value = [value]
+        if not isinstance(value, list):
+            errors.append(f"{_format_path(path)}: expected a list")
+            return None
+        return [validate_item(item, (path, i), errors) for i, item in enumerate(value)]
+    return validate
+
+
+def _compile_object(fields):
+    compiled = tuple((name, compile_schema(node), is_required) for name, (node, is_required) in fields.items())
+
+    def validate(value, path, errors):
+        if not isinstance(value, dict):
+            errors.append(f"{_format_path(path)}: expected an object")
+            return None
+        # unknown keys are kept as they are
+        result = dict(value)
+        for name, validate_field, is_required in compiled:
+            field = value.get(name)
+            if field is None or field == '':
+                if is_required:
+                    errors.append(f"{_format_path((path, name))}: required")
+                # so the defaults of create_models_data apply
+                result.pop(name, None)
+                continue
+            result[name] = validate_field(field, (path, name), errors)
+        return result
+    return validate
+
+
+def compile_schema(spec):
+    """
+    Description: turn a schema spec into a validator(value, path, errors) that returns the coerced value
+    and appends the problems it finds to errors. Dicts are objects, one-item lists are lists of that item,
+    anything else is a coercer.
+    """
+    if isinstance(spec, dict):
+        return _compile_object(spec)
+    if isinstance(spec, list):
+        return _compile_list(spec[0])
+    return _compile_scalar(spec)
+
+
+@lru_cache(maxsize=None)
+def section_validator(section):
+    return compile_schema(PLAN_SCHEMA[section])
+
+
+def validate_section(section, value):
+    """
+    Description: validate and repair a single section of a plan. Raises PlanValidationError.
+    """
+    errors = []
+    value = section_validator(section)(value, section, errors)
+    if errors:
+        raise PlanValidationError(errors)
+    return value
+
+
+def validate_plan(plan, sections=PLAN_SECTIONS):
+    """
+    Description: validate and repair a whole plan: string numbers are parsed, day names are normalized
+    ("segunda", "SEGUNDA-FEIRA" -> "Segunda-feira"), missing optional values are dropped so their defaults apply.
+    Returns the repaired copy, or raises PlanValidationError listing every problem.
+    """
+    if not isinstance(plan, dict):
+        raise PlanValidationError(["plan: expected an object"])
+
+    errors = []
+    result = dict(plan)
+    for section in sections:
+        if section not in plan:
+            errors.append(f"{section}: required")
+            continue
+        result[section] = section_validator(section)(plan[section], section, errors)
+
+    if errors:
+        raise PlanValidationError(errors)
+    return result
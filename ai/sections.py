@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import copy_context
+import json
+import time
+from django.conf import settings
+from .compact import COMPACT_PROMPTS, expand_section
+from .metrics import record_openai_call, stage
+from .openai_client import complete_text
+
+PLAN_SECTIONS = ('habits', 'exercises', 'diet')
+
+COMMON_PROMPT = """
+Você é um assistente de IA que gera planos de saúde personalizados com base nos dados do usuário.
+Responda **APENAS** com JSON válido, sem explicações ou texto adicional. Respeite a tipagem de cada campo.
+Todos os nomes, títulos e descrições devem estar em português.
+"""
+
+# One smaller prompt per section, so the three can be generated at the same time
+SECTION_PROMPTS = {
+    'habits': COMMON_PROMPT + """
+Gere os **hábitos** do usuário. Certifique-se de gerar pelo menos três hábitos: um relacionado ao sono,
+um à alimentação e outro à prática de exercícios. O nome do hábito e a unidade de medida devem estar em português.
+
+Estrutura:
+{"habits": [{"name": "Dormir bem" (string), "goal": 8 (int), "measure": "horas" (string)}, ...]}
+""",
+    'exercises': COMMON_PROMPT + """
+Gere a **rotina de exercícios** da semana. Certifique-se de gerar pelo menos três exercícios para cada dia disponível.
+Use os dias da semana em português (Segunda-feira, Terça-feira, Quarta-feira, Quinta-feira, Sexta-feira, Sábado, Domingo).
+
+Estrutura:
+{"exercises": [{"day": "Segunda-feira" (string), "routine": [
+    {"exercise": "Agachamento com barra" (string), "sets": 3 (int), "weight": 20 (int), "reps": 15 (int), "title": "Agachamento" (string)}, ...
+]}, ...]}
+""",
+    'diet': COMMON_PROMPT + """
+Gere a **dieta** do dia. Certifique-se de incluir pelo menos três refeições, cada uma com os alimentos incluídos,
+suas quantidades e as calorias, proteínas, carboidratos e gorduras por porção.
+
+Estrutura:
+{"diet": [{"meal": "Café da manhã" (string), "foods": [
+    {"name": "Aveia" (string), "servings": 1 (int), "calories": 150 (int), "protein": 5 (float), "carbs": 27 (float), "fat": 3 (float)}, ...
+]}, ...]}
+""",
+}
+
+
+def build_section_messages(section, data, plan_format=None):
+    plan_format = plan_format or settings.AI_PLAN_FORMAT
+    prompts = COMPACT_PROMPTS if plan_format == 'compact' else SECTION_PROMPTS
+    return [
+        {"role": "system", "content": prompts[section]},
+        {"role": "user", "content": f"User Data: {data}"}
+    ]
+
+
+def generate_section(section, data):
+    """
+    Description: ask GPT for a single section of the plan and return its list of items.
+    With AI_PLAN_FORMAT = 'compact' the answer is positional rows, expanded here into the usual dicts.
+    """
+    plan_format = settings.AI_PLAN_FORMAT
+    start = time.perf_counter()
+    text, usage, ttft = complete_text(build_section_messages(section, data, plan_format))
+    record_openai_call(
+        section=section,
+        ttft_ms=round(ttft * 1000, 1) if ttft is not None else None,
+        total_ms=round((time.perf_counter() - start) * 1000, 1),
+        prompt_tokens=usage.prompt_tokens if usage else None,
+        completion_tokens=usage.completion_tokens if usage else None,
+    )
+
+    try:
+        with stage('parse'):
+            parsed = json.loads(text)
+    except json.JSONDecodeError:
+        raise ValueError(f"GPT returned a {section} section that is not valid JSON")
+
+    # the model sometimes answers with the bare list instead of the wrapping object
+    if isinstance(parsed, dict):
+        parsed = parsed.get(section)
+    if not isinstance(parsed, list):
+        raise ValueError(f"GPT returned no {section} section")
+    if plan_format == 'compact':
+        parsed = expand_section(section, parsed)
+    return parsed
+
+
+def generate_sections(data, sections=PLAN_SECTIONS):
+    """
+    Description: generate the sections at the same time and merge them into the structure
+    create_models_data consumes. Latency is the slowest section instead of the sum of all of them.
+    """
+    with ThreadPoolExecutor(max_workers=len(sections)) as executor:
+        # each thread records into the metrics of the caller's run
+        futures = {section: executor.submit(copy_context().run, generate_section, section, data) for section in sections}
+        return {section: future.result() for section, future in futures.items()}
+
+
+def iter_sections(data, sections=PLAN_SECTIONS):
+    """
+    Description: generate the sections at the same time and yield each (section, items) as soon as
+    it is ready, fastest first, for callers that use sections before the plan is complete.
+    """
+    with ThreadPoolExecutor(max_workers=len(sections)) as executor:
+        futures = {executor.submit(copy_context().run, generate_section, section, data): section for section in sections}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
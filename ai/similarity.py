@@ -0,0 +1,185 @@
+"""
+Similarity index over the goals of the cached plans, so "perder peso rápido" can reuse the plan
+generated for "perder peso" instead of paying for another generation. Goals are sparse character
+n-gram TF-IDF vectors compared by cosine, in process, only against the goals of the same profile buckets.
+"""
+import heapq
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from diets.planner import goal_kind
+from .cache import cache_ttl, cache_version, lookup_plan, normalize_goal, plan_cache_key
+from .models import AI_data
+
+NGRAM_SIZES = (2, 3, 4)
+
+# Goals of the same kind (lose weight, gain muscle...) share a feature, so synonyms without
+# common n-grams ("emagrecer", "perder peso") still come close
+KIND_WEIGHT = 4.0
+
+
+def goal_features(goal):
+    """
+    Description: term frequencies of the goal's character n-grams (and its goal kind), as a sparse
+    {feature: weight} dict.
+    """
+    text = f" {normalize_goal(goal)} "
+    counts = Counter(text[i:i + n] for n in NGRAM_SIZES for i in range(len(text) - n + 1))
+    # sublinear term frequency, so repeated words don't dominate
+    features = {gram: math.log1p(count) for gram, count in counts.items()}
+
+    kind = goal_kind(goal)
+    if kind != 'maintain':
+        features[f"#kind:{kind}"] = KIND_WEIGHT
+    return features
+
+
+def _bucket(key):
+    # "v1:<goal>:<weight>:<height>:<age>" -> ("v1", "<weight>:<height>:<age>"); normalized goals never contain ':'
+    version, _, rest = key.partition(':')
+    return version, rest.partition(':')[2]
+
+
+class GoalIndex:
+    """
+    Description: the fresh cached goals, grouped by cache version and profile buckets. store_plan and
+    invalidate_plan update it as they write; plans stored by other processes (celery workers) are read
+    from AI_data at most every SYNC_SECONDS, only the rows created since the last read.
+
+    An entry may outlive its row (deleted or expired elsewhere): find_similar_plan reads the plan through
+    lookup_plan, which only returns fresh rows.
+    """
+
+    SYNC_SECONDS = 5
+    # rows are read again a little before the last read, for transactions that committed late
+    SYNC_OVERLAP = timedelta(seconds=60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.entries = OrderedDict()  # cache key -> (goal, features, expiry), oldest first
+        self.buckets = {}  # (version, profile) -> cache keys
+        self.document_frequency = Counter()
+        self._synced_at = 0.0
+        self._synced_until = None
+
+    def add(self, key, goal, created_at=None):
+        features = goal_features(goal)
+        expiry = (created_at or timezone.now()) + cache_ttl()
+        with self._lock:
+            self._discard(key)
+            self.entries[key] = (goal, features, expiry)
+            self.buckets.setdefault(_bucket(key), set()).add(key)
+            self.document_frequency.update(features.keys())
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.buckets[_bucket(key)].discard(key)
+        for feature in entry[1]:
+            self.document_frequency[feature] -= 1
+            if not self.document_frequency[feature]:
+                del self.document_frequency[feature]
+
+    def sync(self):
+        """
+        Description: add the plans stored since the last sync (all the fresh ones the first time) and drop the
+        expired entries. Costs one indexed query at most every SYNC_SECONDS.
+        """
+        with self._lock:
+            if time.monotonic() - self._synced_at < self.SYNC_SECONDS:
+                return
+            self._synced_at = time.monotonic()
+            since = self._synced_until
+
+        now = timezone.now()
+        oldest = now - cache_ttl()
+        rows = AI_data.objects.filter(
+            version=cache_version(), created_at__gte=oldest if since is None else max(oldest, since - self.SYNC_OVERLAP)
+        ).values_list('cache_key', 'goal', 'created_at')
+        for key, goal, created_at in rows:
+            self.add(key, goal, created_at)
+
+        with self._lock:
+            self._synced_until = now
+            # entries are kept roughly in creation order, the expired ones are at the front
+            while self.entries:
+                key, (_, _, expiry) = next(iter(self.entries.items()))
+                if expiry > now:
+                    break
+                self._discard(key)
+
+    def _idf(self, feature):
+        # smoothed inverse document frequency
+        return math.log((1 + len(self.entries)) / (1 + self.document_frequency.get(feature, 0))) + 1
+
+    def search(self, goal, buckets, k=5):
+        """
+        Description: the k most similar cached goals for the same profile buckets, best first,
+        as (score, cache key, goal). The goal's own key is left out.
+        """
+        self.sync()
+        key = plan_cache_key(goal, buckets)
+        features = goal_features(goal)
+        with self._lock:
+            candidates = self.buckets.get(_bucket(key))
+            if not candidates:
+                return []
+
+            query = {feature: weight * self._idf(feature) for feature, weight in features.items()}
+            query_norm = math.sqrt(sum(weight * weight for weight in query.values()))
+            if query_norm == 0:
+                return []
+
+            scored = []
+            for candidate in candidates:
+                if candidate == key:
+                    continue
+                candidate_goal, candidate_features, _ = self.entries[candidate]
+                weights = {feature: weight * self._idf(feature) for feature, weight in candidate_features.items()}
+                dot = sum(query[feature] * weight for feature, weight in weights.items() if feature in query)
+                norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+                scored.append((dot / (query_norm * norm) if norm else 0.0, candidate, candidate_goal))
+        return heapq.nlargest(k, scored, key=lambda result: result[0])
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+
+goal_index = GoalIndex()
+
+
+def similarity_threshold():
+    return getattr(settings, 'AI_SIMILARITY_THRESHOLD', 0.7)
+
+
+def find_similar_plan(goal, buckets):
+    """
+    Description: the fresh cached plan of the most similar goal for the same profile buckets, if it is at
+    least AI_SIMILARITY_THRESHOLD similar, as (entry, score). (None, best score) otherwise.
+    """
+    threshold = similarity_threshold()
+    if threshold is None or threshold > 1:
+        return None, None
+
+    best = None
+    for score, key, _ in goal_index.search(goal, buckets):
+        best = score if best is None else best
+        if score < threshold:
+            break
+        entry = lookup_plan(key)
+        if entry is not None:
+            return entry, score
+    return None, best
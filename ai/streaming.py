@@ -0,0 +1,93 @@
+import json
+import time
+from .cache import describe_profile, lookup_plan, plan_cache_key, profile_buckets, store_plan
+from .locks import single_flight
+from .metrics import collect, record_cache, record_similarity, record_time, stage
+from .plan_templates import apply_plan
+from .schema import validate_plan, validate_section
+from .sections import PLAN_SECTIONS, iter_sections
+from .similarity import find_similar_plan
+from .utils import create_models_data
+
+
+# key of each section in the result of create_models_data
+CREATED_KEYS = {'habits': 'habits', 'exercises': 'routine_exercises', 'diet': 'meal_foods'}
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def _section_event(section, value, user):
+    # persist the finished section right away, the others may still be generating
+    with stage('persist'):
+        created = create_models_data({section: value}, user)
+    created.pop('queries')
+    return sse_event('section', {'section': section, 'data': value, 'created': created})
+
+
+def _cached_section_event(section, value, created):
+    # only the rows of this section, in the same shape as _section_event
+    created = {name: ids if name == CREATED_KEYS[section] else [] for name, ids in created.items() if name != 'queries'}
+    return sse_event('section', {'section': section, 'data': value, 'created': created})
+
+
+def stream_plan(data, user):
+    """
+    Description: generator of server-sent events for the plan of the user's goal. The sections are
+    generated at the same time, with the same prompts as the jobs, and each one is saved and sent to the
+    client as soon as it is ready; cached plans are replayed section by section.
+    """
+    goal = data['goal']
+    buckets = profile_buckets(user)
+    key = plan_cache_key(goal, buckets)
+
+    with collect():
+        try:
+            with stage('cache_lookup'):
+                entry = lookup_plan(key)
+            if entry is not None:
+                record_cache('hit')
+            else:
+                with stage('similarity'):
+                    entry, score = find_similar_plan(goal, buckets)
+                record_similarity(score)
+                if entry is not None:
+                    record_cache('similar')
+
+            if entry is None:
+                lock_started = time.perf_counter()
+                with single_flight(key) as acquired:
+                    record_time('lock_wait', time.perf_counter() - lock_started)
+                    with stage('cache_lookup'):
+                        entry = lookup_plan(key)
+                    if entry is None and not acquired:
+                        # another worker is still generating this plan, don't start a second generation
+                        raise ValueError("The plan is still being generated, try again shortly.")
+
+                    if entry is not None:
+                        record_cache('coalesced')
+                    else:
+                        record_cache('miss')
+                        plan = {}
+                        for section, items in iter_sections({**data, 'profile': describe_profile(buckets)}):
+                            with stage('validate'):
+                                plan[section] = validate_section(section, items)
+                            yield _section_event(section, plan[section], user)
+
+                        with stage('store'):
+                            store_plan(key, goal, validate_plan(plan))
+                        yield sse_event('done', {'cached': False})
+                        return
+
+            # cached plans are saved at once through their compiled template, then replayed
+            with stage('persist'):
+                created = apply_plan(entry, user)
+            for section in PLAN_SECTIONS:
+                if section in entry.json_data:
+                    yield _cached_section_event(section, entry.json_data[section], created)
+            yield sse_event('done', {'cached': True})
+
+        except Exception as e:
+            print(f"An error occurred while streaming data with GPT: {e}")
+            yield sse_event('error', {'detail': str(e)})
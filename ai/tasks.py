@@ -0,0 +1,89 @@
+from celery import shared_task
+from django.conf import settings
+from django.core.management import call_command
+from django.db import transaction
+from .batch import onboard_jobs
+from .limiter import generation_limiter
+from .local_planner import generate_local_plan
+from .metrics import collect, record_queries, stage
+from .models import AIGenerationJob
+from .plan_templates import apply_plan
+from .utils import create_models_data, discard_plan_rows, get_plan
+
+
+@shared_task
+def generate_plan_for_user(job_id, slot=None):
+    """
+    Description: generate (or fetch from cache) the AI plan for a job and save it for the job's user.
+    `slot` is the generation limiter token taken by the view; it is released once the job ends.
+    """
+    try:
+        _generate_plan_for_job(job_id)
+    finally:
+        generation_limiter.release(slot)
+
+
+def _generate_plan_for_job(job_id):
+    try:
+        job = AIGenerationJob.objects.select_related('user').get(id=job_id)
+    except AIGenerationJob.DoesNotExist:
+        return
+
+    job.status = AIGenerationJob.STATUS_RUNNING
+    job.save(update_fields=['status', 'updated_at'])
+
+    error = None
+    source = AIGenerationJob.SOURCE_AI
+    with collect() as metrics:
+        try:
+            entry = get_plan(job.payload, job.user)
+            created = None
+
+            if entry is not None:
+                # Save the plan's compiled template for the user, in place of the draft if there is one
+                with stage('persist'), transaction.atomic():
+                    discard_plan_rows(job.draft)
+                    created = apply_plan(entry, job.user)
+            elif job.draft:
+                # OpenAI couldn't answer: the user keeps the local draft
+                source = AIGenerationJob.SOURCE_LOCAL
+            elif settings.AI_LOCAL_FALLBACK:
+                source = AIGenerationJob.SOURCE_LOCAL
+                with stage('local_plan'):
+                    plan = generate_local_plan(job.goal, job.user)
+                with stage('persist'):
+                    created = create_models_data(plan, job.user)
+            else:
+                raise ValueError("Error generating data")
+
+            if created is not None:
+                record_queries(created['queries'])
+        except Exception as e:
+            error = str(e)
+
+    job.metrics = metrics.as_dict()
+    if error is not None:
+        job.status = AIGenerationJob.STATUS_FAILED
+        job.error = error
+    else:
+        job.status = AIGenerationJob.STATUS_DONE
+        job.source = source
+    job.save(update_fields=['status', 'error', 'source', 'metrics', 'updated_at'])
+
+
+@shared_task
+def onboard_users(job_ids):
+    """
+    Description: generate and save the plans of a batch of jobs, each distinct plan once (see ai/batch.py).
+    """
+    jobs = list(AIGenerationJob.objects.filter(id__in=job_ids).select_related('user'))
+    if jobs:
+        onboard_jobs(jobs)
+
+
+@shared_task
+def warm_ai_plans():
+    """
+    Description: nightly run of the warm_ai_plans command (see CELERY_BEAT_SCHEDULE).
+    """
+    call_command('warm_ai_plans')
@@ -0,0 +1,201 @@
+"""
+Local stand-in for the OpenAI chat completions API, used by the tests and the benchmarks so they can
+run offline with a controlled latency.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .compact import COMPACT_PROMPTS, compact_section
+
+
+def estimate_tokens(text):
+    # close enough to the GPT tokenizers for latency and cost comparisons (~4 characters per token)
+    return max(1, len(text) // 4)
+
+
+def sample_plan(days=7, exercises_per_day=3, meals=3, foods_per_meal=3):
+    """
+    Description: a realistic plan in the shape generate_data_with_gpt returns.
+    """
+    week = ["Segunda-feira", "Terça-feira", "Quarta-feira", "Quinta-feira", "Sexta-feira", "Sábado", "Domingo"]
+    return {
+        "habits": [
+            {"name": "Dormir bem", "goal": 8, "measure": "horas"},
+            {"name": "Comer frutas diariamente", "goal": 3, "measure": "porções"},
+            {"name": "Exercitar-se regularmente", "goal": 5, "measure": "dias por semana"},
+        ],
+        "exercises": [
+            {
+                "day": day,
+                "routine": [
+                    {"exercise": f"Exercício {j + 1} de {day}", "sets": 3, "weight": 20 + j * 5, "reps": 12}
+                    for j in range(exercises_per_day)
+                ]
+            }
+            for day in week[:days]
+        ],
+        "diet": [
+            {
+                "meal": f"Refeição {i + 1}",
+                "foods": [
+                    {"name": f"Alimento {i + 1}.{j + 1}", "servings": 1, "calories": 150, "protein": 5.0, "carbs": 27.0, "fat": 3.0}
+                    for j in range(foods_per_meal)
+                ]
+            }
+            for i in range(meals)
+        ]
+    }
+
+
+def plan_responder(plan):
+    """
+    Description: answer each request with the part of the plan its system prompt asks for,
+    as positional rows for the compact prompts.
+    """
+    compact = {prompt: section for section, prompt in COMPACT_PROMPTS.items()}
+
+    def respond(request):
+        system = request['messages'][0]['content']
+        if system in compact:
+            section = compact[system]
+            return json.dumps(compact_section(section, plan[section]), ensure_ascii=False, separators=(',', ':'))
+
+        requested = [section for section in ('habits', 'exercises', 'diet') if f'"{section}"' in system]
+        if len(requested) == 1:
+            return json.dumps({requested[0]: plan[requested[0]]}, ensure_ascii=False)
+        return json.dumps(plan, ensure_ascii=False)
+    return respond
+
+
+class FakeOpenAIServer:
+    """
+    Description: threaded HTTP server answering POST /v1/chat/completions, streamed or not.
+
+    `responder(request_json)` returns the completion text. Each response waits `latency` seconds
+    plus `token_latency` seconds per generated token, roughly how GPT output speed behaves.
+
+    `failures` scripts the first requests, one entry per request, to reproduce upstream trouble:
+    an HTTP status code (e.g. 429 or 503) answers with that error, 'hang' waits `hang_seconds`
+    before answering (to trip read timeouts) and 'drop' closes the connection without answering.
+
+        with FakeOpenAIServer(responder) as server:
+            os.environ['OPENAI_BASE_URL'] = server.base_url
+    """
+
+    def __init__(self, responder, latency=0.0, token_latency=0.0, failures=None, hang_seconds=5.0):
+        self.responder = responder
+        self.latency = latency
+        self.token_latency = token_latency
+        self.failures = list(failures or [])
+        self.hang_seconds = hang_seconds
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                with fake._lock:
+                    fake.requests.append(body)
+                try:
+                    fake.handle(self, body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up, e.g. on a read timeout
+                    pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def send_json(self, handler, status, payload):
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def handle(self, handler, body):
+        with self._lock:
+            failure = self.failures.pop(0) if self.failures else None
+
+        if failure == 'drop':
+            handler.close_connection = True
+            return
+        if failure == 'hang':
+            time.sleep(self.hang_seconds)
+        elif failure is not None:
+            handler.send_response(failure)
+            payload = json.dumps({'error': {'message': f'fake error {failure}', 'type': 'fake_error', 'code': None}}).encode()
+            handler.send_header('Content-Type', 'application/json')
+            handler.send_header('Content-Length', str(len(payload)))
+            if failure == 429:
+                handler.send_header('Retry-After', '0')
+            handler.end_headers()
+            handler.wfile.write(payload)
+            return
+
+        content = self.responder(body)
+        prompt_tokens = sum(estimate_tokens(message['content']) for message in body.get('messages', []))
+        completion_tokens = estimate_tokens(content)
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+
+        time.sleep(self.latency)
+
+        if body.get('stream'):
+            self.stream(handler, body, content, usage)
+            return
+
+        time.sleep(self.token_latency * completion_tokens)
+        self.send_json(handler, 200, {
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'gpt-4'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': usage,
+        })
+
+    def stream(self, handler, body, content, usage):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+
+        def send(payload):
+            handler.wfile.write(f"data: {json.dumps(payload)}\n\n".encode())
+            handler.wfile.flush()
+
+        chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': body.get('model', 'gpt-4')}
+        # one chunk per ~token, like the real API
+        for i in range(0, len(content), 4):
+            time.sleep(self.token_latency)
+            send({**chunk, 'choices': [{'index': 0, 'delta': {'content': content[i:i + 4]}, 'finish_reason': None}]})
+
+        send({**chunk, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+        if body.get('stream_options', {}).get('include_usage'):
+            send({**chunk, 'choices': [], 'usage': usage})
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.wfile.flush()
+        handler.close_connection = True
@@ -1,3 +1,1606 @@
-from django.test import TestCase
+import datetime
+import importlib
+import json
+import os
+import threading
+import time
+from io import StringIO
+from unittest import mock
+import redis
+from openai import BadRequestError
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from authentication.models import User
+from complete_profile.models import UserGoals
+from habits.models import Habit, HabitDailyTotal, HabitLog
+from exercises.models import Exercise, Routine, RoutineExercise
+from diets.models import Food, Meal, MealFood
+from diets.planner import energy_expenditure
+from .compact import COMPACT_PROMPTS, compact_section, expand_section
+from .batch import create_jobs, onboard_jobs, resolve_users
+from .cache import PlanLRU, invalidate_plan, normalize_goal, plan_cache_key, plan_lru, profile_buckets, purge_expired_plans, store_plan
+from .limiter import ConcurrencyLimiter, LimitExceeded, RateLimiter, generation_limiter
+from .local_planner import generate_local_plan, goal_kind, profile_values
+from .locks import single_flight
+from .metrics import collect, percentile
+from .models import AI_data, AIGenerationJob, PlanTemplate
+from .openai_client import CircuitBreaker, CircuitOpenError, OpenAIUnavailable, breaker, chat_completion, get_client
+from .plan_templates import apply_plan, apply_template, apply_template_to_users, get_template
+from .schema import PlanValidationError, section_validator, validate_plan, validate_section
+from .sections import build_section_messages, generate_section
+from .similarity import GoalIndex, goal_index, similarity_threshold
+from .tasks import generate_plan_for_user
+from .testing import FakeOpenAIServer, plan_responder, sample_plan
+from .utils import DAY_MAPPING, create_models_data, generate_data_with_gpt, get_data, get_plan_for_buckets
 
-# Create your tests here.
+SAMPLE_PLAN = {
+    "habits": [
+        {"name": "Dormir bem", "goal": 8, "measure": "horas"},
+    ],
+    "exercises": [
+        {
+            "day": "Segunda-feira",
+            "routine": [
+                {"exercise": "Agachamento com barra", "sets": 3, "weight": 20, "reps": 15, "title": "Agachamento"},
+            ]
+        },
+    ],
+    "diet": [
+        {
+            "meal": "Café da manhã",
+            "foods": [
+                {"name": "Aveia", "servings": 1, "calories": 150, "protein": 5, "carbs": 27, "fat": 3},
+            ]
+        },
+    ]
+}
+
+
+class GenerateDataTests(APITestCase):
+
+    def setUp(self):
+        generation_limiter.reset()
+        self.user = User.objects.create_user(email='testuser@example.com', password='testpass')
+        self.login_url = reverse('login')
+
+        # Log in the user and obtain a token
+        login_data = {'email': 'testuser@example.com', 'password': 'testpass'}
+        response = self.client.post(self.login_url, login_data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        token = response.data['access']
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+
+        self.generate_url = reverse('ai-generate-data')
+
+    @mock.patch('ai.views.generate_plan_for_user.delay')
+    def test_generate_data_queues_job(self, delay):
+        response = self.client.post(self.generate_url, {'goal': 'Emagrecimento'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], 'queued')
+
+        job = AIGenerationJob.objects.get(id=response.data['job_id'])
+        self.assertEqual(job.user, self.user)
+        self.assertEqual(job.payload, {'goal': 'Emagrecimento'})
+        delay.assert_called_once_with(job.id, slot=mock.ANY)
+
+    def test_generate_data_without_goal(self):
+        response = self.client.post(self.generate_url, {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(AIGenerationJob.objects.count(), 0)
+
+    def test_job_status(self):
+        job = AIGenerationJob.objects.create(user=self.user, goal='Emagrecimento', payload={'goal': 'Emagrecimento'})
+        response = self.client.get(reverse('ai-job-status', args=[job.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'queued')
+
+    def test_job_status_of_another_user(self):
+        other = User.objects.create_user(email='other@example.com', password='testpass')
+        job = AIGenerationJob.objects.create(user=other, goal='Emagrecimento')
+        response = self.client.get(reverse('ai-job-status', args=[job.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_task_marks_job_done(self):
+        store_plan(plan_cache_key('Emagrecimento', profile_buckets(self.user)), 'Emagrecimento', SAMPLE_PLAN)
+        job = AIGenerationJob.objects.create(user=self.user, goal='Emagrecimento', payload={'goal': 'Emagrecimento'})
+        generate_plan_for_user(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AIGenerationJob.STATUS_DONE)
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), 1)
+
+    @override_settings(AI_LOCAL_FALLBACK=False)
+    @mock.patch('ai.tasks.get_plan', return_value=None)
+    def test_task_marks_job_failed(self, get_plan):
+        job = AIGenerationJob.objects.create(user=self.user, goal='Emagrecimento', payload={'goal': 'Emagrecimento'})
+        generate_plan_for_user(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AIGenerationJob.STATUS_FAILED)
+        self.assertEqual(job.error, 'Error generating data')
+
+
+def build_plan(days=7, exercises_per_day=3, meals=3, foods_per_meal=3):
+    return {
+        "habits": [
+            {"name": f"Hábito {i}", "goal": 8, "measure": "horas"} for i in range(3)
+        ],
+        "exercises": [
+            {
+                "day": day,
+                "routine": [
+                    {"exercise": f"Exercício {j}", "sets": 3, "weight": 20, "reps": 12} for j in range(exercises_per_day)
+                ]
+            }
+            for day in list(DAY_MAPPING)[:days]
+        ],
+        "diet": [
+            {
+                "meal": f"Refeição {i}",
+                "foods": [
+                    {"name": f"Alimento {i}-{j}", "servings": 1, "calories": 100, "protein": 5, "carbs": 10, "fat": 2}
+                    for j in range(foods_per_meal)
+                ]
+            }
+            for i in range(meals)
+        ]
+    }
+
+
+class CreateModelsDataTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='testuser@example.com', password='testpass')
+
+    def test_creates_plan_rows(self):
+        result = create_models_data(SAMPLE_PLAN, self.user)
+
+        habit = Habit.objects.get(user=self.user)
+        self.assertEqual(result['habits'], [habit.id])
+        self.assertEqual(list(habit.frequencies.values_list('name', flat=True)), ['daily'])
+
+        routine_exercise = RoutineExercise.objects.get(routine__user=self.user)
+        self.assertEqual(routine_exercise.day_of_week, 'monday')
+        self.assertEqual(routine_exercise.exercise.exercise_type, 'gym')
+        self.assertEqual(routine_exercise.weight_goal, 20)
+
+        meal_food = MealFood.objects.get(meal__user=self.user)
+        self.assertEqual(meal_food.meal.name, 'Café da manhã')
+        self.assertEqual(meal_food.food.calories, 150)
+
+    def test_plan_logs_reach_the_daily_rollup(self):
+        today = datetime.date.today()
+        plan = dict(SAMPLE_PLAN, habits=[{
+            "name": "Beber água", "goal": 2, "measure": "litros",
+            "logs": [{"date": today, "amount": 0.5}, {"date": today, "amount": 1.0}, {"date": today - datetime.timedelta(days=1), "amount": 2.0}],
+        }])
+        create_models_data(plan, self.user)
+
+        totals = {row.date: (row.total, row.last_amount, row.count) for row in HabitDailyTotal.objects.filter(habit__user=self.user)}
+        self.assertEqual(totals, {today: (1.5, 1.0, 2), today - datetime.timedelta(days=1): (2.0, 2.0, 1)})
+
+    def test_reuses_catalog_entries(self):
+        exercise = Exercise.objects.create(name='Agachamento com barra', exercise_type='gym')
+        food = Food.objects.create(name='Aveia', calories=120)
+
+        create_models_data(SAMPLE_PLAN, self.user)
+        create_models_data(SAMPLE_PLAN, self.user)
+
+        self.assertEqual(Exercise.objects.count(), 1)
+        self.assertEqual(Food.objects.count(), 1)
+        self.assertEqual(set(RoutineExercise.objects.values_list('exercise_id', flat=True)), {exercise.id})
+        self.assertEqual(set(MealFood.objects.values_list('food_id', flat=True)), {food.id})
+        self.assertEqual(Meal.objects.filter(user=self.user).count(), 1)
+
+    def test_query_count_does_not_grow_with_plan_size(self):
+        small = create_models_data(build_plan(days=1, exercises_per_day=1, meals=1, foods_per_meal=1), self.user)
+
+        other = User.objects.create_user(email='other@example.com', password='testpass')
+        with CaptureQueriesContext(connection) as queries:
+            large = create_models_data(build_plan(days=7, exercises_per_day=6, meals=5, foods_per_meal=6), other)
+
+        self.assertEqual(large['queries'], len(queries))
+        self.assertEqual(large['queries'], small['queries'])
+        self.assertEqual(len(large['routine_exercises']), 42)
+        self.assertEqual(len(large['meal_foods']), 30)
+
+    def test_invalid_frequency(self):
+        plan = {"habits": [{"name": "Dormir bem", "goal": 8, "frequency": "hourly"}]}
+        with self.assertRaises(ValidationError):
+            create_models_data(plan, self.user)
+        self.assertEqual(Habit.objects.count(), 0)
+
+    def test_failure_rolls_back_whole_plan(self):
+        plan = dict(SAMPLE_PLAN, diet=[{"meal": "Almoço", "foods": [{"servings": 1}]}])
+        with self.assertRaises(KeyError):
+            create_models_data(plan, self.user)
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), 0)
+        self.assertEqual(RoutineExercise.objects.count(), 0)
+        self.assertEqual(Meal.objects.count(), 0)
+
+
+class LocalPlannerTests(APITestCase):
+
+    def setUp(self):
+        plan_lru.clear()
+        generation_limiter.reset()
+        self.user = User.objects.create_user(
+            email='testuser@example.com', password='testpass', weight=82, height=1.80, birth_date=datetime.date(1990, 5, 1)
+        )
+        self.client.force_authenticate(self.user)
+        self.generate_url = reverse('ai-generate-data')
+
+    def test_goal_kinds(self):
+        self.assertEqual(goal_kind('Emagrecimento'), 'lose')
+        self.assertEqual(goal_kind('Hipertrofia'), 'gain')
+        self.assertEqual(goal_kind('Quero correr uma maratona'), 'endurance')
+        self.assertEqual(goal_kind('Manutenção da saúde'), 'maintain')
+
+    def test_calories_follow_profile_and_goal(self):
+        profile = profile_values({'weight': 80, 'height': 180, 'age': 30})
+        self.assertEqual(profile, {'weight': 85, 'height': 185, 'age': 35})
+        self.assertLess(energy_expenditure(profile, 'lose'), energy_expenditure(profile, 'maintain'))
+        self.assertLess(energy_expenditure(profile, 'maintain'), energy_expenditure(profile, 'gain'))
+        self.assertLess(energy_expenditure(profile_values({'weight': 50}), 'maintain'), energy_expenditure(profile, 'maintain'))
+
+    def test_plan_is_valid_deterministic_and_fast(self):
+        start = time.perf_counter()
+        plan = generate_local_plan('Emagrecimento', self.user)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(validate_plan(plan), plan)
+        self.assertEqual(generate_local_plan('Emagrecimento', self.user), plan)
+        self.assertLess(elapsed, 0.5)
+        self.assertGreaterEqual(len(plan['habits']), 3)
+        self.assertTrue(all(len(day['routine']) >= 3 for day in plan['exercises']))
+        self.assertGreaterEqual(len(plan['diet']), 3)
+        self.assertTrue(all(len({food['name'] for food in meal['foods']}) == len(meal['foods']) for meal in plan['diet']))
+
+    def test_plan_uses_the_catalogs(self):
+        Exercise.objects.create(name='Leg press', exercise_type='gym')
+        Exercise.objects.create(name='Natação', exercise_type='cardio')
+        for i in range(6):
+            Food.objects.create(name=f'Alimento {i}', calories=100 + i * 50, protein=i * 4, carbs=30 - i * 4, fat=i)
+
+        plan = generate_local_plan('Emagrecimento', self.user)
+        names = {item['exercise'] for day in plan['exercises'] for item in day['routine']}
+        foods = {food['name'] for meal in plan['diet'] for food in meal['foods']}
+
+        self.assertEqual(names, {'Leg press', 'Natação'})
+        self.assertTrue(foods <= {f'Alimento {i}' for i in range(6)})
+
+    def test_diet_calories_match_the_target(self):
+        plan = generate_local_plan('Hipertrofia', self.user)
+        total = sum(food['servings'] * food['calories'] for meal in plan['diet'] for food in meal['foods'])
+        target = energy_expenditure(profile_values(profile_buckets(self.user)), 'gain')
+        self.assertLess(abs(total - target) / target, 0.15)
+
+    @mock.patch('ai.tasks.get_plan', return_value=None)
+    def test_task_falls_back_to_local_plan(self, get_plan):
+        job = AIGenerationJob.objects.create(user=self.user, goal='Emagrecimento', payload={'goal': 'Emagrecimento'})
+        generate_plan_for_user(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AIGenerationJob.STATUS_DONE)
+        self.assertEqual(job.source, AIGenerationJob.SOURCE_LOCAL)
+        self.assertIn('local_plan', job.metrics['stages_ms'])
+        self.assertGreaterEqual(Habit.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(AI_data.objects.count(), 0)
+
+    @mock.patch('ai.views.generate_plan_for_user.delay')
+    def test_draft_is_saved_right_away_and_replaced_by_ai_plan(self, delay):
+        response = self.client.post(self.generate_url, {'goal': 'Emagrecimento', 'draft': True}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['source'], 'local')
+        draft_habits = response.data['created']['habits']
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), len(draft_habits))
+
+        job = AIGenerationJob.objects.get(id=response.data['job_id'])
+        self.assertEqual(job.payload, {'goal': 'Emagrecimento'})
+        delay.assert_called_once_with(job.id, slot=mock.ANY)
+
+        # the user already logged one of the draft habits: that one is kept
+        HabitLog.objects.create(habit_id=draft_habits[0], date=datetime.date.today(), amount=1)
+
+        store_plan(plan_cache_key('Emagrecimento', profile_buckets(self.user)), 'Emagrecimento', SAMPLE_PLAN)
+        generate_plan_for_user(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.source, AIGenerationJob.SOURCE_AI)
+        self.assertEqual(
+            sorted(Habit.objects.filter(user=self.user).values_list('name', flat=True)),
+            sorted(['Dormir bem', Habit.objects.get(id=draft_habits[0]).name])
+        )
+        self.assertEqual(list(Meal.objects.filter(user=self.user).values_list('name', flat=True)), ['Café da manhã'])
+        self.assertEqual(MealFood.objects.filter(meal__user=self.user).count(), 1)
+        self.assertEqual(RoutineExercise.objects.filter(routine__user=self.user).count(), 1)
+
+    @mock.patch('ai.tasks.get_plan', return_value=None)
+    @mock.patch('ai.views.generate_plan_for_user.delay')
+    def test_draft_is_kept_when_ai_fails(self, delay, get_plan):
+        response = self.client.post(self.generate_url, {'goal': 'Hipertrofia', 'draft': True}, format='json')
+        generate_plan_for_user(response.data['job_id'])
+
+        job = AIGenerationJob.objects.get(id=response.data['job_id'])
+        self.assertEqual(job.status, AIGenerationJob.STATUS_DONE)
+        self.assertEqual(job.source, AIGenerationJob.SOURCE_LOCAL)
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), len(response.data['created']['habits']))
+
+    @mock.patch('ai.views.generate_plan_for_user.delay')
+    def test_draft_without_upgrade(self, delay):
+        response = self.client.post(self.generate_url, {'goal': 'Hipertrofia', 'draft': 'true', 'upgrade': 'false'})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('job_id', response.data)
+        self.assertEqual(AIGenerationJob.objects.count(), 0)
+        delay.assert_not_called()
+
+
+class PlanTemplateTests(TestCase):
+
+    def setUp(self):
+        plan_lru.clear()
+        self.user = User.objects.create_user(email='testuser@example.com', password='testpass')
+
+    def store(self, plan, goal='Emagrecimento'):
+        return store_plan(plan_cache_key(goal, profile_buckets(None)), goal, plan)
+
+    def rows(self, user):
+        return {
+            'habits': list(Habit.objects.filter(user=user).order_by('id').values_list('name', 'goal', 'measure', 'frequencies__name')),
+            'routine_exercises': list(RoutineExercise.objects.filter(routine__user=user).order_by('id').values_list(
+                'exercise_id', 'day_of_week', 'weight_goal', 'reps_goal'
+            )),
+            'meal_foods': list(MealFood.objects.filter(meal__user=user).order_by('id').values_list('meal__name', 'food_id', 'servings')),
+        }
+
+    def test_template_matches_create_models_data(self):
+        plan = build_plan(days=3, exercises_per_day=2, meals=2, foods_per_meal=2)
+        other = User.objects.create_user(email='other@example.com', password='testpass')
+        create_models_data(plan, other)
+
+        result = apply_plan(self.store(plan), self.user)
+
+        self.assertEqual(self.rows(self.user), self.rows(other))
+        self.assertEqual(result['habits'], list(Habit.objects.filter(user=self.user).order_by('id').values_list('id', flat=True)))
+        self.assertEqual(len(result['routine_exercises']), 6)
+        self.assertEqual(len(result['meal_foods']), 4)
+
+    def test_template_is_compiled_once(self):
+        entry = self.store(SAMPLE_PLAN)
+        apply_plan(entry, self.user)
+        apply_plan(entry, User.objects.create_user(email='other@example.com', password='testpass'))
+
+        self.assertEqual(PlanTemplate.objects.count(), 1)
+        self.assertEqual(Exercise.objects.count(), 1)
+        self.assertEqual(Food.objects.count(), 1)
+
+    def test_query_count_does_not_grow_with_plan_size(self):
+        small = get_template(self.store(build_plan(days=1, exercises_per_day=1, meals=1, foods_per_meal=1), 'Corrida'))
+        large = get_template(self.store(build_plan(days=7, exercises_per_day=6, meals=5, foods_per_meal=6), 'Hipertrofia'))
+
+        small_result = apply_template(small, self.user)
+        other = User.objects.create_user(email='other@example.com', password='testpass')
+        with CaptureQueriesContext(connection) as queries:
+            large_result = apply_template(large, other)
+
+        self.assertEqual(large_result['queries'], len(queries))
+        self.assertEqual(large_result['queries'], small_result['queries'])
+        self.assertEqual(len(large_result['routine_exercises']), 42)
+        self.assertEqual(len(large_result['meal_foods']), 30)
+
+    def test_meals_of_the_day_are_reused(self):
+        entry = self.store(SAMPLE_PLAN)
+        apply_plan(entry, self.user)
+        apply_plan(entry, self.user)
+
+        self.assertEqual(Meal.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(MealFood.objects.filter(meal__user=self.user).count(), 2)
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), 2)
+
+    def test_regenerated_plan_drops_stale_template(self):
+        entry = self.store(SAMPLE_PLAN)
+        get_template(entry)
+
+        entry = self.store(build_plan(days=1, exercises_per_day=1, meals=1, foods_per_meal=1))
+        self.assertEqual(PlanTemplate.objects.count(), 0)
+
+        result = apply_plan(entry, self.user)
+        self.assertEqual(len(result['habits']), 3)
+        self.assertEqual(MealFood.objects.get(meal__user=self.user).food.name, 'Alimento 0-0')
+
+
+class RegenerateSectionTests(APITestCase):
+
+    def setUp(self):
+        generation_limiter.reset()
+        self.user = User.objects.create_user(email='testuser@example.com', password='testpass')
+        self.client.force_authenticate(self.user)
+        self.plan = sample_plan(days=3)
+        create_models_data(self.plan, self.user)
+
+    def regenerate(self, section, items, **data):
+        with mock.patch('ai.regenerate.generate_section', return_value=items) as generate:
+            response = self.client.post(
+                reverse('ai-regenerate-section', args=[section]), {'goal': 'Emagrecimento', **data}, format='json'
+            )
+        return response, generate
+
+    def test_unchanged_section_writes_nothing(self):
+        habit_ids = list(Habit.objects.values_list('id', flat=True))
+        response, generate = self.regenerate('diet', self.plan['diet'])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(generate.call_args[0][0], 'diet')
+        self.assertEqual((response.data['inserted'], response.data['updated'], response.data['deleted']), (0, 0, 0))
+        self.assertEqual(response.data['unchanged'], 9)
+        # reading the section, then nothing to write
+        self.assertLessEqual(response.data['metrics']['queries'], 3)
+        self.assertEqual(list(Habit.objects.values_list('id', flat=True)), habit_ids)
+
+    def test_diet_changes_are_applied_as_a_diff(self):
+        diet = json.loads(json.dumps(self.plan['diet']))
+        diet[0]['foods'][0]['servings'] = 2
+        diet[1]['foods'][2] = {"name": "Banana", "servings": 1, "calories": 105}
+        diet.append({"meal": "Ceia", "foods": [{"name": "Iogurte", "servings": 1, "calories": 100}]})
+        del diet[2]
+
+        untouched = MealFood.objects.get(food__name='Alimento 1.2').id
+        response, _ = self.regenerate('diet', diet)
+
+        self.assertEqual((response.data['inserted'], response.data['updated'], response.data['deleted']), (2, 1, 4))
+        self.assertEqual(MealFood.objects.get(food__name='Alimento 1.1').servings, 2)
+        self.assertTrue(MealFood.objects.filter(id=untouched).exists())
+        self.assertEqual(MealFood.objects.get(food__name='Banana').meal.name, 'Refeição 2')
+        self.assertEqual(
+            sorted(Meal.objects.filter(user=self.user).values_list('name', flat=True)),
+            ['Ceia', 'Refeição 1', 'Refeição 2']
+        )
+
+    def test_habits_diff_removes_duplicates_but_keeps_logged_habits(self):
+        # an earlier full regeneration saved the habits twice
+        create_models_data({'habits': self.plan['habits']}, self.user)
+        logged = Habit.objects.filter(name='Comer frutas diariamente').order_by('id').last()
+        HabitLog.objects.create(habit=logged, date=datetime.date.today(), amount=1)
+
+        habits = [
+            {"name": "Dormir bem", "goal": 7, "measure": "horas", "frequency": "daily"},
+            {"name": "Exercitar-se regularmente", "goal": 3, "measure": "dias por semana", "frequency": "weekly"},
+        ]
+        response, _ = self.regenerate('habits', habits)
+
+        self.assertEqual((response.data['inserted'], response.data['updated'], response.data['deleted']), (0, 2, 3))
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), 3)
+        self.assertTrue(Habit.objects.filter(id=logged.id).exists())
+        self.assertEqual(Habit.objects.get(name='Dormir bem').goal, 7)
+        self.assertEqual(list(Habit.objects.get(name='Exercitar-se regularmente').frequencies.values_list('name', flat=True)), ['weekly'])
+
+    def test_habits_diff_keeps_habits_the_user_created(self):
+        manual = Habit.objects.create(user=self.user, name='Meditar', goal=10, measure='minutos')
+
+        response, _ = self.regenerate('habits', self.plan['habits'][:1])
+
+        self.assertEqual(response.data['deleted'], len(self.plan['habits']) - 1)
+        self.assertTrue(Habit.objects.filter(id=manual.id).exists())
+        self.assertEqual(Habit.objects.filter(user=self.user, from_plan=True).count(), 1)
+
+    def test_exercises_update_in_the_current_routine(self):
+        exercises = json.loads(json.dumps(self.plan['exercises']))
+        exercises[0]['routine'][0]['weight'] = 40
+        exercises[2]['routine'].append({"exercise": "Prancha", "duration": 5})
+
+        response, _ = self.regenerate('exercises', exercises)
+
+        self.assertEqual((response.data['inserted'], response.data['updated'], response.data['deleted']), (1, 1, 0))
+        self.assertEqual(RoutineExercise.objects.get(exercise__name='Exercício 1 de Segunda-feira').weight_goal, 40)
+        self.assertEqual(RoutineExercise.objects.get(exercise__name='Prancha').day_of_week, 'wednesday')
+        self.assertEqual(RoutineExercise.objects.values('routine').distinct().count(), 1)
+
+    def test_diet_diff_keeps_foods_the_user_added(self):
+        dinner = Meal.objects.create(user=self.user, name='Jantar', date=datetime.date.today())
+        pizza = MealFood.objects.create(meal=dinner, food=Food.objects.create(name='Pizza', calories=800), servings=1)
+
+        response, _ = self.regenerate('diet', self.plan['diet'][:1])
+
+        self.assertEqual(response.data['deleted'], 6)
+        self.assertTrue(MealFood.objects.filter(id=pizza.id).exists())
+        self.assertTrue(Meal.objects.filter(id=dinner.id).exists())
+
+    def test_exercises_diff_keeps_exercises_the_user_added(self):
+        routine = RoutineExercise.objects.filter(routine__user=self.user).first().routine
+        manual = RoutineExercise.objects.create(
+            routine=routine, exercise=Exercise.objects.create(name='Natação', exercise_type='cardio'), day_of_week='friday', duration=30
+        )
+
+        response, _ = self.regenerate('exercises', self.plan['exercises'])
+
+        self.assertEqual((response.data['inserted'], response.data['deleted']), (0, 0))
+        self.assertTrue(RoutineExercise.objects.filter(id=manual.id).exists())
+
+    @override_settings(AI_PLAN_FORMAT='compact')
+    def test_instructions_send_the_current_section(self):
+        _, generate = self.regenerate('habits', self.plan['habits'], instructions='Dormir mais')
+
+        data = generate.call_args[0][1]
+        self.assertEqual(data['instructions'], 'Dormir mais')
+        self.assertEqual(data['current'][0][:3], ['Dormir bem', 8, 'horas'])
+
+    def test_unknown_section_and_failures(self):
+        response = self.client.post(reverse('ai-regenerate-section', args=['sleep']), {'goal': 'Emagrecimento'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        with mock.patch('ai.regenerate.generate_section', side_effect=OpenAIUnavailable('down')):
+            response = self.client.post(reverse('ai-regenerate-section', args=['diet']), {'goal': 'Emagrecimento'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(MealFood.objects.count(), 9)
+
+
+class PlanSchemaTests(TestCase):
+
+    def test_valid_plan_is_unchanged(self):
+        self.assertEqual(validate_plan(SAMPLE_PLAN), SAMPLE_PLAN)
+        self.assertEqual(validate_plan(build_plan()), build_plan())
+
+    def test_repairs_common_problems(self):
+        plan = {
+            "habits": [{"name": "Beber água", "goal": "2,5 litros", "measure": None, "frequency": "Daily"}],
+            "exercises": [
+                {"day": "segunda", "routine": {"exercise": "Corrida", "exercise_type": "cardio", "distance": "5 km"}},
+                {"day": "TERÇA-FEIRA", "routine": [{"exercise": "Supino", "weight": "30", "reps": "10-12"}]},
+                {"day": "sabado", "routine": [{"exercise": "Remada", "weight": 22.6}]},
+            ],
+            "diet": [{"meal": "Almoço", "foods": [{"name": "Arroz", "servings": "2", "calories": "130 kcal", "fat": ""}]}],
+        }
+        repaired = validate_plan(plan)
+
+        self.assertEqual(repaired['habits'], [{"name": "Beber água", "goal": 2.5, "frequency": "daily"}])
+        self.assertEqual([exercise['day'] for exercise in repaired['exercises']], ["Segunda-feira", "Terça-feira", "Sábado"])
+        self.assertEqual(repaired['exercises'][0]['routine'], [{"exercise": "Corrida", "exercise_type": "cardio", "distance": 5.0}])
+        self.assertEqual(repaired['exercises'][1]['routine'][0], {"exercise": "Supino", "weight": 30, "reps": 10})
+        self.assertEqual(repaired['exercises'][2]['routine'][0]['weight'], 23)
+        self.assertEqual(repaired['diet'][0]['foods'][0], {"name": "Arroz", "servings": 2.0, "calories": 130})
+
+    def test_reports_every_problem(self):
+        plan = {
+            "habits": [{"goal": "muito"}],
+            "exercises": [{"day": "Dia 1", "routine": [{"weight": 20}]}],
+        }
+        with self.assertRaises(PlanValidationError) as context:
+            validate_plan(plan)
+
+        self.assertEqual(context.exception.errors, [
+            "habits[0].name: required",
+            "habits[0].goal: expected a number, got 'muito'",
+            "exercises[0].day: unknown day 'Dia 1'",
+            "exercises[0].routine[0].exercise: required",
+            "diet: required",
+        ])
+
+    def test_rejects_wrong_types(self):
+        with self.assertRaises(PlanValidationError):
+            validate_section('diet', [{"meal": "Jantar", "foods": [{"name": "Ovo", "calories": -10}]}])
+        with self.assertRaises(PlanValidationError):
+            validate_section('habits', "dormir bem")
+        with self.assertRaises(PlanValidationError):
+            validate_section('habits', [{"name": {"pt": "Dormir"}, "goal": True}])
+
+    def test_validators_are_compiled_once(self):
+        self.assertIs(section_validator('diet'), section_validator('diet'))
+
+    @mock.patch('ai.utils.generate_sections')
+    def test_invalid_plan_is_not_cached(self, generate_sections):
+        generate_sections.return_value = dict(SAMPLE_PLAN, exercises=[{"day": "Segunda-feira", "routine": [{"sets": 3}]}])
+
+        self.assertIsNone(get_data({'goal': 'Emagrecimento'}))
+        self.assertEqual(AI_data.objects.count(), 0)
+
+    @mock.patch('ai.utils.generate_sections')
+    def test_repaired_plan_is_cached(self, generate_sections):
+        generate_sections.return_value = dict(SAMPLE_PLAN, habits=[{"name": "Dormir bem", "goal": "8", "measure": "horas"}])
+
+        self.assertEqual(get_data({'goal': 'Emagrecimento'})['habits'][0]['goal'], 8.0)
+        self.assertEqual(AI_data.objects.get().json_data['habits'][0]['goal'], 8.0)
+
+
+class PlanCacheTests(TestCase):
+
+    def setUp(self):
+        plan_lru.clear()
+        self.user = User.objects.create_user(
+            email='testuser@example.com', password='testpass',
+            weight=72.5, height=1.78, birth_date=datetime.date(1994, 1, 1)
+        )
+
+    def test_normalize_goal(self):
+        self.assertEqual(normalize_goal('  Perder   Peso!'), 'perder peso')
+        self.assertEqual(normalize_goal('Manutenção da saúde'), 'manutencao da saude')
+
+    def test_users_in_same_buckets_share_key(self):
+        other = User.objects.create_user(
+            email='other@example.com', password='testpass',
+            weight=78, height=1.71, birth_date=self.user.birth_date
+        )
+        self.assertEqual(
+            plan_cache_key('Emagrecimento', profile_buckets(self.user)),
+            plan_cache_key('emagrecimento ', profile_buckets(other))
+        )
+
+        other.weight = 95
+        self.assertNotEqual(
+            plan_cache_key('Emagrecimento', profile_buckets(self.user)),
+            plan_cache_key('Emagrecimento', profile_buckets(other))
+        )
+
+    def test_backfilled_keys_match_plan_cache_key(self):
+        migration = importlib.import_module('ai.migrations.0003_ai_data_cache_key')
+        for goal in ('Perder  Peso!', 'Ganhar massa muscular e melhorar o condicionamento ' * 5):
+            backfilled = f"v1:{migration.cache_key_goal(migration.normalize_goal(goal))}:-:-:-"
+            self.assertEqual(backfilled, plan_cache_key(goal, profile_buckets(), version=1))
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_generates_once_then_hits(self, generate):
+        self.assertEqual(get_data({'goal': 'Emagrecimento'}, self.user), SAMPLE_PLAN)
+        self.assertEqual(get_data({'goal': 'EMAGRECIMENTO'}, self.user), SAMPLE_PLAN)
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(AI_data.objects.count(), 1)
+
+        # the profile travels with the goal to the generator
+        self.assertEqual(generate.call_args[0][0]['profile']['weight'], '70-79 kg')
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_lookup_queries(self, generate):
+        get_data({'goal': 'Emagrecimento'}, self.user)
+
+        with self.assertNumQueries(0):
+            get_data({'goal': 'Emagrecimento'}, self.user)
+
+        plan_lru.clear()
+        with self.assertNumQueries(1):
+            get_data({'goal': 'Emagrecimento'}, self.user)
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=None)
+    def test_failed_generation_is_not_cached(self, generate):
+        self.assertIsNone(get_data({'goal': 'Emagrecimento'}, self.user))
+        self.assertEqual(AI_data.objects.count(), 0)
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_expired_plan_is_regenerated(self, generate):
+        get_data({'goal': 'Emagrecimento'}, self.user)
+        AI_data.objects.update(created_at=timezone.now() - datetime.timedelta(days=365))
+        plan_lru.clear()
+
+        get_data({'goal': 'Emagrecimento'}, self.user)
+        self.assertEqual(generate.call_count, 2)
+        self.assertEqual(AI_data.objects.count(), 1)
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_version_bump_invalidates(self, generate):
+        get_data({'goal': 'Emagrecimento'}, self.user)
+
+        with self.settings(AI_PLAN_CACHE_VERSION=2):
+            get_data({'goal': 'Emagrecimento'}, self.user)
+            self.assertEqual(generate.call_count, 2)
+            self.assertEqual(purge_expired_plans(), 1)
+            self.assertEqual(AI_data.objects.get().version, 2)
+
+    def test_lru_evicts_least_recently_used(self):
+        lru = PlanLRU(max_size=2)
+        lru.set('a', 1, 60)
+        lru.set('b', 2, 60)
+        lru.get('a')
+        lru.set('c', 3, 60)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('c'), 3)
+
+
+class GoalSimilarityTests(TestCase):
+
+    def setUp(self):
+        plan_lru.clear()
+        goal_index.clear()
+        self.buckets = {'weight': 70, 'height': 170, 'age': 30}
+        for goal in ('perder peso', 'Hipertrofia', 'correr uma maratona'):
+            store_plan(plan_cache_key(goal, self.buckets), goal, SAMPLE_PLAN)
+
+    def test_search_ranks_similar_goals(self):
+        results = goal_index.search('Perder peso rápido', self.buckets)
+        self.assertEqual(results[0][2], 'perder peso')
+        self.assertGreaterEqual(results[0][0], similarity_threshold())
+        self.assertLess(results[1][0], similarity_threshold())
+
+        # the goal's own key is not a candidate, and other profile buckets are never compared
+        self.assertNotIn('perder peso', [goal for _, _, goal in goal_index.search('perder peso', self.buckets)])
+        self.assertEqual(goal_index.search('perder peso', {**self.buckets, 'weight': 90}), [])
+
+    def test_goal_kind_brings_synonyms_closer(self):
+        score, _, goal = goal_index.search('Hipertrofia muscular', self.buckets)[0]
+        self.assertEqual(goal, 'hipertrofia')
+        self.assertGreater(score, goal_index.search('muscular', self.buckets)[0][0])
+
+    def test_index_follows_the_cache_without_queries(self):
+        goal_index.search('perder peso', self.buckets)
+        with self.assertNumQueries(0):
+            goal_index.search('perder peso rápido', self.buckets)
+
+        invalidate_plan(plan_cache_key('perder peso', self.buckets))
+        self.assertNotIn('perder peso', [goal for _, _, goal in goal_index.search('perder peso rápido', self.buckets)])
+
+    def test_plans_stored_by_other_processes_are_synced(self):
+        goal_index.search('perder peso', self.buckets)
+        AI_data.objects.create(goal='ganhar peso', cache_key=plan_cache_key('ganhar peso', self.buckets), json_data=SAMPLE_PLAN)
+
+        with mock.patch.object(GoalIndex, 'SYNC_SECONDS', 0):
+            results = goal_index.search('ganhar peso rápido', self.buckets)
+        self.assertEqual(results[0][2], 'ganhar peso')
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_similar_goal_reuses_the_plan(self, generate):
+        with collect() as metrics:
+            entry = get_plan_for_buckets({'goal': 'perder peso rápido'}, self.buckets)
+
+        self.assertEqual(entry.cache_key, plan_cache_key('perder peso', self.buckets))
+        generate.assert_not_called()
+        self.assertEqual(metrics.cache, 'similar')
+        self.assertGreaterEqual(metrics.similarity, similarity_threshold())
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_different_goal_is_generated(self, generate):
+        with collect() as metrics:
+            get_plan_for_buckets({'goal': 'dormir melhor'}, self.buckets)
+
+        generate.assert_called_once()
+        self.assertEqual(metrics.cache, 'miss')
+        self.assertLess(metrics.similarity, similarity_threshold())
+
+        # the new goal is in the index right away
+        self.assertEqual(goal_index.search('dormir melhor à noite', self.buckets)[0][2], 'dormir melhor')
+
+    @override_settings(AI_SIMILARITY_THRESHOLD=1.1)
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_threshold_above_one_disables_reuse(self, generate):
+        get_plan_for_buckets({'goal': 'perder peso rápido'}, self.buckets)
+        generate.assert_called_once()
+
+
+class SingleFlightTests(TransactionTestCase):
+    serialized_rollback = True
+
+    def setUp(self):
+        plan_lru.clear()
+
+    def test_concurrent_misses_generate_once(self):
+        def slow_generation(data):
+            time.sleep(0.5)
+            return SAMPLE_PLAN
+
+        results = []
+
+        def request_plan():
+            try:
+                results.append(get_data({'goal': 'Hipertrofia'}))
+            finally:
+                connection.close()
+
+        with mock.patch('ai.utils.generate_data_with_gpt', side_effect=slow_generation) as generate:
+            threads = [threading.Thread(target=request_plan) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(results, [SAMPLE_PLAN] * 5)
+        self.assertEqual(AI_data.objects.count(), 1)
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_lock_wait_timeout_does_not_generate(self, generate):
+        buckets = profile_buckets(None)
+        timed_out = mock.MagicMock()
+        timed_out.return_value.__enter__.return_value = False
+
+        with mock.patch('ai.utils.single_flight', timed_out):
+            self.assertIsNone(get_plan_for_buckets({'goal': 'Hipertrofia'}, buckets))
+
+            # the plan stored meanwhile by the lock holder is returned, even when asked to refresh
+            entry = store_plan(plan_cache_key('Hipertrofia', buckets), 'Hipertrofia', SAMPLE_PLAN)
+            plan_lru.clear()
+            self.assertEqual(get_plan_for_buckets({'goal': 'Hipertrofia'}, buckets, refresh=True), entry)
+
+        generate.assert_not_called()
+        self.assertEqual(AI_data.objects.count(), 1)
+
+    @mock.patch('ai.locks.get_redis')
+    def test_redis_errors_fall_back_to_advisory_lock(self, get_redis):
+        get_redis.return_value.lock.return_value.acquire.side_effect = redis.exceptions.TimeoutError
+        with single_flight('a', wait=0) as got_it:
+            self.assertTrue(got_it)
+
+    def test_lock_is_exclusive_per_key(self):
+        acquired = []
+
+        def try_lock(key):
+            try:
+                with single_flight(key, wait=0) as got_it:
+                    acquired.append((key, got_it))
+            finally:
+                connection.close()
+
+        with single_flight('a', wait=0) as got_it:
+            self.assertTrue(got_it)
+            for key in ('a', 'b'):
+                thread = threading.Thread(target=try_lock, args=(key,))
+                thread.start()
+                thread.join()
+
+        self.assertEqual(acquired, [('a', False), ('b', True)])
+
+
+class GenerateDataStreamTests(APITestCase):
+
+    def setUp(self):
+        plan_lru.clear()
+        generation_limiter.reset()
+        self.user = User.objects.create_user(email='testuser@example.com', password='testpass')
+        response = self.client.post(reverse('login'), {'email': 'testuser@example.com', 'password': 'testpass'})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        self.stream_url = reverse('ai-generate-data-stream')
+
+    def read_events(self, response):
+        body = b''.join(response.streaming_content).decode()
+        events = []
+        for block in body.strip().split('\n\n'):
+            event, data = block.split('\n')
+            events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+        return events
+
+    def test_stream_persists_sections_as_they_complete(self):
+        diet_released = threading.Event()
+
+        def fake_section(section, data):
+            if section == 'diet':
+                # the diet is still generating when the first section reaches the client
+                diet_released.wait(5)
+            return SAMPLE_PLAN[section]
+
+        with mock.patch('ai.sections.generate_section', side_effect=fake_section):
+            response = self.client.post(self.stream_url, {'goal': 'Emagrecimento'}, format='json')
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            content = iter(response.streaming_content)
+            first = next(content).decode()
+            saved_before_diet = Habit.objects.filter(user=self.user).count() + RoutineExercise.objects.filter(routine__user=self.user).count()
+            diet_released.set()
+            body = first + b''.join(content).decode()
+
+        events = [(block.split('\n')[0][len('event: '):], json.loads(block.split('\n')[1][len('data: '):])) for block in body.strip().split('\n\n')]
+        self.assertEqual([event for event, _ in events], ['section', 'section', 'section', 'done'])
+        self.assertIn(events[0][1]['section'], ['habits', 'exercises'])
+        self.assertEqual(events[2][1]['section'], 'diet')
+        self.assertEqual(saved_before_diet, 1)
+        self.assertEqual(MealFood.objects.filter(meal__user=self.user).count(), 1)
+        self.assertEqual(AI_data.objects.get().json_data, SAMPLE_PLAN)
+
+    def test_stream_uses_the_compact_section_prompts(self):
+        prompts = []
+
+        def respond(request):
+            system = request['messages'][0]['content']
+            prompts.append(system)
+            section = next(section for section, prompt in COMPACT_PROMPTS.items() if prompt == system)
+            return json.dumps(compact_section(section, SAMPLE_PLAN[section]), ensure_ascii=False)
+
+        breaker.reset()
+        with FakeOpenAIServer(respond) as server:
+            with mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'test', 'OPENAI_BASE_URL': server.base_url}):
+                events = self.read_events(self.client.post(self.stream_url, {'goal': 'Emagrecimento'}, format='json'))
+
+        self.assertEqual(events[-1], ('done', {'cached': False}))
+        self.assertEqual(sorted(prompts), sorted(COMPACT_PROMPTS.values()))
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), 1)
+
+    def test_stream_reports_pipeline_metrics(self):
+        with mock.patch('ai.sections.generate_section', side_effect=lambda section, data: SAMPLE_PLAN[section]), \
+                mock.patch('ai.metrics.publish') as publish:
+            self.read_events(self.client.post(self.stream_url, {'goal': 'Emagrecimento'}, format='json'))
+
+        metrics = publish.call_args.args[0].as_dict()
+        self.assertEqual(metrics['cache'], 'miss')
+        self.assertTrue({'cache_lookup', 'validate', 'persist', 'store'} <= set(metrics['stages_ms']))
+
+    def test_stream_replays_cached_plan(self):
+        store_plan(plan_cache_key('Emagrecimento', profile_buckets(self.user)), 'Emagrecimento', SAMPLE_PLAN)
+
+        with mock.patch('ai.sections.generate_section') as generate:
+            response = self.client.post(self.stream_url, {'goal': 'Emagrecimento'}, format='json')
+            events = self.read_events(response)
+
+        generate.assert_not_called()
+        self.assertEqual(events[-1], ('done', {'cached': True}))
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), 1)
+
+    def test_stream_rejects_invalid_section_before_saving(self):
+        plan = dict(SAMPLE_PLAN, habits=[{"name": "Dormir bem"}])
+
+        def fake_section(section, data):
+            if section != 'habits':
+                time.sleep(0.2)
+            return plan[section]
+
+        with mock.patch('ai.sections.generate_section', side_effect=fake_section):
+            response = self.client.post(self.stream_url, {'goal': 'Emagrecimento'}, format='json')
+            events = self.read_events(response)
+
+        self.assertEqual(events, [('error', {'detail': "GPT returned an invalid plan: habits[0].goal: required"})])
+        self.assertEqual(Habit.objects.count(), 0)
+        self.assertEqual(AI_data.objects.count(), 0)
+
+    def test_stream_reports_errors(self):
+        with mock.patch('ai.sections.generate_section', side_effect=ValueError('oops')):
+            response = self.client.post(self.stream_url, {'goal': 'Emagrecimento'}, format='json')
+            events = self.read_events(response)
+
+        self.assertEqual(events[-1], ('error', {'detail': 'oops'}))
+        self.assertEqual(AI_data.objects.count(), 0)
+
+
+class ConcurrencyLimiterTests(APITestCase):
+
+    def setUp(self):
+        plan_lru.clear()
+        generation_limiter.reset()
+        self.user = User.objects.create_user(email='testuser@example.com', password='testpass')
+        self.client.force_authenticate(self.user)
+        self.generate_url = reverse('ai-generate-data')
+
+    def test_global_and_user_limits(self):
+        limiter = ConcurrencyLimiter('test', global_limit=2, user_limit=1, timeout=60, retry_after=5)
+        first = limiter.acquire(1)
+        with self.assertRaises(LimitExceeded) as rejected:
+            limiter.acquire(1)
+        self.assertEqual((rejected.exception.scope, rejected.exception.retry_after), ('user', 5))
+
+        limiter.acquire(2)
+        with self.assertRaises(LimitExceeded) as rejected:
+            limiter.acquire(3)
+        self.assertEqual(rejected.exception.scope, 'global')
+        self.assertEqual(limiter.depth(), {'in_flight': 2, 'limit': 2, 'per_user_limit': 1})
+
+        limiter.release(first)
+        limiter.acquire(3)
+
+    def test_rejected_acquire_holds_no_slot(self):
+        limiter = ConcurrencyLimiter('test', global_limit=1, user_limit=1, timeout=60)
+        limiter.acquire(1)
+        with self.assertRaises(LimitExceeded):
+            limiter.acquire(1)
+        self.assertEqual(limiter.local.depth('ai:limiter:test:user:1', time.time()), 1)
+
+    def test_slots_expire(self):
+        limiter = ConcurrencyLimiter('test', global_limit=1, user_limit=1, timeout=0.05)
+        limiter.acquire(1)
+        time.sleep(0.06)
+        limiter.acquire(2)
+
+    def test_slot_context_releases(self):
+        limiter = ConcurrencyLimiter('test', global_limit=1, user_limit=0, timeout=60)
+        with self.assertRaises(RuntimeError), limiter.slot(1):
+            raise RuntimeError
+        with limiter.slot(1):
+            self.assertEqual(limiter.depth()['in_flight'], 1)
+        self.assertEqual(limiter.depth()['in_flight'], 0)
+
+    def test_tokens_name_their_backend(self):
+        limiter = ConcurrencyLimiter('test', global_limit=1, user_limit=1, timeout=60)
+        token = limiter.acquire(1)
+        self.assertEqual(token.split(':')[:2], ['1', 'local'])
+
+        # releasing a Redis slot leaves the local ones alone
+        limiter.release(f"1:redis:{token.split(':')[2]}")
+        self.assertEqual(limiter.depth()['in_flight'], 1)
+
+        # Redis slots go to the worker as they are, local ones are released by the process that took them
+        self.assertEqual(limiter.hand_off('1:redis:abc'), '1:redis:abc')
+        self.assertIsNone(limiter.hand_off(token))
+        self.assertEqual(limiter.depth()['in_flight'], 0)
+
+    @override_settings(AI_CONCURRENCY_LIMIT_PER_USER=1, AI_CONCURRENCY_RETRY_AFTER=7)
+    @mock.patch('ai.views.generate_plan_for_user.delay')
+    def test_user_over_limit_gets_429(self, delay):
+        with mock.patch('ai.sections.generate_section', side_effect=lambda section, data: SAMPLE_PLAN[section]):
+            # the stream holds the user's slot until it ends
+            stream = self.client.post(reverse('ai-generate-data-stream'), {'goal': 'Emagrecimento'}, format='json')
+
+            response = self.client.post(self.generate_url, {'goal': 'Hipertrofia'}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(response['Retry-After'], '7')
+            self.assertEqual(AIGenerationJob.objects.count(), 0)
+
+            b''.join(stream.streaming_content)
+        self.assertEqual(self.client.post(self.generate_url, {'goal': 'Hipertrofia'}, format='json').status_code, status.HTTP_202_ACCEPTED)
+
+    @override_settings(AI_CONCURRENCY_LIMIT_PER_USER=1)
+    @mock.patch('ai.views.generate_plan_for_user.delay')
+    def test_local_slots_are_not_handed_to_the_worker(self, delay):
+        # Redis is down in the tests: the worker runs in another process and could never release a local slot
+        response = self.client.post(self.generate_url, {'goal': 'Emagrecimento'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        delay.assert_called_once_with(response.data['job_id'], slot=None)
+        self.assertEqual(generation_limiter.depth()['in_flight'], 0)
+
+    @override_settings(AI_CONCURRENCY_LIMIT=1, AI_CONCURRENCY_LIMIT_PER_USER=0)
+    @mock.patch('ai.views.generate_plan_for_user.delay')
+    def test_saturated_service_gets_503(self, delay):
+        generation_limiter.acquire(0)
+        response = self.client.post(self.generate_url, {'goal': 'Emagrecimento'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.data['scope'], 'global')
+        self.assertIn('Retry-After', response)
+        delay.assert_not_called()
+
+        stream = self.client.post(reverse('ai-generate-data-stream'), {'goal': 'Emagrecimento'}, format='json')
+        self.assertEqual(stream.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    @override_settings(AI_CONCURRENCY_LIMIT=1)
+    @mock.patch('ai.views.generate_plan_for_user.delay')
+    def test_cached_plans_skip_the_limit(self, delay):
+        generation_limiter.acquire(0)
+        store_plan(plan_cache_key('Emagrecimento', profile_buckets(self.user)), 'Emagrecimento', SAMPLE_PLAN)
+        response = self.client.post(self.generate_url, {'goal': 'Emagrecimento'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        delay.assert_called_once_with(response.data['job_id'], slot=None)
+
+    @override_settings(AI_CONCURRENCY_LIMIT=1)
+    @mock.patch('ai.views.generate_plan_for_user.delay')
+    def test_draft_is_served_without_upgrade_under_load(self, delay):
+        generation_limiter.acquire(0)
+        response = self.client.post(self.generate_url, {'goal': 'Emagrecimento', 'draft': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['source'], AIGenerationJob.SOURCE_LOCAL)
+        self.assertNotIn('job_id', response.data)
+        self.assertIn('retry_after', response.data)
+        self.assertGreater(Habit.objects.filter(user=self.user).count(), 0)
+        delay.assert_not_called()
+
+    @override_settings(AI_CONCURRENCY_LIMIT=1, AI_CONCURRENCY_LIMIT_PER_USER=1)
+    def test_stream_releases_its_slot(self):
+        with mock.patch('ai.sections.generate_section', side_effect=lambda section, data: SAMPLE_PLAN[section]):
+            response = self.client.post(reverse('ai-generate-data-stream'), {'goal': 'Emagrecimento'}, format='json')
+            self.assertEqual(generation_limiter.depth()['in_flight'], 1)
+            b''.join(response.streaming_content)
+        self.assertEqual(generation_limiter.depth()['in_flight'], 0)
+
+    def test_metrics_report_queue_depth(self):
+        AIGenerationJob.objects.create(user=self.user, goal='Emagrecimento')
+        generation_limiter.acquire(self.user.id)
+        admin = User.objects.create_user(email='admin@example.com', password='testpass', is_staff=True)
+        self.client.force_authenticate(admin)
+
+        limiter = self.client.get(reverse('ai-metrics')).data['limiter']
+        self.assertEqual((limiter['in_flight'], limiter['queued'], limiter['running']), (1, 1, 0))
+
+
+class SectionGenerationTests(TestCase):
+
+    def setUp(self):
+        breaker.reset()
+        patcher = mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sections_are_generated_in_parallel_and_merged(self):
+        plan = sample_plan()
+        with FakeOpenAIServer(plan_responder(plan), latency=0.3) as server:
+            with mock.patch.dict(os.environ, {'OPENAI_BASE_URL': server.base_url}):
+                start = time.perf_counter()
+                result = generate_data_with_gpt({'goal': 'Emagrecimento'})
+                elapsed = time.perf_counter() - start
+
+        self.assertEqual(result, plan)
+        self.assertEqual(len(server.requests), 3)
+        # three 0.3s calls at the same time, not one after the other
+        self.assertLess(elapsed, 0.8)
+
+    def test_bare_list_answer_is_accepted(self):
+        plan = sample_plan()
+        with FakeOpenAIServer(lambda request: json.dumps(plan['habits'])) as server:
+            with mock.patch.dict(os.environ, {'OPENAI_BASE_URL': server.base_url}):
+                self.assertEqual(generate_section('habits', {'goal': 'Emagrecimento'}), plan['habits'])
+
+    @override_settings(AI_PLAN_FORMAT='json')
+    def test_invalid_section_fails_whole_plan(self):
+        plan = sample_plan()
+
+        def respond(request):
+            if '"diet"' in request['messages'][0]['content']:
+                return 'not json'
+            return plan_responder(plan)(request)
+
+        with FakeOpenAIServer(respond) as server:
+            with mock.patch.dict(os.environ, {'OPENAI_BASE_URL': server.base_url}):
+                self.assertIsNone(generate_data_with_gpt({'goal': 'Emagrecimento'}))
+
+
+class CompactFormatTests(TestCase):
+
+    def setUp(self):
+        breaker.reset()
+        patcher = mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_expand_positional_rows(self):
+        self.assertEqual(expand_section('habits', [["Dormir bem", 8, "horas"]]), [{"name": "Dormir bem", "goal": 8, "measure": "horas"}])
+        self.assertEqual(expand_section('exercises', [["seg", [["Supino", 3, 30, 12], ["Remada", 3]]]]), [
+            {"day": "seg", "routine": [
+                {"exercise": "Supino", "sets": 3, "weight": 30, "reps": 12},
+                {"exercise": "Remada", "sets": 3},
+            ]},
+        ])
+        self.assertEqual(expand_section('diet', [["Almoço", [["Arroz", 1, 130, 2.7, 28, 0.3]]]]), [
+            {"meal": "Almoço", "foods": [{"name": "Arroz", "servings": 1, "calories": 130, "protein": 2.7, "carbs": 28, "fat": 0.3}]},
+        ])
+
+    def test_compact_round_trip(self):
+        plan = sample_plan()
+        for section in ('habits', 'exercises', 'diet'):
+            self.assertEqual(expand_section(section, compact_section(section, plan[section])), plan[section])
+
+    def test_objects_are_passed_through(self):
+        self.assertEqual(expand_section('habits', [{"name": "Dormir bem", "goal": 8}]), [{"name": "Dormir bem", "goal": 8}])
+
+    def test_compact_generation_is_expanded_and_validated(self):
+        def respond(request):
+            system = request['messages'][0]['content']
+            self.assertIn(system, COMPACT_PROMPTS.values())
+            return {
+                COMPACT_PROMPTS['habits']: '[["Dormir bem","8","horas"]]',
+                COMPACT_PROMPTS['exercises']: '[["seg",[["Agachamento com barra",3,20,15]]]]',
+                COMPACT_PROMPTS['diet']: '[["Café da manhã",[["Aveia",1,150,5,27,3]]]]',
+            }[system]
+
+        with FakeOpenAIServer(respond) as server:
+            with mock.patch.dict(os.environ, {'OPENAI_BASE_URL': server.base_url}):
+                plan = generate_data_with_gpt({'goal': 'Emagrecimento'})
+
+        expected = json.loads(json.dumps(SAMPLE_PLAN))
+        del expected['exercises'][0]['routine'][0]['title']
+        self.assertEqual(plan, expected)
+
+    def test_compact_prompts_are_smaller(self):
+        with override_settings(AI_PLAN_FORMAT='json'):
+            verbose = sum(len(build_section_messages(section, {})[0]['content']) for section in COMPACT_PROMPTS)
+        compact = sum(len(build_section_messages(section, {})[0]['content']) for section in COMPACT_PROMPTS)
+        self.assertLess(compact, verbose * 0.6)
+
+
+@override_settings(OPENAI_BACKOFF_BASE=0.01, OPENAI_BACKOFF_MAX=0.05, OPENAI_MAX_RETRIES=2,
+                   OPENAI_CIRCUIT_FAILURE_THRESHOLD=2, OPENAI_CIRCUIT_RESET_TIMEOUT=0.2)
+class OpenAIClientTests(TestCase):
+    messages = [{"role": "user", "content": "oi"}]
+
+    def setUp(self):
+        breaker.reset()
+        self.addCleanup(breaker.reset)
+        patcher = mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def serve(self, **kwargs):
+        server = FakeOpenAIServer(lambda request: '{"ok": true}', **kwargs)
+        server.__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        patcher = mock.patch.dict(os.environ, {'OPENAI_BASE_URL': server.base_url})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return server
+
+    def test_client_is_reused(self):
+        self.serve()
+        self.assertIs(get_client(), get_client())
+
+    def test_retries_server_errors(self):
+        server = self.serve(failures=[503, 500])
+        completion = chat_completion(self.messages)
+        self.assertEqual(completion.choices[0].message.content, '{"ok": true}')
+        self.assertEqual(len(server.requests), 3)
+
+    def test_retries_rate_limits_and_dropped_connections(self):
+        server = self.serve(failures=[429, 'drop'])
+        chat_completion(self.messages)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_client_errors_are_not_retried(self):
+        server = self.serve(failures=[400])
+        with self.assertRaises(BadRequestError):
+            chat_completion(self.messages)
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @override_settings(OPENAI_READ_TIMEOUT=0.2, OPENAI_MAX_RETRIES=0)
+    def test_read_timeout(self):
+        self.serve(failures=['hang'], hang_seconds=2)
+        start = time.perf_counter()
+        with self.assertRaises(OpenAIUnavailable):
+            chat_completion(self.messages)
+        self.assertLess(time.perf_counter() - start, 1.5)
+
+    def test_circuit_opens_and_recovers(self):
+        server = self.serve(failures=[503] * 6)
+
+        for _ in range(2):
+            with self.assertRaises(OpenAIUnavailable):
+                chat_completion(self.messages)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        # open: fails fast without reaching the server
+        with self.assertRaises(CircuitOpenError):
+            chat_completion(self.messages)
+        self.assertEqual(len(server.requests), 6)
+
+        time.sleep(0.25)
+        chat_completion(self.messages)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_trial_reopens_circuit(self):
+        self.serve(failures=[503] * 9)
+        for _ in range(2):
+            with self.assertRaises(OpenAIUnavailable):
+                chat_completion(self.messages)
+
+        time.sleep(0.25)
+        with self.assertRaises(OpenAIUnavailable):
+            chat_completion(self.messages)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_generation_returns_none_when_unavailable(self):
+        self.serve(failures=[503] * 9)
+        self.assertIsNone(generate_data_with_gpt({'goal': 'Emagrecimento'}))
+
+
+class WarmAIPlansTests(TestCase):
+
+    def setUp(self):
+        plan_lru.clear()
+        goal_index.clear()
+        UserGoals.objects.all().delete()
+        self.goal = UserGoals.objects.create(title='Emagrecimento')
+        self.other_goal = UserGoals.objects.create(title='Hipertrofia')
+        User.objects.create_user(email='a@example.com', password='testpass', goal=self.goal, weight=72, height=1.75)
+        User.objects.create_user(email='b@example.com', password='testpass', goal=self.goal, weight=75, height=1.78)
+        User.objects.create_user(email='c@example.com', password='testpass', goal=self.goal, weight=101, height=1.80)
+
+    def warm(self, *args):
+        out = StringIO()
+        call_command('warm_ai_plans', '--concurrency', '1', '--max-per-minute', '0', *args, stdout=out)
+        return out.getvalue()
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_warms_goals_and_profile_buckets(self, generate):
+        output = self.warm()
+
+        # unknown profile for both goals, plus the two buckets of the 'Emagrecimento' users
+        self.assertEqual(generate.call_count, 4)
+        self.assertEqual(set(AI_data.objects.values_list('cache_key', flat=True)), {
+            'v1:emagrecimento:-:-:-',
+            'v1:emagrecimento:70:170:-',
+            'v1:emagrecimento:100:180:-',
+            'v1:hipertrofia:-:-:-',
+        })
+        self.assertIn('[4/4]', output)
+        self.assertIn('4 generated, 0 already cached, 0 failed', output)
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_only_missing_or_stale_plans_are_generated(self, generate):
+        self.warm('--goal', 'Hipertrofia')
+        AI_data.objects.update(created_at=timezone.now() - datetime.timedelta(days=365))
+        plan_lru.clear()
+
+        output = self.warm()
+        self.assertEqual(generate.call_count, 5)
+        self.assertIn('4 generated, 0 already cached', output)
+
+        output = self.warm()
+        self.assertEqual(generate.call_count, 5)
+        self.assertIn('0 generated, 4 already cached', output)
+
+        self.warm('--force', '--goal', 'Hipertrofia')
+        self.assertEqual(generate.call_count, 6)
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_plans_of_similar_goals_are_not_counted_as_generated(self, generate):
+        store_plan(plan_cache_key('Emagrecimento rápido', {}), 'Emagrecimento rápido', SAMPLE_PLAN)
+
+        output = self.warm('--goal', 'Emagrecimento')
+
+        self.assertEqual(generate.call_count, 2)
+        self.assertIn('2 generated, 0 already cached, 0 failed, 1 served by a similar goal', output)
+        self.assertIn('v1:emagrecimento:-:-:-: similar', output)
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=None)
+    def test_reports_failures(self, generate):
+        output = self.warm('--goal', 'Hipertrofia')
+        self.assertIn('1 failed', output)
+        self.assertEqual(AI_data.objects.count(), 0)
+
+    def test_rate_limiter_spaces_calls(self):
+        limiter = RateLimiter(per_minute=600)
+        start = time.perf_counter()
+        for _ in range(4):
+            limiter.wait()
+        self.assertGreaterEqual(time.perf_counter() - start, 0.29)
+
+
+class WarmAIPlansConcurrencyTests(TransactionTestCase):
+    serialized_rollback = True
+
+    def setUp(self):
+        plan_lru.clear()
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_thread_pool(self, generate):
+        UserGoals.objects.create(title='Corrida')
+        out = StringIO()
+        call_command('warm_ai_plans', '--concurrency', '3', '--max-per-minute', '0', stdout=out)
+
+        titles = UserGoals.objects.count()
+        self.assertEqual(generate.call_count, titles)
+        self.assertEqual(AI_data.objects.count(), titles)
+
+
+class BatchOnboardingTests(APITestCase):
+
+    def setUp(self):
+        plan_lru.clear()
+        generation_limiter.reset()
+        self.goal = UserGoals.objects.create(title='Emagrecimento')
+        # three users in the same bands, one in other bands, one without a goal
+        self.users = [
+            User.objects.create_user(email=f'user{i}@example.com', password='testpass', goal=self.goal, weight=72 + i, height=1.75)
+            for i in range(3)
+        ]
+        self.users.append(User.objects.create_user(email='heavy@example.com', password='testpass', goal=self.goal, weight=101, height=1.80))
+        self.no_goal = User.objects.create_user(email='nogoal@example.com', password='testpass')
+
+    def onboard(self, users, **kwargs):
+        jobs, _ = create_jobs(users)
+        return onboard_jobs(jobs, concurrency=1, max_per_minute=0, **kwargs)
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_each_distinct_plan_is_generated_once(self, generate):
+        report = self.onboard(self.users)
+
+        self.assertEqual(generate.call_count, 2)
+        self.assertEqual([row['status'] for row in report], ['done'] * 4)
+        self.assertEqual(len({row['cache_key'] for row in report}), 2)
+        for user in self.users:
+            self.assertEqual(Habit.objects.filter(user=user).count(), len(SAMPLE_PLAN['habits']))
+            self.assertEqual(MealFood.objects.filter(meal__user=user).count(), 1)
+        self.assertEqual(AIGenerationJob.objects.filter(status=AIGenerationJob.STATUS_DONE, source='ai').count(), 4)
+
+        # a second batch only reads the cache
+        report = self.onboard(self.users[:1])
+        self.assertEqual(generate.call_count, 2)
+        self.assertEqual(report[0]['cache'], 'hit')
+
+    def test_bulk_apply_queries_do_not_grow_with_users(self):
+        entry = store_plan('batch', 'Emagrecimento', sample_plan())
+        template = get_template(entry)
+
+        created, one_user = apply_template_to_users(template, self.users[:1])
+        created, all_users = apply_template_to_users(template, self.users)
+
+        self.assertEqual(one_user, all_users)
+        self.assertEqual(set(created), {user.id for user in self.users})
+        for user in self.users:
+            # every id belongs to its user
+            self.assertEqual(Habit.objects.filter(user=user, id__in=created[user.id]['habits']).count(), 3)
+            self.assertEqual(RoutineExercise.objects.filter(routine__user=user, id__in=created[user.id]['routine_exercises']).count(), 21)
+            self.assertEqual(MealFood.objects.filter(meal__user=user, id__in=created[user.id]['meal_foods']).count(), 9)
+        # the users of the first call reused their routine and meals of the day
+        self.assertEqual(Routine.objects.filter(user=self.users[0]).count(), 1)
+        self.assertEqual(Meal.objects.filter(user=self.users[0]).count(), 3)
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=None)
+    def test_failed_generation_falls_back_to_one_local_plan_per_group(self, generate):
+        report = self.onboard(self.users[:3])
+
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual({row['source'] for row in report}, {'local'})
+        self.assertTrue(all(Habit.objects.filter(user=user).exists() for user in self.users[:3]))
+
+        with override_settings(AI_LOCAL_FALLBACK=False):
+            report = self.onboard(self.users[3:])
+        self.assertEqual(report[0]['status'], 'failed')
+        self.assertEqual(AIGenerationJob.objects.get(id=report[0]['job_id']).error, 'Error generating data')
+
+    def test_generations_hold_a_generation_slot(self):
+        in_flight = []
+
+        def generate(data):
+            in_flight.append(generation_limiter.depth()['in_flight'])
+            return SAMPLE_PLAN
+
+        with mock.patch('ai.utils.generate_data_with_gpt', side_effect=generate):
+            self.onboard(self.users)
+        self.assertEqual(in_flight, [1, 1])
+        self.assertEqual(generation_limiter.depth()['in_flight'], 0)
+
+        # cached plans take no slot, even when the limiter is full
+        with override_settings(AI_CONCURRENCY_LIMIT=1):
+            slot = generation_limiter.acquire(self.no_goal.id)
+            report = self.onboard(self.users[:1])
+            generation_limiter.release(slot)
+        self.assertEqual(report[0]['cache'], 'hit')
+
+    @mock.patch('ai.batch.SLOT_POLL_SECONDS', 0.01)
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_full_limiter_is_waited_on(self, generate):
+        with override_settings(AI_CONCURRENCY_LIMIT=1):
+            slot = generation_limiter.acquire(self.no_goal.id)
+            release = threading.Timer(0.2, generation_limiter.release, [slot])
+            release.start()
+            start = time.monotonic()
+            report = self.onboard(self.users[:1])
+            release.join()
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(report[0]['status'], 'done')
+        self.assertEqual(generate.call_count, 1)
+
+    def test_identifiers_that_are_not_ids_are_not_found(self):
+        identifiers = ['²', '99999999999999999999', -1, str(self.users[0].id), self.users[1].email.upper()]
+        users, missing = resolve_users(identifiers)
+        self.assertEqual(users, self.users[:2])
+        self.assertEqual(missing, identifiers[:3])
+
+    @mock.patch('ai.views.onboard_users.delay')
+    def test_batch_endpoint_creates_one_job_per_user(self, delay):
+        admin = User.objects.create_user(email='admin@example.com', password='testpass', is_staff=True)
+        self.client.force_authenticate(admin)
+        users = [self.users[0].id, 'USER1@example.com', self.no_goal.email, 'missing@example.com']
+
+        response = self.client.post(reverse('ai-generate-data-batch'), {'users': users}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual([job['user_id'] for job in response.data['jobs']], [self.users[0].id, self.users[1].id])
+        self.assertEqual(response.data['skipped'][0]['user_id'], self.no_goal.id)
+        self.assertEqual(response.data['not_found'], ['missing@example.com'])
+        delay.assert_called_once_with([job['job_id'] for job in response.data['jobs']])
+
+        # the admin can follow the jobs of the batch
+        job_id = response.data['jobs'][0]['job_id']
+        self.assertEqual(self.client.get(reverse('ai-job-status', args=[job_id])).status_code, status.HTTP_200_OK)
+
+    def test_batch_endpoint_is_for_admins(self):
+        self.client.force_authenticate(self.users[0])
+        response = self.client.post(reverse('ai-generate-data-batch'), {'users': [self.users[0].id]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_command_reports_every_user(self, generate):
+        out = StringIO()
+        call_command(
+            'onboard_users', *[user.email for user in self.users], self.no_goal.email, 'missing@example.com',
+            '--concurrency', '1', '--max-per-minute', '0', '--json', stdout=out
+        )
+        report = json.loads(out.getvalue())
+
+        self.assertEqual([row['status'] for row in report], ['done'] * 4 + ['skipped', 'not_found'])
+        self.assertEqual(generate.call_count, 2)
+
+
+class BatchOnboardingConcurrencyTests(TransactionTestCase):
+    serialized_rollback = True
+
+    def setUp(self):
+        plan_lru.clear()
+
+    @mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN)
+    def test_thread_pool(self, generate):
+        users = [
+            User.objects.create_user(email=f'user{i}@example.com', password='testpass', weight=50 + i * 10)
+            for i in range(6)
+        ]
+        jobs, _ = create_jobs(users, goal='Emagrecimento')
+        report = onboard_jobs(jobs, concurrency=3, max_per_minute=0)
+
+        self.assertEqual(generate.call_count, 6)
+        self.assertEqual([row['status'] for row in report], ['done'] * 6)
+        self.assertEqual(Habit.objects.count(), 6 * len(SAMPLE_PLAN['habits']))
+
+
+class PipelineMetricsTests(APITestCase):
+
+    def setUp(self):
+        plan_lru.clear()
+        breaker.reset()
+        patcher = mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(email='testuser@example.com', password='testpass')
+
+    def test_generation_records_stages_tokens_and_ttft(self):
+        with FakeOpenAIServer(plan_responder(sample_plan()), latency=0.05) as server:
+            with mock.patch.dict(os.environ, {'OPENAI_BASE_URL': server.base_url}), collect() as metrics:
+                get_data({'goal': 'Emagrecimento'})
+
+        data = metrics.as_dict()
+        self.assertEqual(data['cache'], 'miss')
+        self.assertEqual(sorted(call['section'] for call in data['openai_calls']), ['diet', 'exercises', 'habits'])
+        self.assertTrue(all(call['total_ms'] >= call['ttft_ms'] >= 50 for call in data['openai_calls']))
+        self.assertEqual(data['ttft_ms'], min(call['ttft_ms'] for call in data['openai_calls']))
+        self.assertGreater(data['prompt_tokens'], 0)
+        self.assertGreater(data['completion_tokens'], 0)
+        self.assertGreater(data['cost_usd'], 0)
+        for name in ('cache_lookup', 'lock_wait', 'generation', 'parse', 'validate', 'store'):
+            self.assertIn(name, data['stages_ms'])
+        self.assertGreaterEqual(data['total_ms'], data['stages_ms']['generation'])
+
+    def test_recording_outside_a_run_is_a_noop(self):
+        with mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN):
+            self.assertEqual(get_data({'goal': 'Emagrecimento'}), SAMPLE_PLAN)
+
+    def test_job_records_metrics(self):
+        store_plan(plan_cache_key('Emagrecimento', profile_buckets(self.user)), 'Emagrecimento', SAMPLE_PLAN)
+        job = AIGenerationJob.objects.create(user=self.user, goal='Emagrecimento', payload={'goal': 'Emagrecimento'})
+        generate_plan_for_user(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.metrics['cache'], 'hit')
+        self.assertIn('persist', job.metrics['stages_ms'])
+        self.assertGreater(job.metrics['queries'], 0)
+        self.assertEqual(job.metrics['openai_calls'], [])
+
+    @mock.patch('ai.metrics.get_redis')
+    def test_runs_are_counted_in_redis(self, get_redis):
+        with mock.patch('ai.utils.generate_data_with_gpt', return_value=SAMPLE_PLAN), collect():
+            get_data({'goal': 'Emagrecimento'})
+
+        pipeline = get_redis.return_value.pipeline.return_value
+        pipeline.hincrby.assert_any_call('ai:metrics:counters', 'runs', 1)
+        pipeline.hincrby.assert_any_call('ai:metrics:counters', 'cache_miss', 1)
+        pipeline.execute.assert_called_once()
+
+    def test_percentile(self):
+        self.assertEqual(percentile([], 0.95), None)
+        self.assertEqual(percentile([5], 0.95), 5)
+        self.assertEqual(percentile(list(range(1, 101)), 0.5), 50.5)
+        self.assertAlmostEqual(percentile(list(range(1, 101)), 0.95), 95.05)
+
+    def test_metrics_endpoint(self):
+        for total_ms, cache in ((100, 'hit'), (200, 'hit'), (150, 'similar'), (3000, 'miss')):
+            AIGenerationJob.objects.create(user=self.user, goal='Emagrecimento', status=AIGenerationJob.STATUS_DONE, metrics={
+                'total_ms': total_ms, 'cache': cache, 'stages_ms': {'persist': 10},
+                'ttft_ms': 500 if cache == 'miss' else None,
+                'prompt_tokens': 1000 if cache == 'miss' else 0, 'completion_tokens': 500 if cache == 'miss' else 0,
+                'cost_usd': 0.06 if cache == 'miss' else 0,
+                'similarity': 0.9 if cache == 'similar' else 0.2 if cache == 'miss' else None,
+            })
+        AIGenerationJob.objects.create(user=self.user, goal='Emagrecimento', status=AIGenerationJob.STATUS_FAILED)
+
+        admin = User.objects.create_user(email='admin@example.com', password='testpass', is_staff=True)
+        self.client.force_authenticate(admin)
+        response = self.client.get(reverse('ai-metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['jobs'], {'queued': 0, 'running': 0, 'done': 4, 'failed': 1})
+        self.assertEqual(response.data['pipeline_ms']['p50'], 175)
+        self.assertEqual(response.data['ttft_ms']['count'], 1)
+        self.assertEqual(response.data['cache']['hit_rate'], 3 / 4)
+        self.assertEqual(response.data['similarity']['hit_rate'], 1 / 2)
+        self.assertEqual(response.data['similarity']['best_score']['count'], 2)
+        self.assertEqual(response.data['tokens'], {'prompt': 1000, 'completion': 500})
+        self.assertEqual(response.data['cost_usd']['per_generated_plan'], 0.06)
+        self.assertEqual(response.data['stages_ms']['persist']['count'], 4)
+
+    def test_metrics_endpoint_is_for_admins(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get(reverse('ai-metrics')).status_code, status.HTTP_403_FORBIDDEN)
@@ -1,5 +1,10 @@
-from django.urls import path 
-from .views import GenerateData
+from django.urls import path
+from .views import AIMetrics, GenerateData, GenerateDataBatch, GenerateDataStream, GenerationJobStatus, RegenerateSection
 urlpatterns = [
-    path('generate-data/', GenerateData.as_view(), name="ai-generate-data")
+    path('generate-data/', GenerateData.as_view(), name="ai-generate-data"),
+    path('generate-data/batch/', GenerateDataBatch.as_view(), name="ai-generate-data-batch"),
+    path('generate-data/stream/', GenerateDataStream.as_view(), name="ai-generate-data-stream"),
+    path('plan/<str:section>/regenerate/', RegenerateSection.as_view(), name="ai-regenerate-section"),
+    path('jobs/<int:pk>/', GenerationJobStatus.as_view(), name="ai-job-status"),
+    path('metrics/', AIMetrics.as_view(), name="ai-metrics"),
 ]
@@ -1,269 +1,335 @@
-from openai import OpenAI
-
+from openai import OpenAIError
 from habits.models import Habit, HabitLog, Frequency
+from habits.rollup import refresh_daily_totals
 from exercises.models import Routine, RoutineExercise, Exercise
 from diets.models import Meal, Food, MealFood
 from django.core.exceptions import ValidationError
+from django.db import connection, transaction
 from datetime import date
-import os 
+import logging
+import time
 from dotenv import load_dotenv
-from .models import AI_data
-import json 
+from .cache import describe_profile, lookup_plan, plan_cache_key, profile_buckets, store_plan
+from .locks import single_flight
+from .metrics import record_cache, record_counter, record_similarity, record_time, stage
+from .openai_client import OpenAIUnavailable
+from .schema import DAY_MAPPING, validate_plan
+from .sections import generate_sections
+from .similarity import find_similar_plan
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
-# Mapping for Portuguese to English day names
-DAY_MAPPING = {
-    "Segunda-feira": "monday",
-    "Terça-feira": "tuesday",
-    "Quarta-feira": "wednesday",
-    "Quinta-feira": "thursday",
-    "Sexta-feira": "friday",
-    "Sábado": "saturday",
-    "Domingo": "sunday"
-}
 
-def create_models_data(gpt_data, user):
-    # Handle Habits
-    habits = gpt_data.get('habits', [])
-    for habit_data in habits:
-        # Fetch or create frequency objects
-        frequencies = Frequency.objects.filter(name__in=[habit_data.get('frequency', 'daily')])
+class QueryCounter:
+    """
+    Description: execute wrapper that counts the queries run on a connection while it is installed.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def resolve_frequencies(names):
+    """
+    Description: Frequency rows by name, loaded in one query. Unknown names are a ValidationError.
+    """
+    frequencies = {frequency.name: frequency for frequency in Frequency.objects.filter(name__in=names)}
+
+    missing = set(names) - set(frequencies)
+    if missing:
+        raise ValidationError(f"Invalid frequency: {', '.join(sorted(str(name) for name in missing))}")
+    return frequencies
+
+
+def resolve_exercises(keys):
+    """
+    Description: Exercise rows by (name, exercise_type), resolved against the catalog in one query.
+    The missing ones are created in bulk.
+    """
+    catalog = {}
+    for exercise in Exercise.objects.filter(name__in={name for name, _ in keys}).order_by('id'):
+        catalog.setdefault((exercise.name, exercise.exercise_type), exercise)
+
+    missing = [key for key in dict.fromkeys(keys) if key not in catalog]
+    if missing:
+        for exercise in Exercise.objects.bulk_create([Exercise(name=name, exercise_type=exercise_type) for name, exercise_type in missing]):
+            catalog[(exercise.name, exercise.exercise_type)] = exercise
+    return catalog
+
+
+def resolve_foods(food_items):
+    """
+    Description: Food rows by name, loaded in one query. The missing ones are created in bulk, the first
+    occurrence in the plan provides the nutrition defaults.
+    """
+    foods = {}
+    for food in Food.objects.filter(name__in={food_item['name'] for food_item in food_items}).order_by('id'):
+        foods.setdefault(food.name, food)
+
+    new_foods = {}
+    for food_item in food_items:
+        if food_item['name'] not in foods and food_item['name'] not in new_foods:
+            new_foods[food_item['name']] = Food(
+                name=food_item['name'],  # Name of the food in Portuguese
+                calories=food_item.get('calories', 0),
+                protein=food_item.get('protein', 0),
+                carbs=food_item.get('carbs', 0),
+                fat=food_item.get('fat', 0)
+            )
+    if new_foods:
+        for food in Food.objects.bulk_create(list(new_foods.values())):
+            foods[food.name] = food
+    return foods
+
+
+def _create_habits(habits, user):
+    if not habits:
+        return []
 
-        if not frequencies.exists():
-            raise ValidationError(f"Invalid frequency: {habit_data.get('frequency')}")
+    # Load every frequency referenced by the plan at once
+    frequencies = resolve_frequencies({habit_data.get('frequency', 'daily') for habit_data in habits})
 
-        # Create habit entry with name and measure in Portuguese
-        habit = Habit.objects.create(
+    # Create habit entries with name and measure in Portuguese
+    created = Habit.objects.bulk_create([
+        Habit(
             user=user,
             name=habit_data['name'],  # Name in Portuguese
             goal=habit_data['goal'],
-            measure=habit_data.get('measure', 'steps')  # Measure in Portuguese
+            measure=habit_data.get('measure', 'steps'),  # Measure in Portuguese
+            from_plan=True
         )
-        habit.frequencies.set(frequencies)
-
-        # Optionally create logs for habits if provided
-        if 'logs' in habit_data:
-            for log in habit_data['logs']:
-                HabitLog.objects.create(
-                    habit=habit,
-                    date=log['date'],
-                    amount=log['amount']
-                )
-
-    # Handle Exercise Routines
-    exercises = gpt_data.get('exercises', [])
+        for habit_data in habits
+    ])
+
+    HabitFrequency = Habit.frequencies.through
+    HabitFrequency.objects.bulk_create([
+        HabitFrequency(habit_id=habit.id, frequency_id=frequencies[habit_data.get('frequency', 'daily')].id)
+        for habit, habit_data in zip(created, habits)
+    ])
+
+    # Optionally create logs for habits if provided
+    logs = [
+        HabitLog(habit=habit, date=log['date'], amount=log['amount'])
+        for habit, habit_data in zip(created, habits)
+        for log in habit_data.get('logs', [])
+    ]
+    if logs:
+        HabitLog.objects.bulk_create(logs)
+        # bulk_create sends no signals, the daily rollup of the logged days is refreshed here
+        refresh_daily_totals({(log.habit_id, log.date) for log in logs})
+
+    return [habit.id for habit in created]
+
+
+def _create_routine_exercises(exercises, user):
+    if not exercises:
+        return []
+
+    # Create or get one routine per week start date (usually just today)
+    routines = {}
+    for exercise_data in exercises:
+        week_start_date = exercise_data.get('week_start_date', date.today())  # Default to today's date if missing
+        if week_start_date not in routines:
+            routines[week_start_date], _ = Routine.objects.get_or_create(user=user, week_start_date=week_start_date)
+
+    # Resolve every (name, type) pair against the catalog in one query, creating the missing ones in bulk
+    catalog = resolve_exercises([
+        (routine_data['exercise'], routine_data.get('exercise_type', 'gym'))  # Default to 'gym' if missing
+        for exercise_data in exercises
+        for routine_data in exercise_data['routine']
+    ])
+
+    routine_exercises = []
     for exercise_data in exercises:
         # Translate Portuguese day to English
         english_day = DAY_MAPPING.get(exercise_data['day'], exercise_data['day'])
+        routine = routines[exercise_data.get('week_start_date', date.today())]
 
-        # Create or get the routine
-        routine, _ = Routine.objects.get_or_create(
-            user=user,
-            week_start_date=exercise_data.get('week_start_date', date.today())  # Default to today's date if missing
-        )
-        
-        # Loop through each exercise in the routine
         for routine_data in exercise_data['routine']:
-            # Create or get the exercise in Portuguese (but internally stored in English for titles)
-            exercise, _ = Exercise.objects.get_or_create(
-                name=routine_data['exercise'],  # Name in Portuguese
-                exercise_type=routine_data.get('exercise_type', 'gym')  # Default to 'gym' if missing
-            )
-            
-            # Create RoutineExercise entry with the translated day
-            RoutineExercise.objects.create(
+            routine_exercises.append(RoutineExercise(
                 routine=routine,
-                exercise=exercise,
+                exercise=catalog[(routine_data['exercise'], routine_data.get('exercise_type', 'gym'))],
                 day_of_week=english_day,  # Store the English day in the model
-                weight_goal=routine_data.get('weight') ,
+                weight_goal=routine_data.get('weight'),
                 reps_goal=routine_data.get('reps'),
                 duration=routine_data.get('duration'),
                 distance=routine_data.get('distance'),
                 pace=routine_data.get('pace'),
-                average_velocity=routine_data.get('average_velocity')
-            )
+                average_velocity=routine_data.get('average_velocity'),
+                from_plan=True
+            ))
 
-    # Handle Diet
-    diets = gpt_data.get('diet', [])
-    for diet_data in diets:
-        # Create or get the meal in Portuguese
-        meal, _ = Meal.objects.get_or_create(
-            user=user,
-            name=diet_data['meal'],  # Name of the meal in Portuguese
-            date=date.today()  # Assuming you are using today's date
+    return [routine_exercise.id for routine_exercise in RoutineExercise.objects.bulk_create(routine_exercises)]
+
+
+def _create_meal_foods(diets, user):
+    if not diets:
+        return []
+
+    today = date.today()  # Assuming you are using today's date
+
+    # Reuse today's meals with the same name, create the rest in bulk
+    meal_names = [diet_data['meal'] for diet_data in diets]
+    meals = {}
+    for meal in Meal.objects.filter(user=user, date=today, name__in=meal_names).order_by('id'):
+        meals.setdefault(meal.name, meal)
+
+    missing = [name for name in dict.fromkeys(meal_names) if name not in meals]
+    if missing:
+        for meal in Meal.objects.bulk_create([Meal(user=user, name=name, date=today) for name in missing]):
+            meals[meal.name] = meal
+
+    # Same for foods, keyed by name
+    foods = resolve_foods([food_item for diet_data in diets for food_item in diet_data.get('foods', [])])
+
+    # Add the foods to the meals with servings
+    meal_foods = [
+        MealFood(
+            meal=meals[diet_data['meal']],
+            food=foods[food_item['name']],
+            servings=food_item.get('servings', 1),  # Default servings to 1 if not provided
+            from_plan=True
         )
-        
-        # Add food items to the meal
-        for food_item in diet_data.get('foods', []):
-            food, _ = Food.objects.get_or_create(
-                name=food_item['name'],  # Name of the food in Portuguese
-                defaults={
-                    'calories': food_item.get('calories', 0),
-                    'protein': food_item.get('protein', 0),
-                    'carbs': food_item.get('carbs', 0),
-                    'fat': food_item.get('fat', 0)
-                }
-            )
-            # Add the food to the meal with servings
-            MealFood.objects.create(
-                meal=meal,
-                food=food,
-                servings=food_item.get('servings', 1)  # Default servings to 1 if not provided
-            )
+        for diet_data in diets
+        for food_item in diet_data.get('foods', [])
+    ]
+
+    return [meal_food.id for meal_food in MealFood.objects.bulk_create(meal_foods)]
+
+
+def create_models_data(gpt_data, user):
+    """
+    Description: save a generated plan for the user. Catalog lookups are preloaded, every row is written
+    with bulk_create and the whole plan is saved in a single transaction, so a failure leaves nothing behind.
+
+    Returns the ids of the created habits, routine exercises and meal foods, plus the number of queries run.
+    """
+    counter = QueryCounter()
+
+    with connection.execute_wrapper(counter), transaction.atomic():
+        result = {
+            'habits': _create_habits(gpt_data.get('habits', []), user),
+            'routine_exercises': _create_routine_exercises(gpt_data.get('exercises', []), user),
+            'meal_foods': _create_meal_foods(gpt_data.get('diet', []), user),
+        }
+
+    result['queries'] = counter.count
+    return result
+
+def discard_plan_rows(created):
+    """
+    Description: delete the rows of a plan saved earlier (the result of create_models_data), e.g. a draft
+    replaced by the AI plan. Habits the user already logged are kept, and so are meals with other foods.
+    """
+    if not created:
+        return
+
+    Habit.objects.filter(id__in=created.get('habits', []), habitlog__isnull=True).delete()
+    RoutineExercise.objects.filter(id__in=created.get('routine_exercises', []), exerciselog__isnull=True).delete()
+
+    meal_ids = set(MealFood.objects.filter(id__in=created.get('meal_foods', [])).values_list('meal_id', flat=True))
+    MealFood.objects.filter(id__in=created.get('meal_foods', [])).delete()
+    Meal.objects.filter(id__in=meal_ids, mealfood__isnull=True).delete()
+
 
 def generate_data_with_gpt(data):
-    try:    
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-
-        print(data)
-
-        
-        completion = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                "role": "system",
-                "content": """
-                Você é um assistente de IA que gera hábitos saudáveis personalizados, rotinas de exercícios e planos alimentares com base nos dados do usuário. 
-                Responda **APENAS** com a estrutura JSON, sem explicações ou texto adicional, e forneça os nomes, títulos e descrições em português, como descrito a seguir:
-
-                - Para os **hábitos**: O nome do hábito e a unidade de medida devem estar em português. **Certifique-se de gerar pelo menos três hábitos: um relacionado ao sono, um à alimentação e outro à prática de exercícios.**
-                - Para os **exercícios**: O nome do exercício e o título devem estar em português. **Certifique-se de gerar pelo menos três exercícios para cada dia disponível. **
-                - Para a **dieta**: Liste cada refeição em português com os alimentos incluídos, suas quantidades, calorias, proteínas, carboidratos e gorduras. **Certifique-se de incluir pelo menos três refeições para o dia.**
-                - Para os **dias da semana**: Use os dias em português (segunda-feira, terça-feira, etc.).
-
-                A estrutura de resposta deve ser assim:
-                {
-                    "habits": [
-                        {
-                            "name": "Dormir bem" (string),  # Nome do hábito em português
-                            "goal": 8 (int),
-                            "measure": "horas" (string)  # Unidade de medida em português
-                        },
-                        {
-                            "name": "Comer frutas diariamente" (string),  # Nome relacionado à alimentação
-                            "goal": 3 (int),
-                            "measure": "porções" (string)  # Unidade de medida em português
-                        },
-                        {
-                            "name": "Exercitar-se regularmente" (string),  # Nome relacionado a exercícios
-                            "goal": 5 (int),
-                            "measure": "dias por semana" (string)  # Unidade de medida em português
-                        },
-                        ...
-                    ],
-                    "exercises": [
-                        {
-                            "day": "Segunda-feira" (string),  # O dia da semana em português
-                            "routine": [
-                                {
-                                    "exercise": "Agachamento com barra" (string),  # Nome do exercício em português
-                                    "sets": 3 (int),
-                                    "weight": 20 (int), 
-                                    "reps": 15 (int),
-                                    "title": "Agachamento" (string) # Título em português
-                                },
-                                {
-                                    "exercise": "Supino reto" (string) ,  # Segundo exercício
-                                    "sets": 3 (int),
-                                    "weight": 30 (int),
-                                    "reps": 12 (int),
-                                    "title": "Supino" (string)
-                                },
-                                {
-                                    "exercise": "Levantamento terra" (string),  # Terceiro exercício
-                                    "sets": 3 (int),
-                                    "weight": 40 (int),
-                                    "reps": 10 (int),
-                                    "title": "Levantamento" (string)
-                                }
-                            ]
-                        },
-                        ...
-                    ],
-                    "diet": [
-                        {
-                            "meal": "Café da manhã" (string),  # Nome da refeição em português
-                            "foods": [  # Lista de alimentos com detalhes
-                                {
-                                    "name": "Claras de ovos" (string),  # Nome do alimento
-                                    "servings": 2 (int),  # Quantidade de porções
-                                    "calories": 34 (int),  # Calorias por porção
-                                    "protein": 7.2 (float),  # Proteína em gramas por porção
-                                    "carbs": 0.2 (float),  # Carboidratos em gramas por porção
-                                    "fat": 0.1 (float) # Gordura em gramas por porção
-                                },
-                                {
-                                    "name": "Aveia" (string),
-                                    "servings": 1 (int),
-                                    "calories": 150 (int),
-                                    "protein": 5 (float),
-                                    "carbs": 27 (float),
-                                    "fat": 3 (float)
-                                },
-                                { # Terceiro alimento
-                                }
-                            ]
-                        },
-                        {
-                            "meal": "Almoço",  # Segunda refeição
-                            "foods": [ ... ]
-                        },
-                        {
-                            "meal": "Jantar",  # Terceira refeição
-                            "foods": [ ... ]
-                        },
-                        ...
-                    ]
-                }
-                Lembre-se de fornecer apenas a estrutura JSON válida, sem texto adicional. Respeite a tipagem de cada campo. Todas as informações solicitadas devem estar em português.
-                """
-                }, {"role": "user", "content": f"User Data: {data}"}
-            ]
-        )
-        
-        response_content = completion.choices[0].message.content
-        
-        # Parse the response content as JSON
-        try:
-            return json.loads(response_content)
-        except json.JSONDecodeError:
-            raise ValueError("GPT returned a response that is not valid JSON")
-
-    except Exception as e:
+    try:
+        logger.debug("generating a plan for %s", data)
+
+        # habits, exercises and diet are generated at the same time, each by its own smaller prompt;
+        # the plan is checked and repaired before anything is cached or saved
+        with stage('generation'):
+            plan = generate_sections(data)
+        with stage('validate'):
+            return validate_plan(plan)
+
+    except (OpenAIError, OpenAIUnavailable, ValueError) as e:
         print(f"An error occurred while generating data with GPT: {e}")
         return None
 
-def get_data(data):
+
+def get_data(data, user=None):
+    """
+    Description: if there is a fresh cached plan for the goal and the user's profile buckets, return it.
+    Otherwise, request AI, save in DB and return it. Failed generations are not cached.
+    """
+    return get_data_for_buckets(data, profile_buckets(user))
+
+
+def get_data_for_buckets(data, buckets, refresh=False):
+    """
+    Description: get_data for explicit profile buckets, e.g. when warming the cache without a user.
+    With refresh, the plan is regenerated even if a fresh one is cached.
+    """
+    entry = get_plan_for_buckets(data, buckets, refresh)
+    return entry.json_data if entry is not None else None
+
+
+def get_plan(data, user=None):
     """
-    Description: if there is data for the goal, return it. Otherwise, request AI, save in DB and return it.
+    Description: same as get_data, but returns the AI_data row of the plan (or None), so callers can
+    apply its compiled template instead of the raw JSON.
     """
+    return get_plan_for_buckets(data, profile_buckets(user))
 
+
+def get_plan_for_buckets(data, buckets, refresh=False):
+    """
+    Description: the AI_data row for the goal and profile buckets, generated and stored on a miss.
+
+    Concurrent misses for the same key are coalesced: one caller generates while the others wait
+    for the lock and then read the plan it stored. Callers that give up waiting get None.
+    """
     goal = data['goal']
-    
-    data_for_goal_exists = AI_data.objects.filter(goal=goal).exists()
-
-    print("data_for_goal_exists", data_for_goal_exists)
-
-    if data_for_goal_exists:
-        print("returning existing data")
-        return AI_data.objects.get(goal=goal).json_data
-    else:
-        print("fetching data")
-        gpt_data = generate_data_with_gpt(data)
-
-        print(gpt_data)
-        
-        dict_data = {
-            'goal': goal,
-            'json_data': gpt_data
-        }
-        print("registering response")
-        AI_data.objects.create(**dict_data)
-        return gpt_data
-    
+    key = plan_cache_key(goal, buckets)
 
+    with stage('cache_lookup'):
+        entry = None if refresh else lookup_plan(key)
+    if entry is not None:
+        print("returning cached data", key)
+        record_cache('hit')
+        return entry
 
+    # a plan cached for a near-duplicate goal ("perder peso rápido" for "perder peso") is reused as is
+    if not refresh:
+        with stage('similarity'):
+            entry, score = find_similar_plan(goal, buckets)
+        record_similarity(score)
+        if entry is not None:
+            logger.debug("reusing the plan of a similar goal %s (%.3f) for %s", entry.cache_key, score, key)
+            record_cache('similar')
+            return entry
 
+    lock_started = time.perf_counter()
+    with single_flight(key) as acquired:
+        record_time('lock_wait', time.perf_counter() - lock_started)
+
+        # another worker may have generated the plan while we waited for the lock
+        with stage('cache_lookup'):
+            entry = None if refresh and acquired else lookup_plan(key)
+        if entry is not None:
+            logger.debug("plan %s was generated by another worker", key)
+            record_cache('coalesced')
+            return entry
+
+        if not acquired:
+            # the worker generating this plan is still at it: a second generation would bring back
+            # the stampede, the caller falls back (local plan or draft) instead
+            record_counter('lock_timeout')
+            return None
+
+        print("fetching data", key)
+        record_cache('miss')
+        gpt_data = generate_data_with_gpt({**data, 'profile': describe_profile(buckets)})
+        if gpt_data is None:
+            return None
+
+        print("registering response")
+        with stage('store'):
+            return store_plan(key, goal, gpt_data)
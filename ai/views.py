@@ -1,39 +1,302 @@
+from django.http import StreamingHttpResponse
+from openai import OpenAIError
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from .utils import get_data, create_models_data
-import json
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .batch import create_jobs, resolve_users
+from .cache import lookup_plan, plan_cache_key, profile_buckets
+from .limiter import LimitExceeded, generation_limiter
+from .local_planner import generate_local_plan
+from .metrics import collect, percentile, read_counters
+from .similarity import similarity_threshold
+from .models import AIGenerationJob
+from .openai_client import OpenAIUnavailable
+from .regenerate import regenerate_section
+from .sections import PLAN_SECTIONS
+from .streaming import stream_plan
+from .tasks import generate_plan_for_user, onboard_users
+from .utils import create_models_data
+
+
+def _flag(value):
+    # booleans may come from JSON or from form data
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+
+def _limit_response(error):
+    """
+    Description: fast rejection of a request over the generation limits: 429 when the user already has
+    generations in flight, 503 when the whole service is saturated. Both tell when to retry.
+    """
+    code = status.HTTP_429_TOO_MANY_REQUESTS if error.scope == 'user' else status.HTTP_503_SERVICE_UNAVAILABLE
+    response = Response({"detail": str(error), "scope": error.scope, "retry_after": error.retry_after}, status=code)
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def _generation_slot(user, goal):
+    """
+    Description: take a generation slot for the request, unless its plan is cached already and no GPT call
+    will be made. Returns the slot token (or None); raises LimitExceeded.
+    """
+    if lookup_plan(plan_cache_key(goal, profile_buckets(user))) is not None:
+        return None
+    return generation_limiter.acquire(user.id)
+
+
+def _queue_job(job, slot):
+    # the worker releases the slot when the job ends, unless it was taken in this process' memory
+    slot = generation_limiter.hand_off(slot)
+    try:
+        generate_plan_for_user.delay(job.id, slot=slot)
+    except Exception:
+        generation_limiter.release(slot)
+        raise
+
 
 class GenerateData(APIView):
+    permission_classes = [IsAuthenticated]
+
     def get(self, request):
         return Response({"detail": "Method Not Supported"}, status=status.HTTP_400_BAD_REQUEST)
 
     def post(self, request):
-        # try:
-            data = request.data
-            # print(data)
-            goal = data.get('goal', '')
-
-            print(goal)
-
-            if not goal:
-                return Response({"detail": "Insufficient data."},status=status.HTTP_400_BAD_REQUEST)
-            
-            # get the habits, exercises and diets data
-            new_data = get_data(data)
-            if new_data is None:
-                return Response({"detail": "Error generating data"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-            # Get the authenticated user
-            user = request.user
-
-            # Save the data to the correct models for the user
-            create_models_data(new_data, user)
-
-            return Response({"detail": "OK"},status=200)
-        # except json.JSONDecodeError:
-        #     return Response({"detail": "Invalid JSON"}, status=status.HTTP_400_BAD_REQUEST)
-        # except ValueError as e:
-        #     return Response({"detail": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        # except Exception as e:
-        #     return Response({"detail": f"An unexpected error occurred: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        data = request.data
+        goal = data.get('goal', '')
+
+        if not goal:
+            return Response({"detail": "Insufficient data."},status=status.HTTP_400_BAD_REQUEST)
+
+        payload = dict(data.items())
+        draft = _flag(payload.pop('draft', False))
+        upgrade = _flag(payload.pop('upgrade', True))
+
+        slot = None
+        shed = None
+        if upgrade or not draft:
+            try:
+                slot = _generation_slot(request.user, goal)
+            except LimitExceeded as e:
+                if not draft:
+                    return _limit_response(e)
+                # under load, drafts are still served, just without the GPT upgrade
+                shed = e
+
+        if draft:
+            # Save a local plan right away; the GPT plan replaces it later unless upgrade is false
+            plan = generate_local_plan(goal, request.user)
+            created = create_models_data(plan, request.user)
+            created.pop('queries')
+
+            response = {"plan": plan, "source": AIGenerationJob.SOURCE_LOCAL, "created": created}
+            if shed is not None:
+                response.update({"detail": str(shed), "retry_after": shed.retry_after})
+            elif upgrade:
+                job = AIGenerationJob.objects.create(user=request.user, goal=goal, payload=payload, draft=created)
+                _queue_job(job, slot)
+                response.update({"job_id": job.id, "status": job.status})
+            return Response(response, status=status.HTTP_201_CREATED)
+
+        # Register the job and hand the GPT round trip to the celery worker, which frees the slot
+        job = AIGenerationJob.objects.create(
+            user=request.user,
+            goal=goal,
+            payload=payload
+        )
+        _queue_job(job, slot)
+
+        return Response({"job_id": job.id, "status": job.status}, status=status.HTTP_202_ACCEPTED)
+
+
+class GenerateDataBatch(APIView):
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        """
+        Description: onboard many users at once, e.g. the employees of a company. "users" lists ids or
+        emails; "goal" overrides the users' own goals. One job is created per user and the batch is handed
+        to the celery worker, which generates each distinct plan once and saves it for its users in bulk.
+        """
+        identifiers = request.data.get('users')
+        if not isinstance(identifiers, list) or not identifiers:
+            return Response({"detail": "Insufficient data."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(identifiers) > settings.AI_BATCH_MAX_USERS:
+            return Response({"detail": f"At most {settings.AI_BATCH_MAX_USERS} users per batch."}, status=status.HTTP_400_BAD_REQUEST)
+
+        users, missing = resolve_users(identifiers)
+        jobs, skipped = create_jobs(users, request.data.get('goal'))
+        if jobs:
+            onboard_users.delay([job.id for job in jobs])
+
+        return Response({
+            "jobs": [{"user_id": job.user_id, "job_id": job.id, "status": job.status} for job in jobs],
+            "skipped": [{"user_id": user.id, "error": "User has no goal."} for user in skipped],
+            "not_found": missing,
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+def _releasing(events, slot):
+    # the slot is held until the stream ends, or the client goes away
+    try:
+        yield from events
+    finally:
+        generation_limiter.release(slot)
+
+
+class GenerateDataStream(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        data = request.data
+        goal = data.get('goal', '')
+
+        if not goal:
+            return Response({"detail": "Insufficient data."},status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            slot = _generation_slot(request.user, goal)
+        except LimitExceeded as e:
+            return _limit_response(e)
+
+        # Each section is sent as a server-sent event as soon as it is generated and saved
+        events = _releasing(stream_plan(dict(data.items()), request.user), slot)
+        response = StreamingHttpResponse(events, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # don't let nginx buffer the stream
+        return response
+
+
+class RegenerateSection(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, section):
+        """
+        Description: regenerate one section (habits, exercises or diet) of the user's plan and write only
+        what changed. The goal defaults to the user's goal; "instructions" asks for a specific change.
+        """
+        if section not in PLAN_SECTIONS:
+            return Response({"detail": f"Unknown section, use one of: {', '.join(PLAN_SECTIONS)}."}, status=status.HTTP_404_NOT_FOUND)
+
+        goal = request.data.get('goal') or (request.user.goal.title if request.user.goal_id else '')
+        if not goal:
+            return Response({"detail": "Insufficient data."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            slot = generation_limiter.acquire(request.user.id)
+        except LimitExceeded as e:
+            return _limit_response(e)
+
+        with collect() as metrics:
+            try:
+                result = regenerate_section(request.user, section, goal, request.data.get('instructions'))
+            except (OpenAIError, OpenAIUnavailable, ValueError) as e:
+                print(f"An error occurred while regenerating the {section} section: {e}")
+                result = None
+            finally:
+                generation_limiter.release(slot)
+
+        if result is None:
+            return Response({"detail": "Error generating data."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({**result, "metrics": metrics.as_dict()}, status=status.HTTP_200_OK)
+
+
+class GenerationJobStatus(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        try:
+            # admins follow the jobs of the batches they started
+            jobs = AIGenerationJob.objects.all() if request.user.is_staff else AIGenerationJob.objects.filter(user=request.user)
+            job = jobs.get(id=pk)
+        except AIGenerationJob.DoesNotExist:
+            return Response({"error": "Job not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response({
+            "job_id": job.id,
+            "goal": job.goal,
+            "status": job.status,
+            "source": job.source or None,
+            "error": job.error or None,
+            "metrics": job.metrics,
+            "created_at": job.created_at,
+            "updated_at": job.updated_at,
+        }, status=status.HTTP_200_OK)
+
+
+def _summary(values):
+    values = [value for value in values if value is not None]
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+    }
+
+
+class AIMetrics(APIView):
+    """
+    Description: latency percentiles, cache hit rate, tokens and cost of the generation jobs of the last
+    `hours` (default 24), plus the pipeline counters of every process.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        try:
+            hours = float(request.query_params.get('hours', 24))
+        except ValueError:
+            return Response({"error": "hours must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+
+        jobs = AIGenerationJob.objects.filter(created_at__gte=timezone.now() - timedelta(hours=hours))
+        rows = list(jobs.values_list('status', 'metrics', 'created_at', 'updated_at'))
+
+        statuses = {choice: 0 for choice, _ in AIGenerationJob.STATUS_CHOICES}
+        cache = {'hit': 0, 'similar': 0, 'coalesced': 0, 'miss': 0}
+        stages = {}
+        for job_status, metrics, _, _ in rows:
+            statuses[job_status] += 1
+            if metrics.get('cache') in cache:
+                cache[metrics['cache']] += 1
+            for name, ms in metrics.get('stages_ms', {}).items():
+                stages.setdefault(name, []).append(ms)
+
+        done = [(metrics, created_at, updated_at) for job_status, metrics, created_at, updated_at in rows if job_status == AIGenerationJob.STATUS_DONE]
+        generated = [metrics for metrics, _, _ in done if metrics.get('cache') == 'miss']
+        lookups = sum(cache.values())
+
+        return Response({
+            "window_hours": hours,
+            "jobs": statuses,
+            # from the request to the plan being saved, queueing included
+            "onboarding_ms": _summary([(updated_at - created_at).total_seconds() * 1000 for _, created_at, updated_at in done]),
+            "pipeline_ms": _summary([metrics.get('total_ms') for metrics, _, _ in done]),
+            "ttft_ms": _summary([metrics.get('ttft_ms') for metrics in generated]),
+            "stages_ms": {name: _summary(values) for name, values in sorted(stages.items())},
+            "cache": {**cache, "hit_rate": (cache['hit'] + cache['similar'] + cache['coalesced']) / lookups if lookups else None},
+            # plans reused for near-duplicate goals, out of the lookups that missed the exact goal
+            "similarity": {
+                "threshold": similarity_threshold(),
+                "hit_rate": cache['similar'] / (lookups - cache['hit']) if lookups - cache['hit'] else None,
+                "best_score": _summary([metrics.get('similarity') for _, metrics, _, _ in rows]),
+            },
+            "tokens": {
+                "prompt": sum(metrics.get('prompt_tokens', 0) for _, metrics, _, _ in rows),
+                "completion": sum(metrics.get('completion_tokens', 0) for _, metrics, _, _ in rows),
+            },
+            "cost_usd": {
+                "total": round(sum(metrics.get('cost_usd', 0) for _, metrics, _, _ in rows), 6),
+                "per_generated_plan": round(sum(metrics['cost_usd'] for metrics in generated) / len(generated), 6) if generated else None,
+            },
+            "counters": read_counters(),
+            # generations in flight against the limits, and jobs still waiting for a worker
+            "limiter": {
+                **generation_limiter.depth(),
+                "queued": AIGenerationJob.objects.filter(status=AIGenerationJob.STATUS_QUEUED).count(),
+                "running": AIGenerationJob.objects.filter(status=AIGenerationJob.STATUS_RUNNING).count(),
+            },
+        }, status=status.HTTP_200_OK)
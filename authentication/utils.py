@@ -1,6 +1,10 @@
+from datetime import date
 from .models import User 
 from django.core.exceptions import ObjectDoesNotExist
 
+POUND_IN_KG = 0.45359237  # weights stored in pounds
+
+
 def authenticate_or_create_user_from_google_idinfo(idinfo):
     """
     Authenticate or create a user based on Google ID token information.
@@ -18,4 +22,29 @@ def authenticate_or_create_user_from_google_idinfo(idinfo):
             password=None  # Set password to None, as this user will log in via Google only
         )
 
-    return user
\ No newline at end of file
+    return user
+
+
+def weight_in_kg(user):
+    if not user.weight:
+        return None
+    if (user.weight_measure or 'kg').lower() in ('lb', 'lbs'):
+        return user.weight * POUND_IN_KG
+    return user.weight
+
+
+def height_in_cm(user):
+    if not user.height:
+        return None
+    measure = (user.height_measure or 'm').lower()
+    # heights stored in meters are small numbers, anything else is already in centimeters
+    if measure == 'm' or user.height < 3:
+        return user.height * 100
+    return user.height
+
+
+def age_in_years(birth_date, today=None):
+    if not birth_date:
+        return None
+    today = today or date.today()
+    return today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
@@ -0,0 +1,106 @@
+"""
+Tokens and wall time of the plan generation protocols, served by the local fake OpenAI server replaying
+recorded answers (benchmarks/recorded/ai_plan_responses.json) for the same plan in each format:
+
+- single prompt: the original SYSTEM_PROMPT with its commented JSON example, one verbose JSON answer
+- json sections: one prompt per section, verbose JSON objects (AI_PLAN_FORMAT = 'json')
+- compact sections: short prompts, positional rows expanded on our side (AI_PLAN_FORMAT = 'compact')
+
+    python benchmarks/ai_compact_format.py [--runs 3] [--token-latency 0.01]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'growthness.settings')
+
+import django
+
+django.setup()
+
+from django.test.utils import override_settings
+from ai.compact import COMPACT_PROMPTS
+from ai.openai_client import chat_completion
+from ai.sections import SECTION_PROMPTS
+from ai.testing import FakeOpenAIServer
+from ai.utils import generate_data_with_gpt
+from benchmarks.single_prompt import SYSTEM_PROMPT, build_messages
+
+RECORDED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recorded', 'ai_plan_responses.json')
+
+
+def recorded_responder():
+    with open(RECORDED, encoding='utf-8') as f:
+        recorded = json.load(f)
+
+    answers = {SYSTEM_PROMPT: recorded['single']}
+    answers.update({SECTION_PROMPTS[section]: text for section, text in recorded['json'].items()})
+    answers.update({COMPACT_PROMPTS[section]: text for section, text in recorded['compact'].items()})
+    return lambda request: answers[request['messages'][0]['content']]
+
+
+def single_prompt(data):
+    return json.loads(chat_completion(build_messages(data)).choices[0].message.content)
+
+
+def sections(plan_format):
+    def generate(data):
+        with override_settings(AI_PLAN_FORMAT=plan_format):
+            plan = generate_data_with_gpt(data)
+        assert plan is not None, f"{plan_format} generation failed"
+        return plan
+    return generate
+
+
+def run(server, function, data, runs):
+    timings = []
+    server.requests.clear()
+    for _ in range(runs):
+        start = time.perf_counter()
+        function(data)
+        timings.append(time.perf_counter() - start)
+
+    # the fake server counts ~4 characters per token, the same for every format
+    requests = server.requests[:len(server.requests) // runs]
+    prompt_tokens = sum(len(message['content']) // 4 for request in requests for message in request['messages'])
+    return prompt_tokens, timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds before the first token')
+    parser.add_argument('--token-latency', type=float, default=0.01, help='seconds per generated token')
+    args = parser.parse_args()
+
+    data = {'goal': 'Emagrecimento', 'profile': {'weight': '70-79 kg', 'height': '170-179 cm', 'age': '30-39 anos'}}
+
+    with open(RECORDED, encoding='utf-8') as f:
+        recorded = json.load(f)
+    completion_tokens = {
+        'single prompt': len(recorded['single']) // 4,
+        'json sections': sum(len(text) // 4 for text in recorded['json'].values()),
+        'compact sections': sum(len(text) // 4 for text in recorded['compact'].values()),
+    }
+
+    with FakeOpenAIServer(recorded_responder(), latency=args.latency, token_latency=args.token_latency) as server:
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+        os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+        results = {
+            'single prompt': run(server, single_prompt, data, args.runs),
+            'json sections': run(server, sections('json'), data, args.runs),
+            'compact sections': run(server, sections('compact'), data, args.runs),
+        }
+
+    print(f"{'protocol':<18}{'prompt tok':>12}{'output tok':>12}{'median (s)':>12}{'min (s)':>10}")
+    for name, (prompt_tokens, timings) in results.items():
+        print(f"{name:<18}{prompt_tokens:>12}{completion_tokens[name]:>12}{statistics.median(timings):>12.3f}{min(timings):>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
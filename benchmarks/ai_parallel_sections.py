@@ -0,0 +1,67 @@
+"""
+End-to-end latency of the AI plan generation: the former single prompt against the three section
+prompts generated in parallel, both served by the local fake OpenAI server.
+
+    python benchmarks/ai_parallel_sections.py [--runs 5] [--token-latency 0.02]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'growthness.settings')
+
+import django
+
+django.setup()
+
+from ai.openai_client import chat_completion
+from ai.testing import FakeOpenAIServer, plan_responder, sample_plan
+from ai.utils import generate_data_with_gpt
+from benchmarks.single_prompt import build_messages
+
+
+def single_prompt(data):
+    completion = chat_completion(build_messages(data))
+    return completion.choices[0].message.content
+
+
+def measure(function, data, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function(data)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds before the first token')
+    parser.add_argument('--token-latency', type=float, default=0.005, help='seconds per generated token')
+    args = parser.parse_args()
+
+    data = {'goal': 'Emagrecimento', 'profile': {'weight': '70-79 kg', 'height': '170-179 cm', 'age': '30-39 anos'}}
+
+    with FakeOpenAIServer(plan_responder(sample_plan()), latency=args.latency, token_latency=args.token_latency) as server:
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+        os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+        results = {
+            'single prompt': measure(single_prompt, data, args.runs),
+            'parallel sections': measure(generate_data_with_gpt, data, args.runs),
+        }
+
+    print(f"{'strategy':<20}{'median (s)':>12}{'min (s)':>10}{'max (s)':>10}")
+    for name, timings in results.items():
+        print(f"{name:<20}{statistics.median(timings):>12.3f}{min(timings):>10.3f}{max(timings):>10.3f}")
+
+    speedup = statistics.median(results['single prompt']) / statistics.median(results['parallel sections'])
+    print(f"speedup: {speedup:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
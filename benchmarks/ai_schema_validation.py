@@ -0,0 +1,71 @@
+"""
+Cost of validating and repairing GPT plans of growing size with the precompiled schema, with json.loads
+of the same plan as a reference. The schema is compiled once per process; its cost is printed first.
+
+    python benchmarks/ai_schema_validation.py [--number 200]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'growthness.settings')
+
+import django
+
+django.setup()
+
+from ai.schema import PLAN_SCHEMA, compile_schema, validate_plan
+from ai.testing import sample_plan
+
+SIZES = {
+    'default': dict(days=7, exercises_per_day=3, meals=3, foods_per_meal=3),
+    'large': dict(days=7, exercises_per_day=10, meals=6, foods_per_meal=8),
+    'huge': dict(days=7, exercises_per_day=40, meals=10, foods_per_meal=30),
+}
+
+
+def with_string_numbers(plan):
+    # the kind of answer the repair path handles: numbers as strings, lowercase days
+    plan = json.loads(json.dumps(plan))
+    for exercise in plan['exercises']:
+        exercise['day'] = exercise['day'].lower()
+        for routine in exercise['routine']:
+            routine['weight'] = f"{routine['weight']} kg"
+            routine['reps'] = str(routine['reps'])
+    for meal in plan['diet']:
+        for food in meal['foods']:
+            food['calories'] = f"{food['calories']} kcal"
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=200, help='validations per measurement')
+    args = parser.parse_args()
+
+    compile_time = min(timeit.repeat(lambda: [compile_schema(spec) for spec in PLAN_SCHEMA.values()], number=args.number, repeat=5))
+    print(f"compiling the schema: {compile_time / args.number * 1e6:.1f} us (once per process)\n")
+
+    print(f"{'plan':<10}{'items':>7}{'json.loads':>13}{'valid':>11}{'repairing':>11}   (us per plan)")
+    for name, size in SIZES.items():
+        plan = sample_plan(**size)
+        text = json.dumps(plan, ensure_ascii=False)
+        broken = with_string_numbers(plan)
+        items = len(plan['habits']) + sum(len(e['routine']) for e in plan['exercises']) + sum(len(m['foods']) for m in plan['diet'])
+
+        timings = [
+            min(timeit.repeat(function, number=args.number, repeat=5)) / args.number * 1e6
+            for function in (
+                lambda: json.loads(text),
+                lambda: validate_plan(plan),
+                lambda: validate_plan(broken),
+            )
+        ]
+        print(f"{name:<10}{items:>7}" + ''.join(f"{timing:>{width}.1f}" for timing, width in zip(timings, (13, 11, 11))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.15 on 2026-10-18 11:34
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('diets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='meal',
+            index=models.Index(fields=['user', 'date'], name='meal_user_date_idx'),
+        ),
+        # the composite indexes start with the foreign key, which needs no index of its own anymore
+        migrations.AlterField(
+            model_name='meal',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='meals', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('diets', '0002_alter_meal_user_meal_meal_user_date_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mealfood',
+            name='from_plan',
+            field=models.BooleanField(default=False),
+        ),
+    ]
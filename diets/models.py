@@ -14,10 +14,16 @@ class Food(models.Model):
 
 class Meal(models.Model):
     name = models.CharField(max_length=100)
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='meals')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='meals', db_index=False)  # meal_user_date_idx
     date = models.DateField()
     foods = models.ManyToManyField(Food, through='MealFood')
 
+    class Meta:
+        indexes = [
+            # a user's meals of a day
+            models.Index(fields=['user', 'date'], name='meal_user_date_idx'),
+        ]
+
     def __str__(self):
         return f"{self.name} - {self.user.email} on {self.date}"
 
@@ -26,6 +32,7 @@ class MealFood(models.Model):
     meal = models.ForeignKey(Meal, on_delete=models.CASCADE)
     food = models.ForeignKey(Food, on_delete=models.CASCADE)
     servings = models.FloatField()
+    from_plan = models.BooleanField(default=False)  # created by an AI plan, not by the user
 
     def __str__(self):
         return f"{self.servings} servings of {self.food.name} in {self.meal.name}"
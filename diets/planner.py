@@ -0,0 +1,241 @@
+"""
+Diet planning engine. The Food catalog is loaded as NumPy arrays, a calorie and macro target is computed
+from the user's weight, height and age, and the servings of every meal are found with a small
+non-negative least-squares solve, batched over all the meals at once.
+"""
+import unicodedata
+from datetime import date
+from itertools import combinations
+import numpy as np
+from django.db import transaction
+from authentication.utils import age_in_years, height_in_cm, weight_in_kg
+from .models import Food, Meal, MealFood
+
+# calories, protein (g), carbs (g), fat (g)
+NUTRIENTS = ('calories', 'protein', 'carbs', 'fat')
+KCAL_PER_GRAM = np.array([4.0, 4.0, 9.0])  # protein, carbs, fat
+
+# Goal kinds, matched on the normalized goal (the default UserGoals titles and free text alike)
+GOAL_KEYWORDS = {
+    'lose': ('emagrec', 'perder peso', 'perda de peso', 'queimar', 'definicao', 'secar'),
+    'gain': ('hipertrof', 'massa', 'ganhar peso', 'ganho de peso', 'forca', 'musculo'),
+    'endurance': ('corrida', 'correr', 'resistencia', 'maratona', 'cardio', 'condicionamento'),
+}
+
+# Calorie adjustment and protein (g per kg of body weight) per goal kind
+GOAL_TARGETS = {
+    'lose': {'calories': 0.8, 'protein_per_kg': 2.0},
+    'gain': {'calories': 1.1, 'protein_per_kg': 2.0},
+    'endurance': {'calories': 1.0, 'protein_per_kg': 1.4},
+    'maintain': {'calories': 1.0, 'protein_per_kg': 1.6},
+}
+FAT_SHARE = 0.25  # of the calories
+
+# Used for the unknown values of the profile
+DEFAULT_PROFILE = {'weight': 70, 'height': 170, 'age': 30}
+ACTIVITY_FACTOR = 1.4
+
+# Share of the daily target per meal
+MEALS = (('Café da manhã', 0.25), ('Almoço', 0.35), ('Lanche da tarde', 0.1), ('Jantar', 0.3))
+FOODS_PER_MEAL = 3
+CANDIDATES_PER_SLOT = 4
+SERVING_STEP = 0.25
+
+# How much a relative miss of each nutrient costs in the solve
+NUTRIENT_WEIGHTS = np.array([2.0, 1.5, 1.0, 1.0])
+
+
+def goal_kind(goal):
+    goal = unicodedata.normalize('NFKD', str(goal or '').lower())
+    goal = ''.join(char for char in goal if not unicodedata.combining(char))
+    for kind, keywords in GOAL_KEYWORDS.items():
+        if any(keyword in goal for keyword in keywords):
+            return kind
+    return 'maintain'
+
+
+def body_profile(user):
+    """
+    Description: weight (kg), height (cm) and age (years) of the user, the default profile for unknown values.
+    """
+    values = {'weight': weight_in_kg(user), 'height': height_in_cm(user), 'age': age_in_years(user.birth_date)}
+    return {name: DEFAULT_PROFILE[name] if not value or value <= 0 else value for name, value in values.items()}
+
+
+def energy_expenditure(profile, kind='maintain'):
+    """
+    Description: Mifflin-St Jeor resting energy (sex neutral: the average of the male and female constants)
+    times a light activity factor, adjusted for the goal.
+    """
+    bmr = 10 * profile['weight'] + 6.25 * profile['height'] - 5 * profile['age'] - 78
+    return bmr * ACTIVITY_FACTOR * GOAL_TARGETS[kind]['calories']
+
+
+def macro_targets(profile, kind='maintain'):
+    """
+    Description: daily [calories, protein, carbs, fat] target: protein from the body weight, a fixed share
+    of fat and the remaining calories as carbohydrates.
+    """
+    calories = energy_expenditure(profile, kind)
+    protein = profile['weight'] * GOAL_TARGETS[kind]['protein_per_kg']
+    fat = calories * FAT_SHARE / 9
+    carbs = max(calories - protein * 4 - fat * 9, 0) / 4
+    return np.array([calories, protein, carbs, fat])
+
+
+class FoodArrays:
+    """
+    Description: a food catalog as parallel arrays; `nutrients` is (foods, 4) per serving, in NUTRIENTS order.
+    Foods without calories are left out. `ids` is None for foods not saved in the catalog yet.
+    """
+
+    def __init__(self, rows):
+        rows = [row for row in rows if row[2] and row[2] > 0]
+        self.ids = [row[0] for row in rows]
+        self.names = [row[1] for row in rows]
+        self.nutrients = np.array([row[2:] for row in rows], dtype=float).reshape(len(rows), 4)
+        # missing macros count as zero
+        self.nutrients = np.nan_to_num(self.nutrients)
+
+    @classmethod
+    def from_catalog(cls, queryset=None):
+        queryset = Food.objects.all() if queryset is None else queryset
+        return cls(queryset.order_by('id').values_list('id', 'name', *NUTRIENTS))
+
+    def __len__(self):
+        return len(self.names)
+
+
+def _select_foods(foods, meal_count, per_meal):
+    """
+    Returns a (meals, per_meal) array of food indexes: the richest foods in protein, carbohydrates and fat
+    by share of calories, rotated so consecutive meals don't repeat the same foods.
+    """
+    shares = foods.nutrients[:, 1:] * KCAL_PER_GRAM / foods.nutrients[:, :1]
+    # best first; the stable sort keeps the catalog order between ties
+    rankings = np.argsort(-shares, axis=0, kind='stable')
+
+    selection = np.empty((meal_count, per_meal), dtype=int)
+    for meal in range(meal_count):
+        chosen = []
+        for slot in range(per_meal):
+            candidates = [index for index in rankings[:CANDIDATES_PER_SLOT + slot, slot % 3] if index not in chosen]
+            chosen.append(candidates[meal % len(candidates)])
+        selection[meal] = chosen
+    return selection
+
+
+def _nnls(A, b):
+    """
+    Returns x >= 0 minimizing |A x - b| for a batch of small problems (A is (batch, rows, k), b is (batch, rows)).
+    The least-squares solution of every support set of the k columns is computed for the whole batch at once
+    and the best non-negative one is kept: exact, and faster than an iterative solver for a handful of foods.
+    """
+    batch, _, k = A.shape
+    best = np.zeros((batch, k))
+    best_cost = np.einsum('br,br->b', b, b)
+
+    for size in range(1, k + 1):
+        for support in combinations(range(k), size):
+            columns = A[:, :, support]
+            gram = np.einsum('brk,brl->bkl', columns, columns) + 1e-9 * np.eye(size)
+            x = np.linalg.solve(gram, np.einsum('brk,br->bk', columns, b)[..., None])[..., 0]
+            residual = np.einsum('brk,bk->br', columns, x) - b
+            cost = np.einsum('br,br->b', residual, residual)
+
+            better = (x >= 0).all(axis=1) & (cost < best_cost)
+            candidate = np.zeros((batch, k))
+            candidate[:, support] = x
+            best[better] = candidate[better]
+            best_cost[better] = cost[better]
+    return best
+
+
+def optimize_diet(foods, target, meals=MEALS, per_meal=FOODS_PER_MEAL):
+    """
+    Description: split the daily target over the meals and find the servings of the foods of each meal that
+    get closest to it. Returns the diet in the AI plan shape, the target and the totals it reaches.
+    """
+    if len(foods) < per_meal:
+        raise ValueError("Not enough foods with calories in the catalog to plan a diet.")
+
+    shares = np.array([share for _, share in meals])
+    selection = _select_foods(foods, len(meals), per_meal)
+    meal_targets = shares[:, None] * target  # (meals, 4)
+    nutrients = foods.nutrients[selection]  # (meals, per_meal, 4)
+
+    # relative misses, so grams of fat and calories are comparable
+    scale = NUTRIENT_WEIGHTS / np.maximum(meal_targets, 1e-6)
+    servings = _nnls(nutrients.transpose(0, 2, 1) * scale[:, :, None], meal_targets * scale)
+    servings = np.round(servings / SERVING_STEP) * SERVING_STEP
+    totals = np.einsum('mk,mkn->n', servings, nutrients)
+
+    diet = []
+    portions = []
+    for (name, _), indexes, amounts in zip(meals, selection, servings):
+        kept = [(int(index), float(amount)) for index, amount in zip(indexes, amounts) if amount > 0]
+        portions.append(kept)
+        diet.append({"meal": name, "foods": [
+            {
+                "name": foods.names[index],
+                "servings": amount,
+                "calories": int(foods.nutrients[index, 0]),
+                "protein": float(foods.nutrients[index, 1]),
+                "carbs": float(foods.nutrients[index, 2]),
+                "fat": float(foods.nutrients[index, 3]),
+            }
+            for index, amount in kept
+        ]})
+
+    return {
+        'diet': diet,
+        # (food index, servings) per meal, for save_diet
+        'portions': portions,
+        'target': {name: round(float(value), 1) for name, value in zip(NUTRIENTS, target)},
+        'totals': {name: round(float(value), 1) for name, value in zip(NUTRIENTS, totals)},
+    }
+
+
+def plan_diet(user, goal=None, foods=None):
+    """
+    Description: the optimized diet of the user for the goal (their own goal by default) over the Food catalog.
+    """
+    if goal is None and user.goal_id:
+        goal = user.goal.title
+    kind = goal_kind(goal)
+    foods = FoodArrays.from_catalog() if foods is None else foods
+    return optimize_diet(foods, macro_targets(body_profile(user), kind))
+
+
+def save_diet(user, result, foods, day=None):
+    """
+    Description: write the meals of an optimize_diet result with bulk inserts. Foods that are not in
+    the catalog yet are created first, today's meals of the same name are reused (like the AI plans)
+    and meals left without foods are skipped. Returns the ids of the created MealFood rows.
+    """
+    day = day or date.today()
+
+    with transaction.atomic():
+        missing = sorted({index for portions in result['portions'] for index, _ in portions if foods.ids[index] is None})
+        if missing:
+            created = Food.objects.bulk_create([
+                Food(name=foods.names[index], **dict(zip(NUTRIENTS, foods.nutrients[index].tolist())))
+                for index in missing
+            ])
+            for index, food in zip(missing, created):
+                foods.ids[index] = food.id
+
+        names = list(dict.fromkeys(meal['meal'] for meal, portions in zip(result['diet'], result['portions']) if portions))
+        meals = {}
+        # the first meal of each name, when the user has several
+        for meal in Meal.objects.filter(user=user, date=day, name__in=names).order_by('-id'):
+            meals[meal.name] = meal
+        for meal in Meal.objects.bulk_create([Meal(user=user, name=name, date=day) for name in names if name not in meals]):
+            meals[meal.name] = meal
+
+        meal_foods = MealFood.objects.bulk_create([
+            MealFood(meal=meals[meal['meal']], food_id=foods.ids[index], servings=amount)
+            for meal, portions in zip(result['diet'], result['portions'])
+            for index, amount in portions
+        ])
+    return [meal_food.id for meal_food in meal_foods]
@@ -41,4 +41,9 @@ class MealCreateSerializer(serializers.ModelSerializer):
                 food=food,
                 servings=food_data['servings']
             )
-        return meal
\ No newline at end of file
+        return meal
+
+class DietPlanSerializer(serializers.Serializer):
+    goal = serializers.CharField(required=False, max_length=255)  # The user's goal when left out
+    date = serializers.DateField(required=False)
+    dry_run = serializers.BooleanField(default=False)  # Only return the plan, without saving the meals
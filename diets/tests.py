@@ -1,8 +1,11 @@
+import datetime
+import numpy as np
 from rest_framework import status
 from rest_framework.test import APITestCase
 from django.urls import reverse
 from authentication.models import User
 from .models import Food, Meal, MealFood
+from .planner import FoodArrays, _nnls, body_profile, macro_targets, optimize_diet, save_diet
 
 class DietTrackingTests(APITestCase):
 
@@ -51,3 +54,93 @@ class DietTrackingTests(APITestCase):
         response = self.client.get(self.meal_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 1)
+
+
+class DietPlannerTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='testuser@example.com', password='testpass', weight=80, height=1.80, birth_date=datetime.date(1990, 5, 1)
+        )
+        self.client.force_authenticate(self.user)
+        self.plan_url = reverse('diet-plan')
+
+        foods = (
+            ('Peito de frango', 165, 31.0, 0.0, 3.6), ('Ovo cozido', 78, 6.3, 0.6, 5.3),
+            ('Arroz integral', 215, 5.0, 45.0, 1.8), ('Aveia', 150, 5.0, 27.0, 3.0),
+            ('Banana', 105, 1.3, 27.0, 0.4), ('Castanhas', 185, 4.3, 3.9, 18.5),
+            ('Azeite', 120, 0.0, 0.0, 14.0), ('Salmão', 206, 22.0, 0.0, 12.0),
+        )
+        Food.objects.bulk_create([
+            Food(name=name, calories=calories, protein=protein, carbs=carbs, fat=fat)
+            for name, calories, protein, carbs, fat in foods
+        ])
+
+    def test_targets_follow_profile_and_goal(self):
+        profile = body_profile(self.user)
+        self.assertEqual(profile['weight'], 80)
+        self.assertAlmostEqual(profile['height'], 180)
+
+        lose, maintain, gain = (macro_targets(profile, kind) for kind in ('lose', 'maintain', 'gain'))
+        self.assertLess(lose[0], maintain[0])
+        self.assertLess(maintain[0], gain[0])
+        # protein from the body weight, fat as a share of the calories
+        self.assertEqual(maintain[1], 80 * 1.6)
+        self.assertAlmostEqual(maintain[3] * 9 / maintain[0], 0.25)
+        self.assertAlmostEqual(maintain[1] * 4 + maintain[2] * 4 + maintain[3] * 9, maintain[0])
+
+    def test_nnls_finds_the_non_negative_optimum(self):
+        rng = np.random.default_rng(0)
+        A = rng.uniform(0, 1, size=(50, 4, 3))
+        x = rng.uniform(0, 2, size=(50, 3))
+        np.testing.assert_allclose(_nnls(A, np.einsum('brk,bk->br', A, x)), x, atol=1e-4)
+
+        # an unreachable negative target gives all zeros
+        self.assertTrue((_nnls(A[:1], -np.ones((1, 4))) == 0).all())
+
+    def test_diet_reaches_the_target(self):
+        foods = FoodArrays.from_catalog()
+        target = macro_targets(body_profile(self.user), 'gain')
+        result = optimize_diet(foods, target)
+
+        self.assertEqual(len(result['diet']), 4)
+        for name, value in zip(('calories', 'protein', 'carbs', 'fat'), target):
+            self.assertLess(abs(result['totals'][name] - value) / value, 0.1, name)
+        self.assertTrue(all(len({food['name'] for food in meal['foods']}) == len(meal['foods']) for meal in result['diet']))
+        self.assertTrue(all(food['servings'] % 0.25 == 0 for meal in result['diet'] for food in meal['foods']))
+
+    def test_plan_endpoint_saves_the_meals(self):
+        response = self.client.post(self.plan_url, {'goal': 'Emagrecimento', 'date': '2024-09-26'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Meal.objects.filter(user=self.user, date=datetime.date(2024, 9, 26)).count(), len(response.data['meals']))
+        self.assertEqual(sorted(MealFood.objects.values_list('id', flat=True)), sorted(response.data['created']))
+        self.assertLess(response.data['target']['calories'], macro_targets(body_profile(self.user), 'maintain')[0])
+
+    def test_save_diet_reuses_todays_meals(self):
+        foods = FoodArrays.from_catalog()
+        lunch = Meal.objects.create(user=self.user, name='Almoço', date=datetime.date.today())
+        result = {
+            'diet': [{'meal': 'Almoço'}, {'meal': 'Jantar'}, {'meal': 'Ceia'}],
+            'portions': [[(0, 1.0)], [(1, 2.0), (2, 0.5)], []],
+        }
+
+        created = save_diet(self.user, result, foods)
+
+        self.assertEqual(len(created), 3)
+        self.assertEqual(sorted(Meal.objects.filter(user=self.user).values_list('name', flat=True)), ['Almoço', 'Jantar'])
+        self.assertEqual(lunch.mealfood_set.get().food.name, foods.names[0])
+
+    def test_plan_endpoint_dry_run(self):
+        response = self.client.post(self.plan_url, {'dry_run': True}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreaterEqual(len(response.data['meals']), 3)
+        self.assertEqual(Meal.objects.count(), 0)
+
+    def test_plan_endpoint_needs_foods(self):
+        Food.objects.all().delete()
+        response = self.client.post(self.plan_url, {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('error', response.data)
+
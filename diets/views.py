@@ -1,7 +1,9 @@
 from rest_framework import generics, status
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from .models import Food, Meal, MealFood
-from .serializers import FoodSerializer, MealSerializer, MealCreateSerializer, MealFoodSerializer
+from .planner import FoodArrays, plan_diet, save_diet
+from .serializers import DietPlanSerializer, FoodSerializer, MealSerializer, MealCreateSerializer, MealFoodSerializer
 from rest_framework.permissions import IsAuthenticated
 
 class FoodListCreateView(generics.ListCreateAPIView):
@@ -43,4 +45,29 @@ class MealFoodsListView(generics.ListAPIView):
         meal_foods = MealFood.objects.filter(meal=meal)
         serializer = self.get_serializer(meal_foods, many=True)
 
-        return Response(serializer.data, status=status.HTTP_200_OK)
\ No newline at end of file
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class DietPlanView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        """
+        Description: plan the user's meals for the day from the Food catalog, on the calorie and macro target
+        of their weight, height, age and goal. The meals are saved unless it's a dry run.
+        """
+        serializer = DietPlanSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        foods = FoodArrays.from_catalog()
+        try:
+            result = plan_diet(request.user, serializer.validated_data.get('goal'), foods)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        data = {"target": result['target'], "totals": result['totals'], "meals": result['diet']}
+        if serializer.validated_data['dry_run']:
+            return Response(data, status=status.HTTP_200_OK)
+
+        data['created'] = save_diet(request.user, result, foods, serializer.validated_data.get('date'))
+        return Response(data, status=status.HTTP_201_CREATED)
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.15 on 2026-10-18 11:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exercises', '0005_alter_exerciselog_reps_alter_exerciselog_weight'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='exerciselog',
+            index=models.Index(fields=['routine_exercise', 'date_logged', 'id'], name='exerciselog_re_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='routineexercise',
+            index=models.Index(fields=['routine', 'day_of_week'], name='routineexercise_day_idx'),
+        ),
+        # the composite indexes start with the foreign key, which needs no index of its own anymore
+        migrations.AlterField(
+            model_name='exerciselog',
+            name='routine_exercise',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='exercises.routineexercise'),
+        ),
+        migrations.AlterField(
+            model_name='routineexercise',
+            name='routine',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='exercises.routine'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exercises', '0006_alter_exerciselog_routine_exercise_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='routineexercise',
+            name='from_plan',
+            field=models.BooleanField(default=False),
+        ),
+    ]
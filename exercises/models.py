@@ -22,7 +22,7 @@ class Routine(models.Model):
         return f'Routine for {self.user.email} starting on {self.week_start_date}'
 
 class RoutineExercise(models.Model):
-    routine = models.ForeignKey(Routine, on_delete=models.CASCADE)
+    routine = models.ForeignKey(Routine, on_delete=models.CASCADE, db_index=False)  # routineexercise_day_idx
     exercise = models.ForeignKey(Exercise, on_delete=models.CASCADE)
     day_of_week = models.CharField(max_length=10, choices=[
         ('monday', 'Monday'),
@@ -39,13 +39,20 @@ class RoutineExercise(models.Model):
     distance = models.FloatField(help_text='Distance in kilometers for cardio exercises', blank=True, null=True)
     pace = models.FloatField(help_text='Pace in minutes per kilometer for cardio exercises', blank=True, null=True)
     average_velocity = models.FloatField(help_text='Average velocity in km/h for cardio exercises', blank=True, null=True)
+    from_plan = models.BooleanField(default=False)  # created by an AI plan, not by the user
+
+    class Meta:
+        indexes = [
+            # the exercises of a routine on a given day (today's exercises)
+            models.Index(fields=['routine', 'day_of_week'], name='routineexercise_day_idx'),
+        ]
 
     def __str__(self):
         return f'{self.exercise.name} on {self.day_of_week} in {self.routine}'
 
 class ExerciseLog(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='exercise_logs')
-    routine_exercise = models.ForeignKey(RoutineExercise, on_delete=models.CASCADE)
+    routine_exercise = models.ForeignKey(RoutineExercise, on_delete=models.CASCADE, db_index=False)  # exerciselog_re_date_idx
     date_logged = models.DateField()
     weight = models.IntegerField(help_text='Weight used during exercise', blank=True, null=True)
     reps = models.IntegerField(help_text='Reps completed', blank=True, null=True)
@@ -54,6 +61,12 @@ class ExerciseLog(models.Model):
     average_velocity_logged = models.FloatField(help_text='Average velocity in km/h logged', blank=True, null=True)
     pace_logged = models.FloatField(help_text='Pace in minutes per kilometer logged', blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # last log per date of a routine exercise (exercise-graph-logs)
+            models.Index(fields=['routine_exercise', 'date_logged', 'id'], name='exerciselog_re_date_idx'),
+        ]
+
     def __str__(self):
         return f'Log for {self.routine_exercise.exercise.name} on {self.date_logged}'
 
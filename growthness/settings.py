@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 from pathlib import Path
 import os 
 from dotenv import load_dotenv
+from celery.schedules import crontab
 
 load_dotenv()
 
@@ -187,6 +188,66 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_BACKEND = 'redis://growthness_redis:6379/0'
 CELERY_TIMEZONE = 'UTC'
+CELERY_BEAT_SCHEDULE = {
+    'warm-ai-plans-nightly': {
+        'task': 'ai.tasks.warm_ai_plans',
+        'schedule': crontab(hour=3, minute=0),
+    },
+}
+
+# AI plan cache
+AI_PLAN_CACHE_VERSION = int(os.getenv('AI_PLAN_CACHE_VERSION', 1))  # bump to invalidate every cached plan
+AI_PLAN_CACHE_TTL = int(os.getenv('AI_PLAN_CACHE_TTL', 60 * 60 * 24 * 30))  # seconds
+AI_PLAN_CACHE_LRU_SIZE = 128  # plans kept in memory per process
+AI_PLAN_FORMAT = os.getenv('AI_PLAN_FORMAT', 'compact')  # 'compact' positional rows or verbose 'json' objects
+AI_LOCAL_FALLBACK = True  # save a rule based plan (ai/local_planner.py) when OpenAI can't answer
+AI_SIMILARITY_THRESHOLD = float(os.getenv('AI_SIMILARITY_THRESHOLD', 0.7))  # cosine to reuse a similar goal's plan, above 1 disables
+
+# Only one generation per cache key runs at a time, across all workers
+AI_REDIS_URL = os.getenv('AI_REDIS_URL', 'redis://growthness_redis:6379/1')
+AI_GENERATION_LOCK_TIMEOUT = 180  # seconds before an abandoned lock expires
+AI_GENERATION_LOCK_WAIT = 180  # seconds a caller waits for the in-flight generation
+
+# GPT generations in flight across all workers (ai/limiter.py); over the limit requests are shed
+# with 503 (global) or 429 (per user) and a Retry-After header. 0 disables a limit.
+AI_CONCURRENCY_LIMIT = int(os.getenv('AI_CONCURRENCY_LIMIT', 20))
+AI_CONCURRENCY_LIMIT_PER_USER = int(os.getenv('AI_CONCURRENCY_LIMIT_PER_USER', 1))
+AI_CONCURRENCY_SLOT_TIMEOUT = 300  # seconds before the slot of a lost request frees itself
+AI_CONCURRENCY_RETRY_AFTER = 15  # seconds, sent in Retry-After
+
+# OpenAI client
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')  # None uses the public API
+OPENAI_CONNECT_TIMEOUT = 5  # seconds
+OPENAI_READ_TIMEOUT = 120  # seconds
+OPENAI_MAX_CONNECTIONS = 20
+OPENAI_MAX_RETRIES = 3  # on 429, 5xx, timeouts and connection errors
+OPENAI_BACKOFF_BASE = 0.5  # seconds, doubled on every retry (with jitter)
+OPENAI_BACKOFF_MAX = 8  # seconds
+OPENAI_CIRCUIT_FAILURE_THRESHOLD = 5  # failed calls in a row before failing fast
+OPENAI_CIRCUIT_RESET_TIMEOUT = 30  # seconds before trying OpenAI again
+OPENAI_PROMPT_PRICE_PER_1K = float(os.getenv('OPENAI_PROMPT_PRICE_PER_1K', 0.03))  # USD, gpt-4
+OPENAI_COMPLETION_PRICE_PER_1K = float(os.getenv('OPENAI_COMPLETION_PRICE_PER_1K', 0.06))  # USD, gpt-4
+
+# warm_ai_plans command
+AI_WARM_CONCURRENCY = 4  # plans generated at the same time
+AI_WARM_MAX_PER_MINUTE = 30  # plans started per minute
+
+# Batch onboarding (ai/batch.py)
+AI_BATCH_CONCURRENCY = 4  # distinct plans fetched or generated at the same time
+AI_BATCH_MAX_PER_MINUTE = 30  # generations started per minute
+AI_BATCH_MAX_USERS = 1000  # users per request of the batch endpoint
+
+# One structured line per AI pipeline run (see ai/metrics.py)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'ai.metrics': {'handlers': ['console'], 'level': os.getenv('AI_METRICS_LOG_LEVEL', 'INFO')},
+    },
+}
 
 AUTHENTICATION_BACKENDS = (
     'social_core.backends.google.GoogleOAuth2',
@@ -0,0 +1,116 @@
+"""
+Query plan regression tests: the hot queries of the apps must keep using their indexes. Each test seeds
+tables of a realistic size (hundreds of users, tens of thousands of rows, mostly stale cached plans),
+captures the EXPLAIN of the query as the app runs it and fails if a table it filters is read with a
+sequential scan or without the index meant for it. The planner keeps all of its options, so a test only
+passes when the index is really the cheapest way to run the query.
+"""
+import datetime
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from ai.cache import cache_ttl, cache_version
+from ai.models import AI_data
+from authentication.models import User
+from diets.models import Food, Meal, MealFood
+from exercises.models import Exercise, ExerciseLog, Routine, RoutineExercise
+from habits.models import Habit, HabitLog
+from habits.rollup import backfill_daily_totals, refresh_daily_totals
+from habits.views import graph_series
+
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+USERS = 200
+BATCH_SIZE = 5000
+
+
+class QueryPlanTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        today = datetime.date.today()
+        cls.today = today
+        users = User.objects.bulk_create([User(email=f'user{i}@example.com', password='!') for i in range(USERS)])
+        cls.user = users[0]
+
+        habits = Habit.objects.bulk_create([Habit(user=user, name=f'Habit {i}', goal=1.0) for user in users for i in range(5)])
+        cls.habit = habits[0]
+        HabitLog.objects.bulk_create([
+            HabitLog(habit=habit, date=today - datetime.timedelta(days=day), amount=1.0)
+            for habit in habits for day in range(60)
+        ], batch_size=BATCH_SIZE)
+        backfill_daily_totals()
+
+        exercise = Exercise.objects.create(name='Agachamento', exercise_type='gym')
+        routines = Routine.objects.bulk_create([
+            Routine(user=user, week_start_date=today - datetime.timedelta(weeks=week)) for user in users for week in range(4)
+        ])
+        routine_exercises = RoutineExercise.objects.bulk_create([
+            RoutineExercise(routine=routine, exercise=exercise, day_of_week=day) for routine in routines for day in DAYS for _ in range(3)
+        ], batch_size=BATCH_SIZE)
+        cls.routine_exercise = routine_exercises[0]
+        ExerciseLog.objects.bulk_create([
+            ExerciseLog(user=routine_exercise.routine.user, routine_exercise=routine_exercise, date_logged=today - datetime.timedelta(days=day), weight=20)
+            for routine_exercise in routine_exercises[::8] for day in range(10)
+        ], batch_size=BATCH_SIZE)
+
+        food = Food.objects.create(name='Aveia', calories=150)
+        meals = Meal.objects.bulk_create([
+            Meal(user=user, name=name, date=today - datetime.timedelta(days=day))
+            for user in users for day in range(30) for name in ('Café da manhã', 'Almoço', 'Jantar')
+        ], batch_size=BATCH_SIZE)
+        MealFood.objects.bulk_create([MealFood(meal=meal, food=food, servings=1) for meal in meals], batch_size=BATCH_SIZE)
+
+        # most cached plans are of an older cache version or expired, only a few are fresh
+        fresh = timezone.now()
+        stale = fresh - cache_ttl() - datetime.timedelta(days=1)
+        AI_data.objects.bulk_create([
+            AI_data(
+                goal=f'goal {i}', cache_key=f'v{version}:goal {i}:80:180:30', version=version, json_data={},
+                created_at=fresh if i % 100 == 0 else stale
+            )
+            for version in (cache_version(), cache_version() + 1) for i in range(10000)
+        ], batch_size=BATCH_SIZE)
+
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def explain(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN {sql}", params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def captured_plans(self, run):
+        # the plans of the statements the app really sends
+        with CaptureQueriesContext(connection) as queries:
+            run()
+        statements = [query['sql'] for query in queries.captured_queries]
+        return [self.explain(sql) for sql in statements if not sql.startswith(('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK'))]
+
+    def assertIndexScan(self, plan, table, index):
+        self.assertNotIn(f"Seq Scan on {table}", plan, plan)
+        self.assertIn(index, plan, plan)
+
+    def test_habit_log_days(self):
+        plans = self.captured_plans(lambda: refresh_daily_totals([(self.habit.id, self.today)]))
+        self.assertIndexScan('\n'.join(plans), 'habits_habitlog', 'habitlog_habit_date_idx')
+
+    def test_habit_graph(self):
+        plans = self.captured_plans(lambda: graph_series([self.habit.id], 30, 7, 'sum'))
+        self.assertIndexScan('\n'.join(plans), 'habits_habitdailytotal', 'habit_daily_total_unique_day')
+
+    def test_exercise_graph_logs(self):
+        queryset = ExerciseLog.objects.filter(routine_exercise=self.routine_exercise, date_logged=self.today).order_by('-id')[:1]
+        self.assertIndexScan(queryset.explain(), 'exercises_exerciselog', 'exerciselog_re_date_idx')
+
+    def test_today_exercises(self):
+        queryset = RoutineExercise.objects.filter(day_of_week='monday', routine__user=self.user)
+        self.assertIndexScan(queryset.explain(), 'exercises_routineexercise', 'routineexercise_day_idx')
+
+    def test_meals_of_the_day(self):
+        queryset = Meal.objects.filter(user=self.user, date=self.today, name__in=['Almoço', 'Jantar'])
+        self.assertIndexScan(queryset.explain(), 'diets_meal', 'meal_user_date_idx')
+
+    def test_fresh_cached_plans(self):
+        queryset = AI_data.objects.filter(version=cache_version(), created_at__gte=timezone.now() - cache_ttl())
+        self.assertIndexScan(queryset.values('cache_key', 'goal').explain(), 'ai_ai_data', 'ai_data_version_created_idx')
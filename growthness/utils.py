@@ -0,0 +1,30 @@
+"""
+Small helpers shared by the apps.
+"""
+
+# every id column is a BigAutoField
+MAX_ID = 2 ** 63 - 1
+
+
+def parse_int(value):
+    """
+    Description: `value` (an int or a string holding one) as an int, or None when it isn't an integer.
+    Unlike str.isdigit(), digits such as "²" are rejected instead of crashing int().
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_id(value):
+    """
+    Description: `value` as a primary key, or None when it isn't an integer or can't be an id
+    (not positive, or too big for the id columns).
+    """
+    number = parse_int(value)
+    if number is None or not 0 < number <= MAX_ID:
+        return None
+    return number
@@ -0,0 +1,122 @@
+"""
+Bulk HabitLog ingestion, for step counters and water bottles that sync hundreds of readings at once.
+Entries are checked with plain Python instead of a serializer per row, the habits they reference are
+checked in one query, the valid rows are written with COPY (bulk_create on other databases) and the
+daily rollup of the touched days is refreshed in one statement.
+"""
+import io
+import math
+from datetime import datetime
+from django.db import connection, transaction
+from django.utils import timezone
+from growthness.utils import MAX_ID, parse_int
+from .models import Habit, HabitLog
+from .rollup import refresh_daily_totals
+
+BULK_MAX_LOGS = 10000
+BATCH_SIZE = 1000
+
+REQUIRED = 'This field is required.'
+
+
+def parse_entry(entry):
+    """
+    Description: (habit_id, date, amount) of a bulk entry, or None and its errors by field
+    (in the serializer's format).
+    """
+    if not isinstance(entry, dict):
+        return None, {'non_field_errors': ['Invalid data. Expected an object.']}
+
+    errors = {}
+    habit_id = entry.get('habit')
+    pk = parse_int(habit_id)
+    if habit_id is None:
+        errors['habit'] = [REQUIRED]
+    elif pk is None:
+        errors['habit'] = [f'Incorrect type. Expected pk value, received {type(habit_id).__name__}.']
+    elif not 0 < pk <= MAX_ID:
+        # no habit can have it, and it would overflow the column in the ownership query
+        errors['habit'] = [f'Invalid pk "{habit_id}" - object does not exist.']
+    else:
+        habit_id = pk
+
+    day = entry.get('date')
+    if day is None:
+        errors['date'] = [REQUIRED]
+    else:
+        try:
+            # strptime, not date.fromisoformat: it also takes "20240101" and "2024-W01-1"
+            day = datetime.strptime(day, '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            errors['date'] = ['Date has wrong format. Use one of these formats instead: YYYY-MM-DD.']
+
+    amount = entry.get('amount')
+    if amount is None:
+        errors['amount'] = [REQUIRED]
+    else:
+        try:
+            amount = float(amount)
+        except (TypeError, ValueError):
+            amount = None
+        if isinstance(entry['amount'], bool) or amount is None or not math.isfinite(amount):
+            errors['amount'] = ['A valid number is required.']
+
+    if errors:
+        return None, errors
+    return (habit_id, day, amount), None
+
+
+def _copy_logs(cursor, rows, created_at):
+    # tab separated text; the values are ints, ISO dates and floats, nothing to escape
+    data = io.StringIO(''.join(f"{habit_id}\t{day.isoformat()}\t{amount!r}\t{created_at}\n" for habit_id, day, amount in rows))
+    cursor.copy_expert(
+        f"COPY {HabitLog._meta.db_table} (habit_id, date, amount, created_at) FROM STDIN",
+        data
+    )
+
+
+def insert_logs(rows):
+    """
+    Description: write the (habit_id, date, amount) rows as HabitLogs. No signals are sent:
+    the rollup of the days is refreshed here instead.
+    """
+    created_at = timezone.now()
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql' and hasattr(cursor, 'copy_expert'):
+            _copy_logs(cursor, rows, created_at.isoformat())
+        else:
+            HabitLog.objects.bulk_create([
+                HabitLog(habit_id=habit_id, date=day, amount=amount, created_at=created_at) for habit_id, day, amount in rows
+            ], batch_size=BATCH_SIZE)
+        refresh_daily_totals({(habit_id, day) for habit_id, day, _ in rows})
+
+
+def ingest_logs(user, entries):
+    """
+    Description: validate the entries and save the valid ones as logs of the user's habits.
+    Returns how many logs were created and the errors of the rejected entries, by index.
+    """
+    rows = []
+    errors = []
+    for index, entry in enumerate(entries):
+        row, row_errors = parse_entry(entry) if entry is not None else (None, {'non_field_errors': ['Invalid JSON.']})
+        if row_errors:
+            errors.append({'index': index, 'errors': row_errors})
+        else:
+            rows.append((index, row))
+
+    # ownership of every referenced habit, in one query
+    habit_ids = {habit_id for _, (habit_id, _, _) in rows}
+    owned = set(Habit.objects.filter(user=user, id__in=habit_ids).values_list('id', flat=True)) if habit_ids else set()
+
+    valid = []
+    for index, row in rows:
+        if row[0] in owned:
+            valid.append(row)
+        else:
+            errors.append({'index': index, 'errors': {'habit': [f'Invalid pk "{row[0]}" - object does not exist.']}})
+    errors.sort(key=lambda error: error['index'])
+
+    if valid:
+        insert_logs(valid)
+    return {'created': len(valid), 'errors': errors}
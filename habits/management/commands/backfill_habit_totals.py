@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from habits.rollup import backfill_daily_totals
+
+
+class Command(BaseCommand):
+    help = "Rebuild the HabitDailyTotal rollup from the habit logs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--habit', type=int, action='append', dest='habits',
+                            help="Only rebuild this habit's days (repeatable).")
+
+    def handle(self, *args, **options):
+        rows = backfill_daily_totals(options['habits'])
+        self.stdout.write(self.style.SUCCESS(f"{rows} daily totals written."))
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.15 on 2026-10-18 11:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habits', '0005_insert_default_data'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HabitDailyTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('total', models.FloatField()),
+                ('last_amount', models.FloatField()),
+                ('last_log_id', models.BigIntegerField()),
+                ('count', models.PositiveIntegerField()),
+                ('habit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_totals', to='habits.habit')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='habitdailytotal',
+            constraint=models.UniqueConstraint(fields=('habit', 'date'), name='habit_daily_total_unique_day'),
+        ),
+        # existing logs; later changes are kept in sync by habits/signals.py
+        migrations.RunSQL(
+            """
+            INSERT INTO habits_habitdailytotal (habit_id, date, total, last_amount, last_log_id, count)
+            SELECT habit_id, date, sum(amount), (array_agg(amount ORDER BY id DESC))[1], max(id), count(*)
+            FROM habits_habitlog
+            GROUP BY habit_id, date
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.15 on 2026-10-18 11:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habits', '0006_habitdailytotal'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='habitlog',
+            index=models.Index(fields=['habit', 'date'], include=('amount', 'id'), name='habitlog_habit_date_idx'),
+        ),
+        # the composite indexes start with the foreign key, which needs no index of its own anymore
+        migrations.AlterField(
+            model_name='habitdailytotal',
+            name='habit',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='daily_totals', to='habits.habit'),
+        ),
+        migrations.AlterField(
+            model_name='habitlog',
+            name='habit',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='habits.habit'),
+        ),
+    ]
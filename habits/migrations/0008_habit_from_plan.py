@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-18 11:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habits', '0007_alter_habitdailytotal_habit_alter_habitlog_habit_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='habit',
+            name='from_plan',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -30,16 +30,41 @@ class Habit(models.Model):
     goal = models.FloatField()  # Could represent liters, steps, etc.
     measure = models.CharField(max_length=48, null=True) # define the measurement greatness of goal (steps, liters, etc.)
     frequencies = models.ManyToManyField(Frequency)
+    from_plan = models.BooleanField(default=False)  # created by an AI plan, not by the user
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f"{self.user.username}'s habit: {self.name}"
 
 class HabitLog(models.Model):
-    habit = models.ForeignKey(Habit, on_delete=models.CASCADE)
+    habit = models.ForeignKey(Habit, on_delete=models.CASCADE, db_index=False)  # habitlog_habit_date_idx
     date = models.DateField()
     amount = models.FloatField()  # Amount of water, steps, etc.
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # a habit's logs of a day or a date range; covering, so the rollup refresh reads only the index
+            models.Index(fields=['habit', 'date'], include=['amount', 'id'], name='habitlog_habit_date_idx'),
+        ]
+
     def __str__(self):
         return f"{self.habit.name} on {self.date}"
+
+
+class HabitDailyTotal(models.Model):
+    # Rollup of a habit's logs per day, kept up to date by habits/signals.py (see habits/rollup.py)
+    habit = models.ForeignKey(Habit, on_delete=models.CASCADE, related_name='daily_totals', db_index=False)  # unique day index
+    date = models.DateField()
+    total = models.FloatField()  # sum of the day's amounts
+    last_amount = models.FloatField()  # amount of the day's latest log
+    last_log_id = models.BigIntegerField()  # id of the day's latest log
+    count = models.PositiveIntegerField()  # logs of the day
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['habit', 'date'], name='habit_daily_total_unique_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.habit.name} on {self.date}: {self.total}"
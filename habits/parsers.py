@@ -0,0 +1,31 @@
+import json
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    """
+    Description: newline delimited JSON, one entry per line, as devices sync their readings.
+    Blank lines are skipped; a line that isn't valid JSON comes back as None, so it is reported
+    with the other per-entry errors instead of failing the whole request.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        entries = []
+        if stream is None:
+            return entries
+        for line in stream:
+            try:
+                line = line.decode(encoding).strip()
+            except UnicodeDecodeError as e:
+                raise ParseError(f"NDJSON parse error - {e}")
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                entries.append(None)
+        return entries
@@ -0,0 +1,79 @@
+"""
+HabitDailyTotal maintenance. Every change to a habit's logs recomputes the rollup rows of the days it
+touched from those days' logs (an upsert, or a delete when a day has no logs left), so the summary
+endpoints read one row per habit and day instead of scanning the raw logs.
+"""
+from django.db import connection, transaction
+from .models import Habit, HabitDailyTotal, HabitLog
+
+
+def refresh_daily_totals(days):
+    """
+    Description: recompute the rollup rows of the given (habit_id, date) pairs.
+
+    The habits are locked for the rest of the transaction, in id order (FOR NO KEY UPDATE, which doesn't block
+    new logs): a concurrent refresh of the same habit waits and then reads this transaction's logs too, so
+    the last refresh always sees every log.
+    """
+    # dates may still be strings on instances created with them
+    to_date = HabitLog._meta.get_field('date').to_python
+    days = sorted({(int(habit_id), to_date(date)) for habit_id, date in days if habit_id is not None and date is not None})
+    if not days:
+        return
+
+    habit_ids = [habit_id for habit_id, _ in days]
+    dates = [date for _, date in days]
+    rollup = HabitDailyTotal._meta.db_table
+    logs = HabitLog._meta.db_table
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT id FROM {Habit._meta.db_table} WHERE id = ANY(%s) ORDER BY id FOR NO KEY UPDATE",
+            [habit_ids]
+        )
+        cursor.execute(f"""
+            WITH days AS (
+                SELECT * FROM unnest(%s::bigint[], %s::date[]) AS d(habit_id, date)
+            ), totals AS (
+                SELECT l.habit_id, l.date, sum(l.amount) AS total,
+                       (array_agg(l.amount ORDER BY l.id DESC))[1] AS last_amount, max(l.id) AS last_log_id, count(*) AS count
+                FROM {logs} l
+                JOIN days ON days.habit_id = l.habit_id AND days.date = l.date
+                GROUP BY l.habit_id, l.date
+            ), upserted AS (
+                INSERT INTO {rollup} (habit_id, date, total, last_amount, last_log_id, count)
+                SELECT habit_id, date, total, last_amount, last_log_id, count FROM totals
+                ON CONFLICT (habit_id, date) DO UPDATE
+                SET total = EXCLUDED.total, last_amount = EXCLUDED.last_amount,
+                    last_log_id = EXCLUDED.last_log_id, count = EXCLUDED.count
+            )
+            DELETE FROM {rollup} r
+            USING days
+            WHERE r.habit_id = days.habit_id AND r.date = days.date
+              AND NOT EXISTS (SELECT 1 FROM totals WHERE totals.habit_id = r.habit_id AND totals.date = r.date)
+        """, [habit_ids, dates])
+
+
+BACKFILL_SQL = """
+    INSERT INTO {rollup} (habit_id, date, total, last_amount, last_log_id, count)
+    SELECT habit_id, date, sum(amount), (array_agg(amount ORDER BY id DESC))[1], max(id), count(*)
+    FROM {logs}
+    {where}
+    GROUP BY habit_id, date
+"""
+
+
+def backfill_daily_totals(habit_ids=None):
+    """
+    Description: rebuild the rollup from the logs, for the given habits or all of them.
+    Returns the number of rollup rows written.
+    """
+    rollup = HabitDailyTotal._meta.db_table
+    logs = HabitLog._meta.db_table
+    where = "WHERE habit_id = ANY(%s)" if habit_ids is not None else ""
+    params = [list(habit_ids)] if habit_ids is not None else []
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {rollup} {where}", params)
+        cursor.execute(BACKFILL_SQL.format(rollup=rollup, logs=logs, where=where), params)
+        return cursor.rowcount
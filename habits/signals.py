@@ -0,0 +1,32 @@
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .models import HabitLog
+from .rollup import refresh_daily_totals
+
+
+@receiver(pre_save, sender=HabitLog)
+def remember_log_day(sender, instance, **kwargs):
+    # the day an existing log is saved over, so moving it to another habit or date refreshes both days
+    instance._rollup_day = None
+    if not instance._state.adding:
+        instance._rollup_day = HabitLog.objects.filter(pk=instance.pk).values_list('habit_id', 'date').first()
+
+
+@receiver(post_save, sender=HabitLog)
+def refresh_saved_log_day(sender, instance, **kwargs):
+    refresh_daily_totals({(instance.habit_id, instance.date), instance._rollup_day or (None, None)})
+
+
+@receiver(post_delete, sender=HabitLog)
+def refresh_deleted_log_day(sender, instance, origin=None, **kwargs):
+    # logs deleted along with their habit (or user) need nothing: their rollup rows are cascaded too
+    if not (isinstance(origin, HabitLog) or (isinstance(origin, QuerySet) and origin.model is HabitLog)):
+        return
+
+    # the days of one delete() call are refreshed together, once, when its transaction commits
+    if '_rollup_days' not in origin.__dict__:
+        origin._rollup_days = set()
+        transaction.on_commit(lambda: refresh_daily_totals(origin.__dict__.pop('_rollup_days')))
+    origin._rollup_days.add((instance.habit_id, instance.date))
@@ -1,9 +1,16 @@
 from rest_framework import status
 from rest_framework.test import APITestCase
 from authentication.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from .models import Habit, HabitLog, Frequency
+from .models import Habit, HabitDailyTotal, HabitLog, Frequency
+from .rollup import backfill_daily_totals
 import datetime
+import json
+import time
+from io import StringIO
 from datetime import timezone 
 
 class HabitTests(APITestCase):
@@ -233,4 +240,355 @@ class HabitTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 1)
         self.assertEqual(response.data[0]['habit'], 'Drink Water')
-        self.assertEqual(len(response.data[0]['logs']), 0)
\ No newline at end of file
+        self.assertEqual(len(response.data[0]['logs']), 0)
+
+class HabitQueryTests(APITestCase):
+    """
+    Query counts and results of the summary endpoints, with many habits per user.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='testuser@example.com', password='testpass')
+        self.client.force_authenticate(self.user)
+        # the default frequencies come from a data migration
+        self.frequencies = {name: Frequency.objects.get_or_create(name=name)[0] for name in ('daily', 'weekly', 'monthly')}
+        self.today = datetime.date.today()
+
+    def create_habits(self, count, frequency='daily', logs_per_habit=3):
+        habits = Habit.objects.bulk_create([
+            Habit(user=self.user, name=f'Habit {i}', goal=10.0) for i in range(count)
+        ])
+        Habit.frequencies.through.objects.bulk_create([
+            Habit.frequencies.through(habit_id=habit.id, frequency_id=self.frequencies[frequency].id) for habit in habits
+        ])
+        HabitLog.objects.bulk_create([
+            HabitLog(habit=habit, date=self.today - datetime.timedelta(days=day), amount=2.0)
+            for habit in habits for day in range(logs_per_habit)
+        ])
+        # bulk_create sends no signals
+        backfill_daily_totals([habit.id for habit in habits])
+        return habits
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries), response
+
+    def test_completion_status_windows(self):
+        for frequency, amounts in (('daily', (2, 3)), ('weekly', (6, 5)), ('monthly', (20, 31))):
+            habit = Habit.objects.create(user=self.user, name=frequency, goal=10.0)
+            habit.frequencies.add(self.frequencies[frequency])
+            for days_ago in amounts:
+                HabitLog.objects.create(habit=habit, date=self.today - datetime.timedelta(days=days_ago), amount=4.0)
+        # a habit without frequency has no window
+        Habit.objects.create(user=self.user, name='none', goal=10.0)
+
+        response = self.client.get(reverse('habits-completion-status'))
+        totals = {row['habit']: (row['frequency'], row['total_amount']) for row in response.data}
+        self.assertEqual(totals, {'daily': ('daily', 0), 'weekly': ('weekly', 8.0), 'monthly': ('monthly', 4.0)})
+
+    def test_completion_status_uses_the_first_frequency(self):
+        habit = Habit.objects.create(user=self.user, name='Drink Water', goal=4.0)
+        habit.frequencies.add(self.frequencies['weekly'], self.frequencies['daily'])
+        HabitLog.objects.create(habit=habit, date=self.today - datetime.timedelta(days=5), amount=4.0)
+
+        row = self.client.get(reverse('habits-completion-status')).data[0]
+        expected = 'daily' if self.frequencies['daily'].id < self.frequencies['weekly'].id else 'weekly'
+        self.assertEqual(row['frequency'], expected)
+        self.assertEqual(row['completed'], expected == 'weekly')
+
+    def test_completion_status_query_count_is_constant(self):
+        url = reverse('habits-completion-status')
+        self.create_habits(5)
+        few, _ = self.count_queries(url)
+        self.create_habits(120)
+        many, response = self.count_queries(url)
+
+        self.assertEqual(few, many)
+        self.assertEqual(len(response.data), 125)
+        self.assertTrue(all(row['total_amount'] == 4.0 for row in response.data))
+
+    def test_history_keeps_the_last_log_of_each_day(self):
+        habit = Habit.objects.create(user=self.user, name='Drink Water', goal=2.0)
+        Habit.objects.create(user=self.user, name='Walk', goal=2.0)
+        yesterday = self.today - datetime.timedelta(days=1)
+        for amount in (1.0, 3.0):
+            HabitLog.objects.create(habit=habit, date=yesterday, amount=amount)
+        HabitLog.objects.create(habit=habit, date=self.today, amount=0.5)
+        HabitLog.objects.create(habit=habit, date=self.today - datetime.timedelta(days=10), amount=9.0)
+
+        response = self.client.get(reverse('habits-history'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['habit'] for row in response.data], ['Drink Water', 'Walk'])
+        self.assertEqual([log['amount'] for log in response.data[0]['logs']], [3.0, 0.5])
+        self.assertEqual(response.data[1]['logs'], [])
+
+        response = self.client.get(reverse('habits-history'), {'days': 30})
+        self.assertEqual([log['amount'] for log in response.data[0]['logs']], [9.0, 3.0, 0.5])
+
+    def test_history_rejects_bad_ranges(self):
+        for days in ('abc', '0', '1000'):
+            response = self.client.get(reverse('habits-history'), {'days': days})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_history_query_count_is_constant(self):
+        url = reverse('habits-history')
+        self.create_habits(5)
+        few, _ = self.count_queries(url)
+        self.create_habits(120)
+        many, response = self.count_queries(url)
+
+        self.assertEqual(few, many)
+        self.assertEqual(len(response.data), 125)
+        self.assertTrue(all(len(row['logs']) == 3 for row in response.data))
+
+    def test_graph_logs_buckets_by_step(self):
+        habit = Habit.objects.create(user=self.user, name='Walk', goal=10000.0, measure='steps')
+        # 14 days, two points of 7 days; the first point has logs on two days, one of them twice
+        start = self.today - datetime.timedelta(days=13)
+        for days, amount in ((0, 1000.0), (0, 500.0), (3, 4000.0), (10, 2000.0)):
+            HabitLog.objects.create(habit=habit, date=start + datetime.timedelta(days=days), amount=amount)
+        url = reverse('habits-habit-graphlogs', args=[habit.id])
+
+        expected = {'sum': [5500.0, 2000.0], 'max': [4000.0, 2000.0], 'avg': [2750.0, 2000.0], 'last': [4000.0, 2000.0]}
+        for aggregation, amounts in expected.items():
+            response = self.client.get(url, {'startDateRange': 14, 'dateStep': 7, 'aggregation': aggregation})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual([log['amount'] for log in response.data['logs']], amounts)
+        self.assertEqual(
+            [log['date'] for log in response.data['logs']],
+            [start.strftime('%Y-%m-%d'), (start + datetime.timedelta(days=7)).strftime('%Y-%m-%d')]
+        )
+
+    def test_graph_logs_defaults_to_the_last_log_per_day(self):
+        habit = Habit.objects.create(user=self.user, name='Drink Water', goal=2.0)
+        HabitLog.objects.create(habit=habit, date=self.today, amount=0.5)
+        HabitLog.objects.create(habit=habit, date=self.today, amount=1.5)
+
+        response = self.client.get(reverse('habits-habit-graphlogs', args=[habit.id]))
+        self.assertEqual(len(response.data['logs']), 7)
+        self.assertEqual(response.data['logs'][-1], {'date': self.today.strftime('%Y-%m-%d'), 'amount': 1.5})
+        self.assertEqual(sum(log['amount'] for log in response.data['logs'][:-1]), 0)
+
+    def test_graph_logs_rejects_bad_parameters(self):
+        habit = Habit.objects.create(user=self.user, name='Drink Water', goal=2.0)
+        url = reverse('habits-habit-graphlogs', args=[habit.id])
+        for params in ({'dateStep': 'x'}, {'dateStep': 0}, {'aggregation': 'median'}):
+            self.assertEqual(self.client.get(url, params).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_graph_logs_of_many_habits(self):
+        habits = self.create_habits(30, logs_per_habit=2)
+        other_user = User.objects.create_user(email='other@example.com', password='testpass')
+        foreign = Habit.objects.create(user=other_user, name='Not mine', goal=1.0)
+        url = reverse('habits-graph-logs')
+
+        queries, response = self.count_queries(f'{url}?ids={habits[2].id},{habits[0].id},{foreign.id}&aggregation=sum')
+        self.assertEqual([row['id'] for row in response.data], [habits[2].id, habits[0].id])
+        single = self.client.get(reverse('habits-habit-graphlogs', args=[habits[2].id]), {'aggregation': 'sum'}).data
+        self.assertEqual(response.data[0]['logs'], single['logs'])
+        self.assertEqual(response.data[0]['habit'], single['habit'])
+
+        all_queries, response = self.count_queries(url)
+        self.assertEqual(len(response.data), 30)
+        self.assertEqual(queries, all_queries)
+        self.assertTrue(all(row['logs'][-1]['amount'] == 2.0 for row in response.data))
+
+        self.assertEqual(self.client.get(url, {'ids': '1,a'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {'ids': str(foreign.id)}).data, [])
+
+
+class HabitDailyTotalTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='testuser@example.com', password='testpass')
+        self.habit = Habit.objects.create(user=self.user, name='Drink Water', goal=2.0)
+        self.today = datetime.date.today()
+        self.yesterday = self.today - datetime.timedelta(days=1)
+
+    def totals(self):
+        return {
+            (row.habit_id, row.date): (row.total, row.last_amount, row.count)
+            for row in HabitDailyTotal.objects.all()
+        }
+
+    def test_created_logs_are_rolled_up(self):
+        HabitLog.objects.create(habit=self.habit, date=self.today, amount=0.5)
+        last = HabitLog.objects.create(habit=self.habit, date=self.today.strftime('%Y-%m-%d'), amount=0.25)
+
+        self.assertEqual(self.totals(), {(self.habit.id, self.today): (0.75, 0.25, 2)})
+        self.assertEqual(HabitDailyTotal.objects.get().last_log_id, last.id)
+
+    def test_updated_logs_move_between_days(self):
+        first = HabitLog.objects.create(habit=self.habit, date=self.today, amount=0.5)
+        log = HabitLog.objects.create(habit=self.habit, date=self.today, amount=1.0)
+
+        log.amount = 2.0
+        log.save()
+        self.assertEqual(self.totals(), {(self.habit.id, self.today): (2.5, 2.0, 2)})
+
+        log = HabitLog.objects.get(id=log.id)
+        log.date = self.yesterday
+        log.save()
+        self.assertEqual(self.totals(), {
+            (self.habit.id, self.today): (0.5, 0.5, 1),
+            (self.habit.id, self.yesterday): (2.0, 2.0, 1),
+        })
+        self.assertEqual(HabitDailyTotal.objects.get(date=self.today).last_log_id, first.id)
+
+    def test_deleted_logs_are_removed(self):
+        first = HabitLog.objects.create(habit=self.habit, date=self.today, amount=0.5)
+        log = HabitLog.objects.create(habit=self.habit, date=self.today, amount=1.0)
+
+        # the days are refreshed when the delete commits
+        with self.captureOnCommitCallbacks(execute=True):
+            log.delete()
+        self.assertEqual(self.totals(), {(self.habit.id, self.today): (0.5, 0.5, 1)})
+        with self.captureOnCommitCallbacks(execute=True):
+            HabitLog.objects.filter(id=first.id).delete()
+        self.assertEqual(self.totals(), {})
+
+        HabitLog.objects.create(habit=self.habit, date=self.today, amount=0.5)
+        self.habit.delete()
+        self.assertEqual(HabitDailyTotal.objects.count(), 0)
+
+    def test_bulk_deletes_refresh_each_day_once(self):
+        HabitLog.objects.bulk_create([
+            HabitLog(habit=self.habit, date=self.today - datetime.timedelta(days=i % 20), amount=1.0) for i in range(2000)
+        ])
+        backfill_daily_totals()
+
+        # deleting 1000 logs refreshes their 10 days at once
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            HabitLog.objects.filter(habit=self.habit, date__gte=self.today - datetime.timedelta(days=9)).delete()
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(HabitDailyTotal.objects.count(), 10)
+
+        # deleting the habit cascades to its rollup rows, no refresh is needed
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks() as callbacks:
+            self.habit.delete()
+        self.assertLess(len(queries), 20)
+        self.assertEqual(callbacks, [])
+        self.assertEqual(HabitDailyTotal.objects.count(), 0)
+
+    def test_endpoints_follow_log_changes(self):
+        self.client.force_authenticate(self.user)
+        self.habit.frequencies.add(Frequency.objects.get_or_create(name='daily')[0])
+        log = HabitLog.objects.create(habit=self.habit, date=self.today, amount=1.0)
+        self.client.patch(reverse('habit-logs-detail', args=[log.id]), {'amount': 3.0}, format='json')
+
+        self.assertEqual(self.client.get(reverse('habits-completion-status')).data[0]['total_amount'], 3.0)
+        self.assertEqual(self.client.get(reverse('habits-history')).data[0]['logs'][0]['amount'], 3.0)
+        graph = self.client.get(reverse('habits-habit-graphlogs', args=[self.habit.id])).data
+        self.assertEqual(graph['logs'][-1]['amount'], 3.0)
+
+    def test_backfill_command(self):
+        other = Habit.objects.create(user=self.user, name='Walk', goal=2.0)
+        HabitLog.objects.bulk_create([
+            HabitLog(habit=self.habit, date=self.today, amount=1.0),
+            HabitLog(habit=self.habit, date=self.today, amount=2.0),
+            HabitLog(habit=other, date=self.yesterday, amount=4.0),
+        ])
+        self.assertEqual(HabitDailyTotal.objects.count(), 0)
+
+        out = StringIO()
+        call_command('backfill_habit_totals', '--habit', str(self.habit.id), stdout=out)
+        self.assertIn('1 daily totals written', out.getvalue())
+        call_command('backfill_habit_totals', stdout=out)
+        self.assertEqual(self.totals(), {
+            (self.habit.id, self.today): (3.0, 2.0, 2),
+            (other.id, self.yesterday): (4.0, 4.0, 1),
+        })
+
+
+class HabitLogBulkTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='testuser@example.com', password='testpass')
+        self.client.force_authenticate(self.user)
+        self.habit = Habit.objects.create(user=self.user, name='Walk', goal=10000.0, measure='steps')
+        self.bulk_url = reverse('habit-logs-bulk')
+        self.today = datetime.date.today()
+
+    def entries(self, count, habit=None):
+        habit = habit or self.habit
+        return [
+            {'habit': habit.id, 'date': (self.today - datetime.timedelta(days=i % 30)).isoformat(), 'amount': 100.0 + i}
+            for i in range(count)
+        ]
+
+    def test_json_list(self):
+        response = self.client.post(self.bulk_url, self.entries(60), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {'created': 60, 'errors': []})
+        self.assertEqual(HabitLog.objects.filter(habit=self.habit).count(), 60)
+
+        # the rollup of every touched day is refreshed
+        today = HabitDailyTotal.objects.get(habit=self.habit, date=self.today)
+        self.assertEqual((today.total, today.count), (100.0 + 130.0, 2))
+        self.assertEqual(HabitDailyTotal.objects.filter(habit=self.habit).count(), 30)
+
+    def test_ndjson(self):
+        lines = [json.dumps(entry) for entry in self.entries(3)] + ['', '{not json', json.dumps({'habit': self.habit.id})]
+        response = self.client.post(self.bulk_url, '\n'.join(lines), content_type='application/x-ndjson')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 3)
+        self.assertEqual([error['index'] for error in response.data['errors']], [3, 4])
+        self.assertEqual(set(response.data['errors'][1]['errors']), {'date', 'amount'})
+
+    def test_per_row_errors_and_ownership(self):
+        other_user = User.objects.create_user(email='other@example.com', password='testpass')
+        foreign = Habit.objects.create(user=other_user, name='Not mine', goal=1.0)
+        entries = [
+            {'habit': self.habit.id, 'date': self.today.isoformat(), 'amount': 5},
+            {'habit': foreign.id, 'date': self.today.isoformat(), 'amount': 5},
+            {'habit': self.habit.id, 'date': '18/10/2026', 'amount': 5},
+            {'habit': self.habit.id, 'date': self.today.isoformat(), 'amount': 'many'},
+            {'habit': 'abc', 'date': self.today.isoformat(), 'amount': 5},
+            [1, 2],
+            {'habit': self.habit.id, 'date': '20240101', 'amount': 5},
+            {'habit': self.habit.id, 'date': '2024-W01-1', 'amount': 5},
+            {'habit': self.habit.id, 'date': 20240101, 'amount': 5},
+        ]
+        response = self.client.post(self.bulk_url, {'logs': entries}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 1)
+        errors = {error['index']: set(error['errors']) for error in response.data['errors']}
+        self.assertEqual(errors, {
+            1: {'habit'}, 2: {'date'}, 3: {'amount'}, 4: {'habit'}, 5: {'non_field_errors'},
+            6: {'date'}, 7: {'date'}, 8: {'date'},
+        })
+        self.assertFalse(HabitLog.objects.filter(habit=foreign).exists())
+
+        response = self.client.post(self.bulk_url, entries[1:], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['created'], 0)
+        self.assertEqual(self.client.post(self.bulk_url, [], format='json').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_habit_ids_that_are_not_pks(self):
+        entries = [
+            {'habit': value, 'date': self.today.isoformat(), 'amount': 5}
+            for value in ('²', '99999999999999999999', -1, 1.5, True, str(self.habit.id))
+        ]
+        response = self.client.post(self.bulk_url, entries, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual([error['index'] for error in response.data['errors']], [0, 1, 2, 3, 4])
+        self.assertIn('does not exist', response.data['errors'][1]['errors']['habit'][0])
+
+    def test_query_count_and_throughput(self):
+        with CaptureQueriesContext(connection) as few:
+            self.client.post(self.bulk_url, self.entries(10), format='json')
+
+        start = time.perf_counter()
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.post(self.bulk_url, self.entries(5000), format='json')
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(response.data['created'], 5000)
+        self.assertEqual(len(few), len(many))
+        self.assertLess(elapsed, 5)
+        self.assertEqual(HabitLog.objects.count(), 5010)
@@ -4,9 +4,11 @@ from .serializers import HabitSerializer, HabitLogSerializer
 
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
 from django.utils import timezone
-from django.db.models import Sum, OuterRef, Subquery
+from django.db import connection
+from django.db.models import Sum, OuterRef, Q, Subquery
 from datetime import timedelta
 from .models import Habit, HabitLog
 from .serializers import HabitSerializer, HabitLogSerializer, FrequencySerializer
@@ -16,9 +18,78 @@ from rest_framework.response import Response
 from django.utils import timezone
 from django.db.models import Sum
 from datetime import timedelta
-from .models import Habit, HabitLog, Frequency
+from .models import Habit, HabitDailyTotal, HabitLog, Frequency
+from .ingest import BULK_MAX_LOGS, ingest_logs
+from .parsers import NDJSONParser
 from .serializers import HabitSerializer, HabitLogSerializer
 
+HISTORY_DAYS = 7
+MAX_HISTORY_DAYS = 366
+
+# How the days of a graph point are combined. Each day counts with its total (the sum of its logs),
+# except for 'last', the latest amount logged in the point
+GRAPH_AGGREGATIONS = {
+    'sum': 'sum(d.total)',
+    'max': 'max(d.total)',
+    'avg': 'avg(d.total)',  # over the days with logs
+    'last': '(array_agg(d.last_amount ORDER BY d.date DESC))[1]',
+}
+
+
+def graph_params(query_params):
+    """
+    Description: startDateRange (days, default 7), dateStep (days per point, default 1) and
+    aggregation (default 'last') of a graph request. Raises ValueError with the message to return.
+    """
+    try:
+        # Convert start_date_range and date_step to integers
+        start_date_range = int(query_params.get('startDateRange', '7'))
+        date_step = int(query_params.get('dateStep', '1'))
+    except ValueError:
+        raise ValueError("startDateRange and dateStep must be integers")
+    if start_date_range < 1 or date_step < 1:
+        raise ValueError("startDateRange and dateStep must be positive")
+
+    aggregation = query_params.get('aggregation', 'last')
+    if aggregation not in GRAPH_AGGREGATIONS:
+        raise ValueError(f"aggregation must be one of: {', '.join(GRAPH_AGGREGATIONS)}")
+    return start_date_range, date_step, aggregation
+
+
+def graph_series(habit_ids, start_date_range, date_step, aggregation='last'):
+    """
+    Description: the graph points of the last `start_date_range` days of each habit, one every
+    `date_step` days. The database groups the daily totals (HabitDailyTotal) into the points, so only the
+    points come back; points without logs are 0.
+
+    Returns {habit_id: [{'date': 'YYYY-MM-DD', 'amount': ...}]}.
+    """
+    if not habit_ids:
+        return {}
+
+    today = timezone.now().date()
+    date_from = today - timedelta(days=start_date_range-1)
+    points = range(0, start_date_range, date_step)
+    date_to = date_from + timedelta(days=len(points) * date_step - 1)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT d.habit_id, (d.date - %s::date) / %s AS point, {GRAPH_AGGREGATIONS[aggregation]}
+            FROM {HabitDailyTotal._meta.db_table} d
+            WHERE d.habit_id = ANY(%s) AND d.date BETWEEN %s AND %s
+            GROUP BY 1, 2
+        """, [date_from, date_step, list(habit_ids), date_from, date_to])
+        amounts = {(habit_id, point): amount for habit_id, point, amount in cursor.fetchall()}
+
+    return {
+        habit_id: [{
+            'date': (date_from + timedelta(days=i)).strftime('%Y-%m-%d'),  # Format the date
+            'amount': amounts.get((habit_id, i // date_step), 0),  # Use 0 if nothing was logged
+        } for i in points]
+        for habit_id in habit_ids
+    }
+
+
 class HabitViewSet(viewsets.ModelViewSet):
     serializer_class = HabitSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -38,40 +109,12 @@ class HabitViewSet(viewsets.ModelViewSet):
         except Habit.DoesNotExist:
             return Response({"error": "Habit not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        # Get query parameters for date step and range
-        start_date_range = request.query_params.get('startDateRange', '7')
-        date_step = request.query_params.get('dateStep', '1')
-
         try:
-            # Convert start_date_range and date_step to integers
-            start_date_range = int(start_date_range)
-            date_step = int(date_step)
-        except ValueError:
-            return Response({"error": "startDateRange and dateStep must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+            start_date_range, date_step, aggregation = graph_params(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Calculate the date range
-        today = timezone.now().date()
-        date_from = today - timedelta(days=start_date_range-1)
-
-        # Generate the list of dates within the range, spaced by `date_step`
-        all_dates = []
-        for i in range(0, start_date_range, date_step):
-            date = date_from + timedelta(days=i)
-            all_dates.append(date)
-
-        # Fetch existing logs within the range
-        habit_logs = HabitLog.objects.filter(habit=habit, date__gte=date_from).order_by('date')
-
-        # Convert the habit logs to a dictionary keyed by the date for easier lookup
-        logs_dict = {log.date: log.amount for log in habit_logs}
-
-        # Prepare the data for the chart, ensuring all dates are present
-        logs_data = []
-        for date in all_dates:
-            logs_data.append({
-                'date': date.strftime('%Y-%m-%d'),  # Format the date
-                'amount': logs_dict.get(date, 0),  # Use 0 if no log exists for the date
-            })
+        logs_data = graph_series([habit.id], start_date_range, date_step, aggregation)[habit.id]
 
         return Response({
             'habit': habit.name,
@@ -80,25 +123,66 @@ class HabitViewSet(viewsets.ModelViewSet):
             'logs': logs_data,
         }, status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=['get'], url_path='graph-logs', url_name='graph-logs')
+    def get_habits_logs(self, request):
+        """
+        Description: the habit-graph-logs of many habits in one request, from one grouped query.
+        ?ids=1,2,3 picks the habits (all of the user's by default); the other parameters are the same.
+        """
+        habits = self.get_queryset().order_by('id')
+        ids = request.query_params.get('ids')
+        if ids:
+            try:
+                ids = [int(habit_id) for habit_id in ids.split(',') if habit_id.strip()]
+            except ValueError:
+                return Response({"error": "ids must be a comma separated list of integers"}, status=status.HTTP_400_BAD_REQUEST)
+            habits = {habit.id: habit for habit in habits.filter(id__in=ids)}
+            # in the order asked, habits of other users are left out
+            habits = [habits[habit_id] for habit_id in dict.fromkeys(ids) if habit_id in habits]
+
+        try:
+            start_date_range, date_step, aggregation = graph_params(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        habits = list(habits)
+        series = graph_series([habit.id for habit in habits], start_date_range, date_step, aggregation)
+
+        return Response([{
+            'id': habit.id,
+            'habit': habit.name,
+            'goal': habit.goal,
+            'measure': habit.measure,
+            'logs': series[habit.id],
+        } for habit in habits], status=status.HTTP_200_OK)
+
     @action(detail=False, methods=['get'], url_path='completion-status', url_name='completion-status')
     def completion_status(self, request):
-        habits = self.get_queryset()
-        results = []
+        today = timezone.now().date()
+        windows = {
+            'daily': today - timedelta(days=1),
+            'weekly': today - timedelta(weeks=1),
+            'monthly': today - timedelta(days=30),
+        }
+
+        # One query: the habit's first frequency and its logged total over each window, picked below
+        first_frequency = Habit.frequencies.through.objects.filter(
+            habit_id=OuterRef('pk')
+        ).order_by('frequency_id').values('frequency__name')[:1]
+        totals = {
+            f'{name}_total': Sum('daily_totals__total', filter=Q(daily_totals__date__gte=date_from), default=0)
+            for name, date_from in windows.items()
+        }
+        habits = self.get_queryset().annotate(frequency=Subquery(first_frequency), **totals).order_by('id')
 
+        results = []
         for habit in habits:
             goal = habit.goal
-            frequency = habit.frequencies.first().name
-            if frequency == 'daily':
-                date_from = timezone.now().date() - timedelta(days=1)
-            elif frequency == 'weekly':
-                date_from = timezone.now().date() - timedelta(weeks=1)
-            elif frequency == 'monthly':
-                date_from = timezone.now().date() - timedelta(days=30)
-            else:
+            frequency = habit.frequency
+            if frequency not in windows:
                 continue
 
-            habit_logs = HabitLog.objects.filter(habit=habit, date__gte=date_from)
-            total_amount = habit_logs.aggregate(Sum('amount'))['amount__sum'] or 0
+            total_amount = getattr(habit, f'{frequency}_total')
             percentage_completion = (total_amount / goal) * 100 if goal else 0
             completed = percentage_completion >= 100
 
@@ -116,30 +200,28 @@ class HabitViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['get'], url_path='history', url_name='history')
     def habit_history(self, request):
-        habits = self.get_queryset()
-        date_from = timezone.now().date() - timedelta(days=7)
-        results = []
+        try:
+            days = int(request.query_params.get('days', HISTORY_DAYS))
+        except ValueError:
+            return Response({"error": "days must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= days <= MAX_HISTORY_DAYS:
+            return Response({"error": f"days must be between 1 and {MAX_HISTORY_DAYS}"}, status=status.HTTP_400_BAD_REQUEST)
 
-        for habit in habits:
-            # Get the last log for each date
-            latest_logs_subquery = HabitLog.objects.filter(
-                habit=habit,
-                date=OuterRef('date')
-            ).order_by('-id')
-
-            habit_logs = HabitLog.objects.filter(
-                habit=habit,
-                date__gte=date_from,
-                id=Subquery(latest_logs_subquery.values('id')[:1])
-            ).order_by('date')
-
-            # Serialize the filtered logs
-            habit_logs_data = HabitLogSerializer(habit_logs, many=True).data
-            results.append({
-                'habit': habit.name,
-                'logs': habit_logs_data
-            })
+        habits = self.get_queryset().order_by('id')
+        date_from = timezone.now().date() - timedelta(days=days)
 
+        # The last log of each habit and date, for all the habits at once, found through the daily totals
+        last_log_ids = HabitDailyTotal.objects.filter(
+            habit__user=request.user,
+            date__gte=date_from
+        ).values('last_log_id')
+        latest_logs = HabitLog.objects.filter(id__in=last_log_ids).order_by('habit_id', 'date')
+
+        logs_by_habit = {}
+        for log in HabitLogSerializer(latest_logs, many=True).data:
+            logs_by_habit.setdefault(log['habit'], []).append(log)
+
+        results = [{'habit': habit.name, 'logs': logs_by_habit.get(habit.id, [])} for habit in habits]
         return Response(results, status=status.HTTP_200_OK)
 
 
@@ -155,6 +237,23 @@ class HabitLogViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save()
 
+    @action(detail=False, methods=['post'], url_path='bulk', url_name='bulk', parser_classes=[JSONParser, NDJSONParser])
+    def bulk_ingest(self, request):
+        """
+        Description: create many logs at once, e.g. the readings of a wearable sync. The body is a JSON
+        list of {habit, date, amount} (or {"logs": [...]}), or NDJSON with one entry per line.
+        Valid entries are saved even if others are rejected; the errors come back with their index.
+        """
+        entries = request.data.get('logs') if isinstance(request.data, dict) else request.data
+        if not isinstance(entries, list) or not entries:
+            return Response({"error": "Send a list of logs."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(entries) > BULK_MAX_LOGS:
+            return Response({"error": f"At most {BULK_MAX_LOGS} logs per request."}, status=status.HTTP_400_BAD_REQUEST)
+
+        result = ingest_logs(request.user, entries)
+        code = status.HTTP_201_CREATED if result['created'] else status.HTTP_400_BAD_REQUEST
+        return Response(result, status=code)
+
 class FrequencyViewSet(viewsets.ModelViewSet):
     serializer_class = FrequencySerializer
     permission_classes = [permissions.IsAuthenticated]